@@ -0,0 +1,111 @@
+"""
+Time-to-candidate of the asyncio STUN client (client/stun_client.py) on lossy links: emulated STUN
+servers drop each request and each response with probability --loss and answer after a one-way
+--delay (plus jitter) each way. Many clients query, 20 at a time; reported are the p50/p90/p99 times
+until query.first() returns a mapped address, and the share that got none within --timeout, for one
+server and for several servers queried concurrently.
+
+$ python3 benchmarks/bench_client_loss.py [--loss 0,0.1,0.3] [--servers 1,3] [--clients 300] [--delay 0.03]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+import stun_server  # noqa: E402
+from stun_client import StunClient, StunError  # noqa: E402
+
+
+class LossyStunServer(asyncio.DatagramProtocol):
+    """ Answers binding requests, losing requests and responses with probability loss, after delay each way """
+    def __init__(self, loss, delay, jitter, rng):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.rng = rng
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def one_way(self):
+        return self.delay + self.rng.random() * self.jitter
+
+    def datagram_received(self, data, client_address):
+        if self.rng.random() < self.loss or not stun_server.is_stun_message(data, len(data)):
+            return
+        response = stun_server.create_stun_binding_response(data[8:20], *client_address[:2])
+        if self.rng.random() >= self.loss:
+            asyncio.get_running_loop().call_later(self.one_way() + self.one_way(), self.respond, response, client_address)
+
+    def respond(self, response, client_address):
+        if not self.transport.is_closing():
+            self.transport.sendto(response, client_address)
+
+
+async def time_to_candidate(servers, timeout, concurrency):
+    async with concurrency, StunClient(timeout=timeout) as client:
+        start = asyncio.get_running_loop().time()
+        query = client.query(servers)
+        try:
+            await query.first()
+            return asyncio.get_running_loop().time() - start
+        except StunError:
+            return None
+        finally:
+            query.cancel()
+
+
+async def run(loss, server_count, clients, delay, jitter, timeout, seed):
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    transports = []
+    servers = []
+    for _ in range(server_count):
+        transport, _ = await loop.create_datagram_endpoint(lambda: LossyStunServer(loss, delay, jitter, rng),
+                                                           local_addr=('127.0.0.1', 0))
+        transports.append(transport)
+        servers.append(transport.get_extra_info('sockname'))
+    try:
+        concurrency = asyncio.Semaphore(20)  # keep the event loop from adding its own queueing delay
+        times = await asyncio.gather(*(time_to_candidate(servers, timeout, concurrency) for _ in range(clients)))
+    finally:
+        for transport in transports:
+            transport.close()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loss', default="0,0.1,0.3", help="comma separated loss rates (each direction)")
+    parser.add_argument('--servers', default="1,3", help="comma separated numbers of servers queried at once")
+    parser.add_argument('--clients', type=int, default=300, help="clients per measurement")
+    parser.add_argument('--delay', type=float, default=0.03, help="one-way delay in seconds")
+    parser.add_argument('--jitter', type=float, default=0.02, help="random extra one-way delay, up to this many seconds")
+    parser.add_argument('--timeout', type=float, default=9.5, help="give up after this many seconds")
+    args = parser.parse_args()
+
+    print(f"{'loss':>6}{'servers':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'failed':>9}"
+          f"   (one request, no retransmission: unanswered)")
+    for loss in (float(value) for value in args.loss.split(',')):
+        for server_count in (int(value) for value in args.servers.split(',')):
+            times = asyncio.run(run(loss, server_count, args.clients, args.delay, args.jitter, args.timeout, seed=1))
+            answered = sorted(t for t in times if t is not None)
+            if len(answered) >= 2:
+                cuts = statistics.quantiles(answered, n=100, method='inclusive')
+                p50, p90, p99 = cuts[49] * 1e3, cuts[89] * 1e3, cuts[98] * 1e3
+            else:
+                p50 = p90 = p99 = float('nan')
+            failed = 1 - len(answered) / len(times)
+            single_shot = (1 - (1 - loss) ** 2) ** server_count
+            print(f"{loss:6.0%}{server_count:9}{p50:10.0f}{p90:10.0f}{p99:10.0f}{failed:9.1%}   {single_shot:.1%}")
+
+
+if __name__ == '__main__':
+    main()
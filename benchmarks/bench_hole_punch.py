@@ -0,0 +1,103 @@
+"""
+Time-to-connect and probes sent by the hole punching engine (client/hole_punch.py) for several
+pacing settings, between two clients behind emulated NATs (benchmarks/nat_emulator.py) with
+port-restricted filtering: the first peer starts punching at once, the second after --notify seconds
+(when the room's join notice reaches it), so the first peer's early probes are filtered. Reported
+are p50/p90 times until both peers are connected, counted from the first peer's start, and the
+probes both sent.
+
+--pacing takes burst:spacing:interval:backoff settings: burst probes spacing seconds apart, then a
+pause of interval seconds growing by backoff (up to --max-interval) until the next burst.
+
+$ python3 benchmarks/bench_hole_punch.py [--pacing 1:0:0.05:2,2:0.02:0.1:2] [--loss 0.05] [--delay 0.03] [--notify 0.3]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+from hole_punch import HolePuncher, HolePunchError  # noqa: E402
+from nat_emulator import NatNetwork  # noqa: E402
+from stun_client import StunClient  # noqa: E402
+
+
+async def trial(pacing, args, rng):
+    burst, spacing, interval, backoff = pacing
+    network = NatNetwork(args.loss, args.delay, args.jitter, rng)
+    clients = [await StunClient(local_host='127.0.0.1').open() for _ in range(2)]
+    punchers = [HolePuncher(client, burst, spacing, interval, backoff, args.max_interval, args.timeout)
+                for client in clients]
+    nats = []
+    for client in clients:
+        nat = network.add_nat(args.filtering)
+        nat.host = client.transport.get_extra_info('sockname')
+        nats.append(nat)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    async def punch(puncher, peer, delay):
+        await asyncio.sleep(delay)
+        try:
+            transport, _ = await puncher.connect([peer.address])
+            return loop.time() - start, transport.get_extra_info('punch').probes_sent
+        except HolePunchError as e:
+            return None, e.stats.probes_sent
+
+    try:
+        (time_a, probes_a), (time_b, probes_b) = await asyncio.gather(
+            punch(punchers[0], nats[1], 0), punch(punchers[1], nats[0], args.notify))
+    finally:
+        for puncher, client in zip(punchers, clients):
+            puncher.close()
+            client.close()
+        network.close()
+    if time_a is None or time_b is None:
+        return None, probes_a + probes_b
+    return max(time_a, time_b), probes_a + probes_b
+
+
+async def run(pacing, args):
+    rng = random.Random(1)
+    results = []
+    for _ in range(0, args.trials, 10):
+        results += await asyncio.gather(*(trial(pacing, args, rng) for _ in range(10)))
+    return results[:args.trials]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pacing', default="1:0:0.05:2,2:0.02:0.1:2,3:0.01:0.2:1.5,1:0:0.5:1",
+                        help="comma separated burst:spacing:interval:backoff settings")
+    parser.add_argument('--max-interval', type=float, default=1.0, help="longest pause between bursts")
+    parser.add_argument('--trials', type=int, default=50, help="connects per setting")
+    parser.add_argument('--loss', type=float, default=0.05, help="loss rate of each datagram")
+    parser.add_argument('--delay', type=float, default=0.03, help="one-way delay in seconds")
+    parser.add_argument('--jitter', type=float, default=0.01, help="random extra one-way delay, up to this many seconds")
+    parser.add_argument('--notify', type=float, default=0.3, help="seconds before the second peer starts punching")
+    parser.add_argument('--filtering', default='port', choices=('none', 'address', 'port'), help="NAT filtering")
+    parser.add_argument('--timeout', type=float, default=10.0, help="give up after this many seconds")
+    args = parser.parse_args()
+
+    print(f"{'pacing':<18}{'p50 ms':>9}{'p90 ms':>9}{'probes':>8}{'failed':>8}")
+    for setting in args.pacing.split(','):
+        burst, spacing, interval, backoff = setting.split(':')
+        pacing = int(burst), float(spacing), float(interval), float(backoff)
+        results = asyncio.run(run(pacing, args))
+        times = sorted(t for t, _ in results if t is not None)
+        if len(times) >= 2:
+            cuts = statistics.quantiles(times, n=10, method='inclusive')
+            p50, p90 = cuts[4] * 1e3, cuts[8] * 1e3
+        else:
+            p50 = p90 = float('nan')
+        probes = statistics.mean(p for _, p in results)
+        failed = 1 - len(times) / len(results)
+        print(f"{setting:<18}{p50:9.0f}{p90:9.0f}{probes:8.1f}{failed:8.1%}")
+
+
+if __name__ == '__main__':
+    main()
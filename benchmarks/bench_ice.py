@@ -0,0 +1,115 @@
+"""
+Connect time of two peers on the same LAN with ICE candidate exchange (client/ice.py) versus punching
+to the server-reflexive candidate only (the room roster's "cnd"). The peers' host candidates are
+their real localhost sockets; their server-reflexive candidates are public addresses of emulated NATs
+(benchmarks/nat_emulator.py) whose path adds --hairpin-delay each way, like a NAT that hairpins
+traffic between its own clients, or drops it with --no-hairpin. Candidates reach the other peer
+after --signal seconds (the websocket sendMessage round trip), as does the roster/join notice.
+A peer that gets a check from an address it has no candidate for yet reports it as peer-reflexive.
+
+$ python3 benchmarks/bench_ice.py [--trials 50] [--signal 0.05] [--hairpin-delay 0.02] [--no-hairpin]
+"""
+
+import argparse
+import asyncio
+import collections
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+from hole_punch import HolePuncher  # noqa: E402
+from ice import IceAgent, gather_candidates, make_candidate  # noqa: E402
+from nat_emulator import NatNetwork  # noqa: E402
+from stun_client import BindingResult, StunClient  # noqa: E402
+
+
+async def trial(use_ice, args, rng):
+    loop = asyncio.get_running_loop()
+    network = NatNetwork(1.0 if args.no_hairpin else 0.0, args.hairpin_delay, 0.0, rng)
+    clients = [await StunClient(local_host='127.0.0.1').open() for _ in range(2)]
+    nats = []
+    for client in clients:
+        nat = network.add_nat('port')
+        nat.host = client.transport.get_extra_info('sockname')
+        nats.append(nat)
+    uids = ['a', 'b']
+    punchers = [HolePuncher(client, check_spacing=args.check_spacing, timeout=args.timeout, uid=uid)
+                for client, uid in zip(clients, uids)]
+    connected = [loop.create_future(), loop.create_future()]
+    agents = []
+    for index, (client, nat) in enumerate(zip(clients, nats)):
+        mapped = BindingResult(server=('127.0.0.1', 3478), mapped_address=nat.address, answered=True)
+        candidates = gather_candidates(client, mapped) if use_ice else []
+        other = 1 - index
+
+        def send(uid, candidates, other=other, me=uids[index]):
+            if candidates:
+                loop.call_later(args.signal, lambda: agents[other].start(me, candidates))
+
+        def on_connected(uid, transport, remote, index=index):
+            if not connected[index].done():
+                connected[index].set_result((loop.time(), remote.kind, transport.get_extra_info('punch')))
+
+        def on_failed(uid, error, index=index):
+            if not connected[index].done():
+                connected[index].set_result((None, None, error.stats))
+
+        agents.append(IceAgent(punchers[index], candidates, send, on_connected=on_connected,
+                               on_failed=on_failed))
+
+    start = loop.time()
+    # a knows b from the roster at once; b learns a's candidate from the join notice
+    agents[0].start('b', [make_candidate('srflx', nats[1].address)])
+    loop.call_later(args.signal, lambda: agents[1].start('a', [make_candidate('srflx', nats[0].address)]))
+    try:
+        results = await asyncio.gather(*connected)
+    finally:
+        for agent, puncher, client in zip(agents, punchers, clients):
+            agent.close()
+            puncher.close()
+            client.close()
+        network.close()
+    probes = sum(stats.probes_sent for _, _, stats in results)
+    if any(t is None for t, _, _ in results):
+        return None, None, probes
+    return max(t for t, _, _ in results) - start, '/'.join(kind for _, kind, _ in results), probes
+
+
+async def run(use_ice, args):
+    rng = random.Random(1)
+    results = []
+    for _ in range(0, args.trials, 10):
+        results += await asyncio.gather(*(trial(use_ice, args, rng) for _ in range(10)))
+    return results[:args.trials]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=50, help="connects per mode")
+    parser.add_argument('--signal', type=float, default=0.05, help="seconds for a websocket message to reach the peer")
+    parser.add_argument('--hairpin-delay', type=float, default=0.02, help="one-way delay through the NAT in seconds")
+    parser.add_argument('--no-hairpin', action='store_true', help="the NAT drops traffic between its own clients")
+    parser.add_argument('--check-spacing', type=float, default=0.02, help="seconds between checks of candidates")
+    parser.add_argument('--timeout', type=float, default=5.0, help="give up after this many seconds")
+    args = parser.parse_args()
+
+    print(f"{'mode':<7}{'p50 ms':>9}{'p90 ms':>9}{'probes':>8}{'failed':>8}   selected by a/b")
+    for name, use_ice in (('srflx', False), ('ice', True)):
+        results = asyncio.run(run(use_ice, args))
+        times = sorted(t for t, _, _ in results if t is not None)
+        if len(times) >= 2:
+            cuts = statistics.quantiles(times, n=10, method='inclusive')
+            p50, p90 = cuts[4] * 1e3, cuts[8] * 1e3
+        else:
+            p50 = p90 = float('nan')
+        probes = statistics.mean(p for _, _, p in results)
+        failed = 1 - len(times) / len(results)
+        kinds = collections.Counter(kind for _, kind, _ in results if kind is not None)
+        print(f"{name:<7}{p50:9.0f}{p90:9.0f}{probes:8.1f}{failed:8.1%}   {dict(kinds)}")
+
+
+if __name__ == '__main__':
+    main()
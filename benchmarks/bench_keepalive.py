@@ -0,0 +1,92 @@
+"""
+CPU cost of holding many NAT mappings open: --ports local ports, each sending a binding request to a
+local STUN server every --interval seconds for --duration seconds, scheduled by the client's timer
+wheel (client/keepalive.py) and, for comparison, by one asyncio task per port sleeping between
+requests. Reported are keepalives/sec, answered share and the client process's CPU use.
+
+$ python3 benchmarks/bench_keepalive.py [--ports 2000] [--interval 2] [--duration 10] [--engine fast]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+from keepalive import KeepaliveScheduler  # noqa: E402
+from loadgen import start_server  # noqa: E402
+from stun_client import StunClient  # noqa: E402
+
+
+async def wheel(clients, server, interval, duration):
+    scheduler = KeepaliveScheduler(interval=interval)
+    keepalives = [await scheduler.add(client, server) for client in clients]
+    start = time.process_time()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - start
+    scheduler.close()
+    return cpu, sum(k.sent for k in keepalives), sum(k.answered for k in keepalives)
+
+
+async def tasks(clients, server, interval, duration):
+    counts = [0, 0]
+
+    def count_answer(request):
+        if not request.cancelled() and request.result().ok:
+            counts[1] += 1
+
+    async def keep_alive(client):
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            counts[0] += 1
+            request = asyncio.ensure_future(client.request(server))
+            request.add_done_callback(count_answer)
+            await asyncio.sleep(interval * (1 - random.uniform(0, 0.2)))
+            request.cancel()
+
+    running = [asyncio.ensure_future(keep_alive(client)) for client in clients]
+    start = time.process_time()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - start
+    for task in running:
+        task.cancel()
+    await asyncio.gather(*running, return_exceptions=True)
+    return cpu, counts[0], counts[1]
+
+
+async def run(mode, ports, server, interval, duration):
+    clients = [await StunClient(max_transmissions=1, timeout=interval).open() for _ in range(ports)]
+    try:
+        return await mode(clients, server, interval, duration)
+    finally:
+        for client in clients:
+            client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ports', type=int, default=2000, help="local ports kept alive")
+    parser.add_argument('--interval', type=float, default=2.0, help="seconds between keepalives of a port")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds measured per mode")
+    parser.add_argument('--engine', default='fast', help="engine of the local STUN server")
+    parser.add_argument('--port', type=int, default=34840, help="local STUN server port")
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.engine, [])
+    try:
+        print(f"{'mode':<8}{'keepalives/s':>14}{'answered':>10}{'CPU':>8}{'CPU us/keepalive':>18}")
+        for name, mode in (('wheel', wheel), ('tasks', tasks)):
+            cpu, sent, answered = asyncio.run(run(mode, args.ports, ('127.0.0.1', args.port),
+                                                  args.interval, args.duration))
+            print(f"{name:<8}{sent / args.duration:14,.0f}{answered / max(sent, 1):10.1%}"
+                  f"{cpu / args.duration:8.1%}{cpu / max(sent, 1) * 1e6:18.1f}")
+    finally:
+        server.kill()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Micro-benchmark: BindingResponder with and without the cache of encoded XOR-MAPPED-ADDRESS
+attributes, replaying keepalive-heavy traffic.
+
+--clients clients send keepalive binding requests in random order; a --churn share of the
+requests comes from a source never seen before (new clients, NAT rebinding).
+
+Sources are replayed as IPv4 (ip, port) addresses, as the v4-mapped (ip, port, flowinfo, scope_id)
+addresses a dual-stack socket reports for the same clients, and as IPv6 clients.
+
+$ python3 benchmarks/bench_mapped_cache.py [-n 300000] [--clients 5000] [--churn 0.02] [--cache-size 65536] [--families ipv4,mapped,ipv6]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import stun_server  # noqa: E402
+
+REQUEST = b"\x00\x01\x00\x00" + b"\x21\x12\xA4\x42" + os.urandom(12)
+
+
+def make_sources(n, clients, churn, seed=1):
+    rng = random.Random(seed)
+    keepalive = [(f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", 1024 + i % 60000) for i in range(clients)]
+    sources = []
+    for i in range(n):
+        if rng.random() < churn:
+            sources.append((f"172.{16 + (i >> 16 & 15)}.{i >> 8 & 255}.{i & 255}", 1024 + rng.randrange(60000)))
+        else:
+            sources.append(rng.choice(keepalive))
+    return sources
+
+
+def as_family(sources, family):
+    """ The sources as a socket of that family reports them """
+    if family == 'mapped':
+        return [(f"::ffff:{ip}", port, 0, 0) for ip, port in sources]
+    if family == 'ipv6':
+        return [("2001:db8::" + ip.replace('.', ':'), port, 0, 0) for ip, port in sources]
+    return sources
+
+
+def replay(responder, sources):
+    """ Returns packets/sec """
+    build_response = responder.build_response
+    nbytes = len(REQUEST)
+    start = time.perf_counter()
+    for client_address in sources:
+        build_response(REQUEST, nbytes, client_address)
+    return len(sources) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=300000, help="requests replayed per run")
+    parser.add_argument('--clients', type=int, default=5000, help="clients sending keepalives")
+    parser.add_argument('--churn', type=float, default=0.02, help="share of requests from new sources")
+    parser.add_argument('--cache-size', type=int, default=65536, help="mapped_cache_size of the cached run")
+    parser.add_argument('--families', default='ipv4,mapped,ipv6', help="comma separated: ipv4, mapped (dual-stack), ipv6")
+    args = parser.parse_args()
+
+    for family in args.families.split(','):
+        sources = as_family(make_sources(args.n, args.clients, args.churn), family)
+        for name, cache_size in (('no cache', 0), (f'cache ({args.cache_size})', args.cache_size)):
+            counters = stun_server.PacketCounters()
+            responder = stun_server.BindingResponder(mapped_cache_size=cache_size, counters=counters)
+            replay(responder, sources[:args.clients])  # warm up
+            counters.mapped_cache_hits = counters.mapped_cache_misses = 0
+            pps = replay(responder, sources)
+            hit_rate = counters.mapped_cache_hits / len(sources)
+            print(f"{family:>6} {name:>16}: {pps:12,.0f} packets/sec  ({1e9 / pps:5.0f} ns/packet)  hit rate {hit_rate:6.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark: cost of the RFC 5389 prefilter and attribute parsing on valid and garbage traffic.
+
+Compares, per packet:
+    parse_stun_message      - the original parser (no validation beyond the cookie)
+    is_stun_message         - the prefilter alone
+    iter_stun_attributes    - prefilter + walking every TLV
+    BindingResponder        - the whole hot path (prefilter, attribute checks, response)
+
+$ python3 benchmarks/bench_parser.py [-n 100000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import stun_server  # noqa: E402
+
+CLIENT_ADDRESS = ('203.0.113.7', 54321)
+
+
+def make_traffic(seed=1):
+    rng = random.Random(seed)
+    transaction_id = bytes(rng.getrandbits(8) for _ in range(12))
+    return {
+        'binding request': stun_server.create_stun_message(stun_server.STUN_BINDING_REQUEST, transaction_id),
+        'request + SOFTWARE + FINGERPRINT': stun_server.create_stun_message(
+            stun_server.STUN_BINDING_REQUEST, transaction_id,
+            [(stun_server.STUN_ATTR_SOFTWARE, b"bench client")], fingerprint=True),
+        'garbage (random 100 bytes)': bytes(rng.getrandbits(8) for _ in range(100)),
+        'garbage (RTP-like, 0x80 first byte)': b"\x80\x60" + bytes(rng.getrandbits(8) for _ in range(170)),
+        'garbage (cookie, bad length)': stun_server.create_stun_message(stun_server.STUN_BINDING_REQUEST, transaction_id) + b"\x00" * 4,
+    }
+
+
+def walk(data):
+    if stun_server.is_stun_message(data, len(data)):
+        for _ in stun_server.iter_stun_attributes(data):
+            pass
+
+
+def nanoseconds_per_packet(fn, data, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn(data)
+    return (time.perf_counter() - start) / n * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=100000, help="packets per measurement")
+    args = parser.parse_args()
+
+    responder = stun_server.BindingResponder(verify_fingerprint=True)
+    variants = {
+        'parse_stun_message': stun_server.parse_stun_message,
+        'is_stun_message': lambda data: stun_server.is_stun_message(data, len(data)),
+        'iter_stun_attributes': walk,
+        'BindingResponder': lambda data: responder.build_response(data, len(data), CLIENT_ADDRESS),
+    }
+
+    print(f"{'ns/packet':>36}" + "".join(f"{name:>22}" for name in variants))
+    for traffic, data in make_traffic().items():
+        row = [nanoseconds_per_packet(fn, data, args.n) for fn in variants.values()]
+        print(f"{traffic:>36}" + "".join(f"{ns:22.0f}" for ns in row))
+
+
+if __name__ == '__main__':
+    main()
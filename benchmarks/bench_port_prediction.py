@@ -0,0 +1,120 @@
+"""
+Success rate of hole punching to a peer behind a symmetric NAT with port prediction
+(client/port_prediction.py), against the number of probes sent, on emulated NATs
+(benchmarks/nat_emulator.py). The symmetric peer samples its mapping from --samples STUN servers at
+once, then sends the predicted window of its next ports to the other peer (behind a port-restricted
+cone NAT) and punches to it; the other peer probes the window, --batch probes every --spacing
+seconds. Window 0 is the single candidate a STUN query reports, i.e. no prediction. --noise is the
+average number of ports other hosts behind the symmetric NAT take between two allocations.
+
+$ python3 benchmarks/bench_port_prediction.py [--windows 0,1,4,16,64] [--noise 0,0.5,2] [--delta 1] [--trials 30]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+from bench_client_loss import LossyStunServer  # noqa: E402
+from hole_punch import HolePuncher, HolePunchError  # noqa: E402
+from nat_emulator import NatNetwork  # noqa: E402
+from port_prediction import sample_mapping  # noqa: E402
+from stun_client import StunClient, StunError  # noqa: E402
+
+
+async def trial(window, noise, stun_servers, args, rng):
+    loop = asyncio.get_running_loop()
+    network = NatNetwork(args.loss, args.delay, 0.0, rng)
+    servers = [network.add_public_host(server) for server in stun_servers[:args.samples]]
+    symmetric_client = await StunClient(local_host='127.0.0.1', timeout=2).open()
+    cone_client = await StunClient(local_host='127.0.0.1').open()
+    symmetric_nat = network.add_nat('port', 'symmetric', args.delta, noise)
+    symmetric_nat.host = symmetric_client.transport.get_extra_info('sockname')
+    cone_nat = network.add_nat('port')
+    cone_nat.host = cone_client.transport.get_extra_info('sockname')
+    symmetric_puncher = HolePuncher(symmetric_client, timeout=args.timeout)
+    cone_puncher = HolePuncher(cone_client, timeout=args.timeout, check_spacing=args.spacing, batch=args.batch)
+
+    async def punch(puncher, candidates, delay):
+        await asyncio.sleep(delay)
+        try:
+            transport, _ = await puncher.connect(candidates)
+            return loop.time() - start, transport.get_extra_info('punch').probes_sent
+        except HolePunchError as e:
+            return None, e.stats.probes_sent
+
+    try:
+        try:
+            behavior = await sample_mapping(symmetric_client, servers)
+        except StunError:
+            return None, 0
+        if window:
+            candidates = behavior.predicted_candidates(window)
+        else:
+            candidates = [('127.0.0.1', behavior.ports[0])]  # what a single STUN query reports
+        start = loop.time()
+        (time_symmetric, _), (time_cone, probes) = await asyncio.gather(
+            punch(symmetric_puncher, [cone_nat.address], args.signal),
+            punch(cone_puncher, candidates, args.signal))
+    finally:
+        for puncher, client in ((symmetric_puncher, symmetric_client), (cone_puncher, cone_client)):
+            puncher.close()
+            client.close()
+        network.close()
+    if time_symmetric is None or time_cone is None:
+        return None, probes
+    return max(time_symmetric, time_cone), probes
+
+
+async def run(window, noise, args):
+    loop = asyncio.get_running_loop()
+    rng = random.Random(1)
+    transports = []
+    for _ in range(args.samples):
+        transport, _ = await loop.create_datagram_endpoint(lambda: LossyStunServer(0, 0, 0, rng),
+                                                           local_addr=('127.0.0.1', 0))
+        transports.append(transport)
+    stun_servers = [transport.get_extra_info('sockname') for transport in transports]
+    results = []
+    try:
+        for _ in range(0, args.trials, 10):
+            results += await asyncio.gather(*(trial(window, noise, stun_servers, args, rng) for _ in range(10)))
+    finally:
+        for transport in transports:
+            transport.close()
+    return results[:args.trials]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--windows', default="0,1,4,16,64", help="comma separated predicted window sizes")
+    parser.add_argument('--noise', default="0,0.5,2", help="comma separated ports taken by others per allocation")
+    parser.add_argument('--delta', type=int, default=1, help="port step of the symmetric NAT")
+    parser.add_argument('--samples', type=int, default=3, help="STUN servers sampled at once")
+    parser.add_argument('--batch', type=int, default=16, help="probes sent at once")
+    parser.add_argument('--spacing', type=float, default=0.01, help="seconds between batches")
+    parser.add_argument('--trials', type=int, default=30, help="connects per setting")
+    parser.add_argument('--loss', type=float, default=0.0, help="loss rate of each datagram")
+    parser.add_argument('--delay', type=float, default=0.02, help="one-way delay in seconds")
+    parser.add_argument('--signal', type=float, default=0.05, help="seconds for the prediction to reach the peer")
+    parser.add_argument('--timeout', type=float, default=3.0, help="give up after this many seconds")
+    args = parser.parse_args()
+    if args.samples < 2:
+        parser.error("--samples needs at least two servers")
+
+    print(f"{'noise':>6}{'window':>8}{'success':>9}{'p50 ms':>9}{'probes':>8}")
+    for noise in (float(value) for value in args.noise.split(',')):
+        for window in (int(value) for value in args.windows.split(',')):
+            results = asyncio.run(run(window, noise, args))
+            times = sorted(t for t, _ in results if t is not None)
+            p50 = statistics.median(times) * 1e3 if times else float('nan')
+            probes = statistics.mean(p for _, p in results)
+            print(f"{noise:6.1f}{window:8}{len(times) / len(results):9.0%}{p50:9.0f}{probes:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
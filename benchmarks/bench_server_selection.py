@@ -0,0 +1,121 @@
+"""
+Time-to-candidate with latency-ranked STUN server selection (client/stun_servers.py) against emulated
+servers with different one-way delays and loss rates: always asking the first configured server (as
+client_api.py did), asking every server at once, and asking the selector's best server first. Reported
+are p50/p99 times until a mapped address arrives and the requests the servers received per candidate.
+With --fail-best the fastest server stops answering halfway through, to show failover.
+
+$ python3 benchmarks/bench_server_selection.py [--delays 0.12,0.06,0.015,0.04] [--loss 0,0,0,0.2] [--clients 200] [--fail-best]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+from bench_client_loss import LossyStunServer  # noqa: E402
+from stun_client import StunClient, StunError  # noqa: E402
+from stun_servers import StunServerSelector  # noqa: E402
+
+
+class CountingStunServer(LossyStunServer):
+    """ LossyStunServer that counts the datagrams it receives """
+    def __init__(self, loss, delay, jitter, rng):
+        super().__init__(loss, delay, jitter, rng)
+        self.received = 0
+
+    def datagram_received(self, data, client_address):
+        self.received += 1
+        super().datagram_received(data, client_address)
+
+
+async def fixed(servers, selector, timeout):
+    async with StunClient(timeout=timeout) as client:
+        return await client.query(servers[:1]).first()
+
+
+async def all_at_once(servers, selector, timeout):
+    async with StunClient(timeout=timeout) as client:
+        query = client.query(servers)
+        try:
+            return await query.first()
+        finally:
+            query.cancel()
+
+
+async def selected(servers, selector, timeout):
+    return await selector.mapped_address()
+
+
+async def run(mode, delays, losses, clients, jitter, timeout, fail_best, seed):
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    transports, protocols, servers = [], [], []
+    for delay, loss in zip(delays, losses):
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: CountingStunServer(loss, delay, jitter, rng), local_addr=('127.0.0.1', 0))
+        transports.append(transport)
+        protocols.append(protocol)
+        servers.append('%s:%d' % transport.get_extra_info('sockname'))
+    selector = StunServerSelector(servers, cache_path=None, timeout=timeout)
+    if mode is selected:
+        await selector.probe()  # what the on-disk cache or background re-probing provide
+
+    concurrency = asyncio.Semaphore(20)
+    best = min(range(len(delays)), key=lambda i: delays[i] / max(1 - losses[i], 0.01))
+
+    async def one(index):
+        async with concurrency:
+            if fail_best and index == clients // 2:
+                protocols[best].loss = 1.0
+            start = loop.time()
+            try:
+                await mode(servers, selector, timeout)
+                return loop.time() - start
+            except StunError:
+                return None
+
+    received_before = sum(protocol.received for protocol in protocols)
+    try:
+        times = await asyncio.gather(*(one(index) for index in range(clients)))
+    finally:
+        for transport in transports:
+            transport.close()
+    received = sum(protocol.received for protocol in protocols) - received_before
+    return times, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--delays', default="0.12,0.06,0.015,0.04", help="comma separated one-way delays in seconds, one per server")
+    parser.add_argument('--loss', default="0,0,0,0.2", help="comma separated loss rates (each direction), one per server")
+    parser.add_argument('--clients', type=int, default=200, help="candidates gathered per mode")
+    parser.add_argument('--jitter', type=float, default=0.01, help="random extra one-way delay, up to this many seconds")
+    parser.add_argument('--timeout', type=float, default=9.5, help="give up after this many seconds")
+    parser.add_argument('--fail-best', action='store_true', help="the fastest server stops answering halfway through")
+    args = parser.parse_args()
+    delays = [float(value) for value in args.delays.split(',')]
+    losses = [float(value) for value in args.loss.split(',')]
+    if len(losses) != len(delays):
+        parser.error("--delays and --loss need one value per server")
+
+    print(f"{'mode':<10}{'p50 ms':>10}{'p99 ms':>10}{'failed':>9}{'requests/candidate':>21}")
+    for name, mode in (('fixed', fixed), ('all', all_at_once), ('selected', selected)):
+        times, received = asyncio.run(run(mode, delays, losses, args.clients, args.jitter, args.timeout,
+                                          args.fail_best, seed=1))
+        answered = sorted(t for t in times if t is not None)
+        if len(answered) >= 2:
+            cuts = statistics.quantiles(answered, n=100, method='inclusive')
+            p50, p99 = cuts[49] * 1e3, cuts[98] * 1e3
+        else:
+            p50 = p99 = float('nan')
+        failed = 1 - len(answered) / len(times)
+        print(f"{name:<10}{p50:10.0f}{p99:10.0f}{failed:9.1%}{received / len(times):21.2f}")
+
+
+if __name__ == '__main__':
+    main()
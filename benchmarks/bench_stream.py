@@ -0,0 +1,171 @@
+"""
+STUN over TCP/TLS vs. UDP on localhost: binding requests/sec on one connection (one request at a time,
+and --window requests pipelined) and the cost of setting a connection up (connect + first response:
+TCP, TLS full handshake, TLS session resumption) against a single UDP round trip.
+
+A server with the fast engine is started with STUN over TCP and TLS (a throwaway self-signed
+certificate is made with the openssl command line tool; without it TLS is skipped).
+
+$ python3 benchmarks/bench_stream.py [-n 20000] [--window 64] [--connections 200]
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import stun_server  # noqa: E402
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stun_server.py')
+RESPONSE_SIZE = stun_server.STUN_BINDING_RESPONSE_V4_SIZE
+
+
+def make_certificate(directory):
+    if shutil.which('openssl') is None:
+        return None
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                    '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost'],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def start_server(port, certificate):
+    command = [sys.executable, SERVER, '--host', '127.0.0.1', '--port', str(port), '--engine', 'fast',
+               '--stun-tcp-port', str(port + 1)]
+    if certificate:
+        command += ['--stun-tls-port', str(port + 2), '--tls-cert', certificate[0], '--tls-key', certificate[1]]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port + 1), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+
+def request():
+    return stun_server.create_stun_message(stun_server.STUN_BINDING_REQUEST, os.urandom(12))
+
+
+def recv_exactly(sock, nbytes):
+    data = b""
+    while len(data) < nbytes:
+        chunk = sock.recv(max(nbytes - len(data), 65536))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+def udp_requests_per_second(address, n):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(1)
+        message = request()
+        start = time.perf_counter()
+        for _ in range(n):
+            sock.sendto(message, address)
+            sock.recv(2048)
+        return n / (time.perf_counter() - start)
+
+
+def stream_requests_per_second(sock, n, window):
+    """ Requests/sec on one connection with window requests in flight (1: request, response, request...) """
+    burst = request() * window
+    start = time.perf_counter()
+    for _ in range(n // window):
+        sock.sendall(burst)
+        recv_exactly(sock, RESPONSE_SIZE * window)
+    return n // window * window / (time.perf_counter() - start)
+
+
+def setup_seconds(connect, count):
+    """ Median seconds from connecting to the first binding response """
+    samples = []
+    message = request()
+    for _ in range(count):
+        start = time.perf_counter()
+        sock = connect()
+        sock.sendall(message)
+        recv_exactly(sock, RESPONSE_SIZE)
+        samples.append(time.perf_counter() - start)
+        sock.close()
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=20000, help="requests per throughput measurement")
+    parser.add_argument('--window', type=int, default=64, help="pipelined requests in flight")
+    parser.add_argument('--connections', type=int, default=200, help="connections per setup cost measurement")
+    parser.add_argument('--port', type=int, default=34910, help="UDP port; TCP and TLS use the next two")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    certificate = make_certificate(directory)
+    server = start_server(args.port, certificate)
+    udp_address, tcp_address, tls_address = ('127.0.0.1', args.port), ('127.0.0.1', args.port + 1), ('127.0.0.1', args.port + 2)
+
+    client_context = ssl.create_default_context()
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+
+    def connect_tcp(address=tcp_address):
+        sock = socket.create_connection(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    session = [None]
+
+    def connect_tls(resume=False):
+        return client_context.wrap_socket(connect_tcp(tls_address), session=session[0] if resume else None)
+
+    def connect_tls_resumed():
+        sock = connect_tls(resume=True)
+        if not sock.session_reused:
+            raise RuntimeError("TLS session was not resumed")
+        return sock
+
+    try:
+        print("requests/sec on one connection")
+        print(f"{'UDP, 1 in flight':>28}: {udp_requests_per_second(udp_address, args.n):10,.0f}")
+        transports = [('TCP', connect_tcp)] + ([('TLS', connect_tls)] if certificate else [])
+        for name, connect in transports:
+            with connect() as sock:
+                for window in (1, args.window):
+                    rps = stream_requests_per_second(sock, args.n, window)
+                    print(f"{f'{name}, {window} in flight':>28}: {rps:10,.0f}")
+
+        print("median time from connect to first response")
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(udp_address)
+            print(f"{'UDP (no connection)':>28}: {setup_seconds(lambda: sock.dup(), args.connections) * 1e6:10.0f} us")
+        print(f"{'TCP':>28}: {setup_seconds(connect_tcp, args.connections) * 1e6:10.0f} us")
+        if certificate:
+            print(f"{'TLS full handshake':>28}: {setup_seconds(connect_tls, args.connections) * 1e6:10.0f} us")
+            with connect_tls() as sock:
+                sock.sendall(request())
+                recv_exactly(sock, RESPONSE_SIZE)  # the session ticket arrives after the handshake
+                session[0] = sock.session
+            print(f"{'TLS resumed session':>28}: {setup_seconds(connect_tls_resumed, args.connections) * 1e6:10.0f} us")
+        else:
+            print("openssl not found, TLS skipped")
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
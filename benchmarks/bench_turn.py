@@ -0,0 +1,135 @@
+"""
+Localhost throughput benchmark of the TurnServer relay loop, for sizing relay boxes.
+
+A TurnServer runs alone in a forked process (one core). A client allocates, binds a channel to a
+peer socket and blasts ChannelData for --duration seconds per payload size; the receiving side
+(in another process) counts what gets through. Reported: delivered packets/sec and payload Mbit/s,
+and the share of sent datagrams lost (the relay or a socket buffer could not keep up).
+
+    client -> peer: ChannelData from the client, relayed out of the relay socket
+    peer -> client: datagrams from the peer, relayed to the client as ChannelData
+
+$ python3 benchmarks/bench_turn.py [--duration 2] [--sizes 64,512,1200] [--direction both]
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import stun_server  # noqa: E402
+
+CHANNEL = 0x4000
+
+
+def run_server(turn_socket):
+    stun_server.TurnServer(turn_socket, '127.0.0.1').serve_forever()
+
+
+def request(sock, server_address, method, attributes):
+    sock.sendto(stun_server.create_stun_message(method, os.urandom(12), attributes), server_address)
+    data, _ = sock.recvfrom(2048)
+    message_type = int.from_bytes(data[:2], 'big')
+    if message_type != method | stun_server.STUN_CLASS_SUCCESS:
+        raise RuntimeError(f"TURN request 0x{method:03x} failed: 0x{message_type:04x}")
+    return dict(stun_server.iter_stun_attributes(data))
+
+
+def count_received(sock, duration, results):
+    """ Counts datagrams and bytes until duration seconds after the first one arrives """
+    sock.settimeout(1.0)
+    packets = total = 0
+    deadline = None
+    buffer = bytearray(65536)
+    while deadline is None or time.perf_counter() < deadline:
+        try:
+            nbytes = sock.recv_into(buffer)
+        except socket.timeout:
+            break
+        if deadline is None:
+            deadline = time.perf_counter() + duration
+        packets += 1
+        total += nbytes
+    results.put((packets, total))
+
+
+def blast(sock, address, message, duration):
+    sendto = sock.sendto
+    sent = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        for _ in range(64):
+            try:
+                sendto(message, address)
+                sent += 1
+            except BlockingIOError:
+                pass
+    return sent
+
+
+def measure(ctx, sender, receiver, destination, message, duration, header):
+    results = ctx.Queue()
+    counter = ctx.Process(target=count_received, args=(receiver, duration + 0.5, results))
+    counter.start()
+    time.sleep(0.2)
+    sent = blast(sender, destination, message, duration)
+    packets, total = results.get()
+    counter.join()
+    return sent, packets / duration, (total - packets * header) * 8 / duration / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=2.0, help="seconds of traffic per measurement")
+    parser.add_argument('--sizes', default="64,512,1200", help="comma separated payload sizes in bytes")
+    parser.add_argument('--direction', choices=['client', 'peer', 'both'], default='both')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('fork')
+    turn_socket = stun_server.create_udp_socket('127.0.0.1', 0)
+    server_address = turn_socket.getsockname()
+    server = ctx.Process(target=run_server, args=(turn_socket,), daemon=True)
+    server.start()
+
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(2.0)
+    peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    peer.bind(('127.0.0.1', 0))
+    for sock in (client, peer):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+
+    attributes = request(client, server_address, stun_server.TURN_ALLOCATE,
+                         [(stun_server.STUN_ATTR_REQUESTED_TRANSPORT, bytes([socket.IPPROTO_UDP, 0, 0, 0]))])
+    relay_address = stun_server.decode_xor_address(attributes[stun_server.STUN_ATTR_XOR_RELAYED_ADDRESS])
+    request(client, server_address, stun_server.TURN_CHANNEL_BIND, [
+        (stun_server.STUN_ATTR_CHANNEL_NUMBER, struct.pack('!HH', CHANNEL, 0)),
+        (stun_server.STUN_ATTR_XOR_PEER_ADDRESS, stun_server.encode_xor_address(peer.getsockname())),
+    ])
+    client.setblocking(False)
+    peer.setblocking(False)
+
+    print(f"{'direction':>16}{'payload':>9}{'sent/sec':>14}{'relayed/sec':>14}{'Mbit/s':>10}{'lost':>8}")
+    for size in (int(size) for size in args.sizes.split(',')):
+        payload = os.urandom(size)
+        runs = []
+        if args.direction in ('client', 'both'):
+            runs.append(('client -> peer', client, peer, server_address,
+                         stun_server.TURN_CHANNEL_DATA.pack(CHANNEL, size) + payload, 0))
+        if args.direction in ('peer', 'both'):
+            runs.append(('peer -> client', peer, client, relay_address, payload, 4))
+
+        for name, sender, receiver, destination, message, header in runs:
+            sent, pps, mbits = measure(ctx, sender, receiver, destination, message, args.duration, header)
+            lost = 1 - pps * args.duration / sent if sent else 0.0
+            print(f"{name:>16}{size:>9}{sent / args.duration:14,.0f}{pps:14,.0f}{mbits:10.1f}{max(lost, 0.0):8.1%}")
+
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
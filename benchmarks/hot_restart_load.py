@@ -0,0 +1,126 @@
+"""
+Hot restart under load: runs a server with --handoff-path, sends binding requests at a steady
+rate, starts a second server on the same handoff path mid-run (which takes the sockets over
+while the first one drains and exits) and reports how many requests were never answered.
+
+With --cold the first server is killed and the second one binds fresh sockets instead,
+for comparison.
+
+$ python3 benchmarks/hot_restart_load.py [--rate 5000] [--duration 4] [--engine fast] [--cold]
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stun_server.py')
+
+
+def start_server(port, engine, handoff_path):
+    command = [sys.executable, SERVER, '--host', '127.0.0.1', '--port', str(port), '--engine', engine]
+    if handoff_path:
+        command += ['--handoff-path', handoff_path]
+    log = tempfile.TemporaryFile('w+')  # not a pipe: the thread engine prints every request
+    return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT), log
+
+
+def wait_for_port(port, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("server did not start")
+
+
+def receive(sock, answered, stop):
+    sock.settimeout(0.2)
+    while not stop.is_set():
+        try:
+            data = sock.recv(2048)
+        except socket.timeout:
+            continue
+        if len(data) >= 20:
+            answered.add(int.from_bytes(data[8:20], 'big'))
+
+
+def send(sock, address, rate, duration):
+    """ Sends binding requests with sequential transaction IDs at rate per second, returns the count """
+    interval = 1 / rate
+    start = time.perf_counter()
+    sent = 0
+    while True:
+        now = time.perf_counter()
+        if now - start >= duration:
+            return sent
+        while sent < (now - start) * rate:
+            request = b"\x00\x01\x00\x00\x21\x12\xA4\x42" + sent.to_bytes(12, 'big')
+            try:
+                sock.sendto(request, address)
+            except ConnectionRefusedError:
+                pass  # ICMP port unreachable: nothing bound during a cold restart
+            sent += 1
+        time.sleep(interval / 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=34780)
+    parser.add_argument('--engine', default='fast', choices=['thread', 'fast', 'batch'])
+    parser.add_argument('--rate', type=float, default=5000, help="binding requests per second")
+    parser.add_argument('--duration', type=float, default=4.0, help="seconds of load; the restart happens halfway")
+    parser.add_argument('--cold', action='store_true', help="kill and start instead of handing the sockets over")
+    args = parser.parse_args()
+
+    handoff_path = None if args.cold else os.path.join(tempfile.mkdtemp(), 'stun_handoff.sock')
+    old, old_log = start_server(args.port, args.engine, handoff_path)
+    wait_for_port(args.port)
+
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    client.bind(('127.0.0.1', 0))
+    answered = set()
+    stop = threading.Event()
+    receiver = threading.Thread(target=receive, args=(client, answered, stop))
+    receiver.start()
+
+    result = {}
+    sender = threading.Thread(target=lambda: result.setdefault('sent', send(client, ('127.0.0.1', args.port), args.rate, args.duration)))
+    sender.start()
+    time.sleep(args.duration / 2)
+
+    restart_started = time.perf_counter()
+    if args.cold:
+        old.kill()
+        old.wait()
+    new, new_log = start_server(args.port, args.engine, handoff_path)
+    old_exit = old.wait(timeout=10)
+    restart_seconds = time.perf_counter() - restart_started
+
+    sender.join()
+    time.sleep(1.0)
+    stop.set()
+    receiver.join()
+    new.terminate()
+    new.wait()
+
+    sent = result['sent']
+    lost = sent - len(answered)
+    print(f"{'cold' if args.cold else 'hot'} restart ({args.engine}) at {args.rate:.0f} requests/sec:")
+    print(f"  sent {sent}, answered {len(answered)}, lost {lost} ({lost / sent:.3%})")
+    print(f"  old server exited with {old_exit} after {restart_seconds:.2f}s")
+    for name, log in (('old', old_log), ('new', new_log)):
+        log.seek(0)
+        lines = [line.strip() for line in log if line.strip() and 'Binding' not in line]
+        print(f"  {name} server: " + " | ".join(lines))
+
+
+if __name__ == '__main__':
+    main()
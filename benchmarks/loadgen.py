@@ -0,0 +1,200 @@
+"""
+STUN load generator: fires binding requests with random transaction IDs at a fixed rate from many
+local source ports, spread over several processes, and matches responses by transaction ID.
+Reports achieved responses/sec, loss and round-trip latency percentiles.
+
+Against a running server:
+$ python3 benchmarks/loadgen.py --target 127.0.0.1:3560 [--rate 20000] [--duration 5] [--processes 4] [--sockets 64]
+
+Comparing server variants: each engine is started locally in turn (extra server options after --server-args),
+loaded the same way, and the results are saved as JSON for tracking regressions:
+$ python3 benchmarks/loadgen.py --compare thread,asyncio,fast,batch [--json results.json] [--server-args --workers 2]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import stun_server  # noqa: E402
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stun_server.py')
+REQUEST_HEADER = b"\x00\x01\x00\x00\x21\x12\xA4\x42"
+
+
+def generate(target, rate, duration, sockets, grace, seed, results):
+    """
+    One load generating process: sends rate requests/sec round-robin over `sockets` source ports
+    for duration seconds, then waits up to grace seconds for late responses.
+    """
+    rng = random.Random(seed)
+    socks = []
+    poller = select.poll()
+    for _ in range(sockets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.bind(('0.0.0.0', 0))
+        sock.setblocking(False)
+        poller.register(sock, select.POLLIN)
+        socks.append(sock)
+    by_fd = {sock.fileno(): sock for sock in socks}
+
+    histogram = stun_server.LatencyHistogram()
+    pending = {}
+    sent = received = unmatched = send_errors = 0
+    start = time.perf_counter()
+    end = start + duration
+
+    while True:
+        now = time.perf_counter()
+        if now < end:
+            due = int((now - start) * rate)
+            while sent < due:
+                transaction_id = rng.getrandbits(96).to_bytes(12, 'big')
+                try:
+                    socks[sent % sockets].sendto(REQUEST_HEADER + transaction_id, target)
+                    pending[transaction_id] = time.perf_counter_ns()
+                except OSError:
+                    send_errors += 1
+                sent += 1
+        elif not pending or now >= end + grace:
+            break
+
+        for fd, _ in poller.poll(1):
+            sock = by_fd[fd]
+            while True:
+                try:
+                    data = sock.recv(2048)
+                except (BlockingIOError, ConnectionRefusedError):
+                    break
+                sent_ns = pending.pop(data[8:20], None)
+                if sent_ns is None:
+                    unmatched += 1
+                    continue
+                received += 1
+                histogram.record(time.perf_counter_ns() - sent_ns)
+
+    results.put({
+        "sent": sent,
+        "received": received,
+        "unmatched": unmatched,
+        "send_errors": send_errors,
+        "counts": histogram.counts,
+        "max": histogram.max,
+    })
+
+
+def run_load(target, rate, duration, processes, sockets, grace=1.0):
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    workers = [
+        ctx.Process(target=generate, args=(target, rate / processes, duration, sockets, grace, index, results))
+        for index in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    parts = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    histogram = stun_server.LatencyHistogram()
+    for part in parts:
+        other = stun_server.LatencyHistogram()
+        other.counts, other.max, other.total = part["counts"], part["max"], sum(part["counts"])
+        histogram.merge(other)
+
+    sent = sum(part["sent"] for part in parts)
+    received = sum(part["received"] for part in parts)
+    return {
+        "target_rate": rate,
+        "duration": duration,
+        "sent": sent,
+        "received": received,
+        "unmatched": sum(part["unmatched"] for part in parts),
+        "send_errors": sum(part["send_errors"] for part in parts),
+        "achieved_pps": received / duration,
+        "loss": 1 - received / sent if sent else 0.0,
+        "latency": histogram.summary(),
+    }
+
+
+def start_server(port, engine, server_args):
+    command = [sys.executable, SERVER, '--host', '127.0.0.1', '--port', str(port), '--engine', engine] + server_args
+    log = tempfile.TemporaryFile('w+')  # not a pipe: the thread engine prints every request
+    server = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.05)
+    server.kill()
+    log.seek(0)
+    raise RuntimeError(f"{engine} server did not start: {log.read()}")
+
+
+def report(name, result):
+    latency = result["latency"]
+    print(f"{name:>10}: {result['achieved_pps']:10,.0f} responses/sec of {result['target_rate']:,.0f}"
+          f"  loss {result['loss']:7.3%}"
+          f"  p50 {latency['p50_us']:8.1f}us  p99 {latency['p99_us']:8.1f}us  p999 {latency['p999_us']:8.1f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', default='127.0.0.1:3560', help="host:port of the server under load")
+    parser.add_argument('--rate', type=float, default=20000, help="binding requests per second (all processes)")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds of load")
+    parser.add_argument('--processes', type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)))
+    parser.add_argument('--sockets', type=int, default=64, help="source ports per process")
+    parser.add_argument('--compare', default=None, help="comma separated engines to start locally and compare")
+    parser.add_argument('--port', type=int, default=34790, help="port of the locally started servers (--compare)")
+    parser.add_argument('--json', default=None, help="write the results to this file")
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[],
+                        help="extra stun_server.py options for --compare (must come last)")
+    args = parser.parse_args()
+
+    results = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "settings": {"rate": args.rate, "duration": args.duration, "processes": args.processes,
+                     "sockets": args.sockets, "server_args": args.server_args},
+        "runs": {},
+    }
+
+    if args.compare:
+        for engine in args.compare.split(','):
+            server = start_server(args.port, engine, args.server_args)
+            try:
+                results["runs"][engine] = run_load(('127.0.0.1', args.port), args.rate, args.duration, args.processes, args.sockets)
+            finally:
+                server.terminate()
+                server.wait()
+            report(engine, results["runs"][engine])
+    else:
+        host, port = args.target.rsplit(':', 1)
+        results["runs"][args.target] = run_load((host, int(port)), args.rate, args.duration, args.processes, args.sockets)
+        report(args.target, results["runs"][args.target])
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
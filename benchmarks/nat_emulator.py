@@ -0,0 +1,168 @@
+"""
+In-process NAT emulation on localhost for hole punching benchmarks. Every host keeps its real UDP
+socket (its private address); each NAT owns public sockets on 127.0.0.1 that stand in for its public
+address. A datagram a host sends to another NAT's public address is taken as leaving through the
+sender's NAT mapping: the receiving NAT checks its filtering rule and delivers it to its host from
+the sender's public address, after one-way delay (plus jitter) and with probability 1 - loss.
+
+Filtering (RFC 4787): "none" (endpoint-independent), "address" and "port" (address- and
+port-dependent: only remote addresses the host has sent to get in). On localhost every address is
+127.0.0.1, so "address" lets everything in once the host has sent anywhere.
+
+Mapping: "independent" (one public address for every destination) or "symmetric" (a new public
+port per destination, allocated sequentially --delta apart; with noise, other hosts behind the NAT
+take that many extra ports per allocation on average). Servers such as STUN servers are added as
+public hosts, reachable at a public address without a NAT in front of them.
+"""
+
+import asyncio
+import socket
+
+
+class PublicSocket:
+    """ One public address of a NAT, and the remote addresses sent to through it """
+    def __init__(self, network, nat, port=0):
+        self.network = network
+        self.nat = nat
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind(('127.0.0.1', port))
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.permissions = set()
+        network.loop.add_reader(self.sock.fileno(), self.on_readable)
+
+    def allows(self, remote):
+        if self.nat.filtering == 'none':
+            return True
+        if self.nat.filtering == 'address':
+            return any(ip == remote[0] for ip, _ in self.permissions)
+        return remote in self.permissions
+
+    def on_readable(self):
+        while True:
+            try:
+                data, source = self.sock.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # ICMP error of an earlier datagram
+            self.network.forward(data, source, self)
+
+    def close(self):
+        self.network.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+class Nat:
+    """ A NAT in front of one host """
+    def __init__(self, network, filtering, mapping='independent', delta=1, noise=0.0):
+        if filtering not in ('none', 'address', 'port'):
+            raise ValueError(f"unknown filtering {filtering!r}")
+        if mapping not in ('independent', 'symmetric'):
+            raise ValueError(f"unknown mapping {mapping!r}")
+        self.network = network
+        self.filtering = filtering
+        self.mapping = mapping
+        self.delta = delta
+        self.noise = noise
+        self.host = None  # private (ip, port) of the host behind it
+        self.public = PublicSocket(network, self)
+        self.sockets = [self.public]
+        self.mappings = {}  # remote public address -> PublicSocket (symmetric)
+        self.next_port = self.public.address[1]
+
+    @property
+    def address(self):
+        """ The first public address of the host (what a STUN server would report) """
+        return self.public.address
+
+    def mapping_for(self, remote):
+        """ The public socket the host's datagrams to remote leave from """
+        if self.mapping == 'independent':
+            return self.public
+        public = self.mappings.get(remote)
+        if public is None:
+            public = self.allocate() if self.mappings else self.public
+            self.mappings[remote] = public
+        return public
+
+    def allocate(self):
+        """ The next public port, skipping those other hosts take and those in use """
+        if self.noise and self.network.rng is not None:
+            while self.network.rng.random() < self.noise / (1 + self.noise):
+                self.next_port += self.delta  # taken by another host
+        for _ in range(100):
+            self.next_port += self.delta
+            if not 1024 <= self.next_port < 65536:
+                break
+            try:
+                public = PublicSocket(self.network, self, self.next_port)
+            except OSError:
+                continue  # in use on this machine: a real NAT would skip it too
+            self.sockets.append(public)
+            return public
+        raise RuntimeError("no free public port")
+
+    def close(self):
+        for public in self.sockets:
+            public.close()
+
+
+class NatNetwork:
+    """
+        network = NatNetwork(loss=0.05, delay=0.03)
+        nat_a = network.add_nat('port'); nat_a.host = client_a.transport.get_extra_info('sockname')
+        # client_a punches to nat_b.address, client_b to nat_a.address
+    """
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, rng=None):
+        self.loop = asyncio.get_running_loop()
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.rng = rng
+        self.nats = []
+        self.forwarded = 0
+        self.filtered = 0
+        self.lost = 0
+
+    def add_nat(self, filtering='port', mapping='independent', delta=1, noise=0.0):
+        nat = Nat(self, filtering, mapping, delta, noise)
+        self.nats.append(nat)
+        return nat
+
+    def add_public_host(self, host):
+        """ Public address (ip, port) through which hosts behind NATs reach host, e.g. a STUN server """
+        nat = self.add_nat('none')
+        nat.host = host
+        return nat.address
+
+    def forward(self, data, source, public):
+        """ data arrived at public (a NAT's public address) from source (a private host) """
+        sender = next((nat for nat in self.nats if nat.host == source), None)
+        if sender is None or sender is public.nat:
+            return
+        mapping = sender.mapping_for(public.address)
+        mapping.permissions.add(public.address)
+        if not public.allows(mapping.address):
+            self.filtered += 1
+            return
+        if self.rng is not None and self.rng.random() < self.loss:
+            self.lost += 1
+            return
+        self.forwarded += 1
+        delay = self.delay + (self.rng.random() * self.jitter if self.rng is not None else 0)
+        self.loop.call_later(delay, self.deliver, mapping, data, public.nat.host)
+
+    def deliver(self, mapping, data, host):
+        try:
+            mapping.sock.sendto(data, host)
+        except OSError:
+            pass  # closed
+
+    def close(self):
+        for nat in self.nats:
+            nat.close()
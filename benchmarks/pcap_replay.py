@@ -0,0 +1,469 @@
+"""
+Replays the STUN traffic of a packet capture (pcap or pcapng, read in pure Python) against a server,
+at the captured timing or sped up, and checks every answer: responses are matched to requests by
+transaction ID and source port, and the XOR-MAPPED-ADDRESS of success responses must be the replaying
+socket's address. Reports per kind of captured datagram (valid binding requests, other STUN messages,
+malformed datagrams) how many got success / error (by ERROR-CODE) / no responses, and round-trip latency
+percentiles.
+
+Captured datagrams sent to the server port (--capture-port, by default the port most binding requests
+go to) are replayed, malformed ones included, each captured source from one of --sockets local ports.
+Ethernet (with VLAN tags), Linux cooked (SLL, SLL2), loopback and raw IP captures over IPv4/IPv6 are read.
+
+Against a running server, at the captured timing (--speed 10: ten times faster, 0: as fast as possible):
+$ python3 benchmarks/pcap_replay.py capture.pcap --target 127.0.0.1:3560 [--speed 1]
+
+Against each engine started locally in turn, saving the results; --baseline compares the answers with a
+saved run and exits with status 1 if they differ (parser regressions on real, malformed traffic; replay at a
+speed the server keeps up with, or losses show up as differences):
+$ python3 benchmarks/pcap_replay.py capture.pcap --compare thread,fast,batch [--json results.json] [--baseline old.json]
+
+Without a production capture, a synthetic one (keepalives, retransmissions, attributes, garbage) can be written:
+$ python3 benchmarks/pcap_replay.py --synthesize sample.pcap [--count 20000]
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import stun_server  # noqa: E402
+from loadgen import start_server  # noqa: E402
+
+# pcap magic number -> (byte order, timestamp fraction unit)
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ('<', 1e-6),
+    b"\xa1\xb2\xc3\xd4": ('>', 1e-6),
+    b"\x4d\x3c\xb2\xa1": ('<', 1e-9),
+    b"\xa1\xb2\x3c\x4d": ('>', 1e-9),
+}
+PCAPNG_SECTION_HEADER = b"\x0a\x0d\x0d\x0a"
+PCAPNG_INTERFACE_DESCRIPTION = 1
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (101, 228, 229)  # raw IP, IPv4, IPv6
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8)
+
+KINDS = ('binding', 'other_stun', 'malformed')
+
+
+def read_pcap(f, magic):
+    order, unit = PCAP_MAGIC[magic]
+    header = f.read(20)
+    if len(header) < 20:
+        raise ValueError("truncated pcap header")
+    link_type = struct.unpack(order + 'HHiIII', header)[5] & 0xFFFF
+    record = struct.Struct(order + 'IIII')
+    while True:
+        head = f.read(16)
+        if len(head) < 16:
+            return
+        seconds, fraction, captured, _ = record.unpack(head)
+        frame = f.read(captured)
+        if len(frame) < captured:
+            return  # capture cut short while writing
+        yield seconds + fraction * unit, link_type, frame
+
+
+def read_pcapng(f):
+    order = '<'
+    interfaces = []
+    head = PCAPNG_SECTION_HEADER + f.read(4)
+    while len(head) == 8:
+        if head[:4] == PCAPNG_SECTION_HEADER:  # same bytes in either byte order; the section says which follows
+            byte_order = f.read(4)
+            order = '<' if byte_order == b"\x4d\x3c\x2b\x1a" else '>'
+            total_length, = struct.unpack(order + 'I', head[4:])
+            f.read(total_length - 12)
+            interfaces = []
+        else:
+            kind, total_length = struct.unpack(order + 'II', head)
+            body = f.read(total_length - 8)
+            if len(body) < total_length - 8:
+                return
+            if kind == PCAPNG_INTERFACE_DESCRIPTION:
+                link_type, = struct.unpack_from(order + 'H', body, 0)
+                interfaces.append((link_type, interface_resolution(body[8:-4], order)))
+            elif kind == PCAPNG_ENHANCED_PACKET:
+                interface, high, low, captured, _ = struct.unpack_from(order + 'IIIII', body, 0)
+                link_type, unit = interfaces[interface]
+                yield ((high << 32) | low) * unit, link_type, body[20:20 + captured]
+            elif kind == PCAPNG_SIMPLE_PACKET and interfaces:
+                yield 0.0, interfaces[0][0], body[4:-4]
+        head = f.read(8)
+
+
+def interface_resolution(options, order):
+    """ Timestamp unit of a pcapng interface from its if_tsresol option (default microseconds) """
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack_from(order + 'HH', options, offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            resolution = options[offset + 4]
+            return 2.0 ** -(resolution & 0x7F) if resolution & 0x80 else 10.0 ** -resolution
+        offset += 4 + length + (-length & 3)
+    return 1e-6
+
+
+def read_capture(path):
+    """ Yields (timestamp in seconds, link type, frame) from a pcap or pcapng file """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+        if magic in PCAP_MAGIC:
+            yield from read_pcap(f, magic)
+        elif magic == PCAPNG_SECTION_HEADER:
+            yield from read_pcapng(f)
+        else:
+            raise ValueError(f"{path} is not a pcap or pcapng file")
+
+
+def ip_offset(link_type, frame):
+    """ Offset of the IP header in a frame of link_type, or None if it does not carry IP """
+    if link_type == LINKTYPE_ETHERNET:
+        offset, ethertype = 14, int.from_bytes(frame[12:14], 'big')
+        while ethertype in ETHERTYPE_VLAN:
+            ethertype = int.from_bytes(frame[offset + 2:offset + 4], 'big')
+            offset += 4
+        return offset if ethertype in (ETHERTYPE_IPV4, ETHERTYPE_IPV6) else None
+    if link_type in LINKTYPE_RAW:
+        return 0
+    if link_type == LINKTYPE_NULL:
+        return 4
+    if link_type == LINKTYPE_LINUX_SLL:
+        return 16 if int.from_bytes(frame[14:16], 'big') in (ETHERTYPE_IPV4, ETHERTYPE_IPV6) else None
+    if link_type == LINKTYPE_LINUX_SLL2:
+        return 20 if int.from_bytes(frame[0:2], 'big') in (ETHERTYPE_IPV4, ETHERTYPE_IPV6) else None
+    return None
+
+
+def udp_datagrams(path):
+    """ Yields (timestamp, (source ip, port), (destination ip, port), payload) of the UDP datagrams of a capture """
+    for timestamp, link_type, frame in read_capture(path):
+        offset = ip_offset(link_type, frame)
+        if offset is None or len(frame) < offset + 20:
+            continue
+        version = frame[offset] >> 4
+        if version == 4:
+            if frame[offset + 9] != socket.IPPROTO_UDP or int.from_bytes(frame[offset + 6:offset + 8], 'big') & 0x3FFF:
+                continue  # not UDP, or a fragment
+            source = socket.inet_ntop(socket.AF_INET, frame[offset + 12:offset + 16])
+            destination = socket.inet_ntop(socket.AF_INET, frame[offset + 16:offset + 20])
+            udp = offset + (frame[offset] & 0x0F) * 4
+        elif version == 6 and len(frame) >= offset + 40:
+            if frame[offset + 6] != socket.IPPROTO_UDP:
+                continue  # not UDP (extension headers are not followed)
+            source = socket.inet_ntop(socket.AF_INET6, frame[offset + 8:offset + 24])
+            destination = socket.inet_ntop(socket.AF_INET6, frame[offset + 24:offset + 40])
+            udp = offset + 40
+        else:
+            continue
+        if len(frame) < udp + 8:
+            continue
+        source_port, destination_port, length = struct.unpack_from('!HHH', frame, udp)
+        yield timestamp, (source, source_port), (destination, destination_port), bytes(frame[udp + 8:udp + max(length, 8)])
+
+
+def classify(payload):
+    if not stun_server.is_stun_message(payload, len(payload)):
+        return 'malformed'
+    if int.from_bytes(payload[:2], 'big') == stun_server.STUN_BINDING_REQUEST:
+        return 'binding'
+    return 'other_stun'
+
+
+def load_requests(path, capture_port=None):
+    """
+    Returns the server port and [(timestamp, source, payload, kind)] of the datagrams sent to it,
+    the port being the one most binding requests go to unless capture_port is given.
+    """
+    datagrams = list(udp_datagrams(path))
+    if capture_port is None:
+        ports = collections.Counter(destination[1] for _, _, destination, payload in datagrams if classify(payload) == 'binding')
+        if not ports:
+            raise ValueError(f"no STUN binding requests in {path}")
+        capture_port = ports.most_common(1)[0][0]
+    requests = [(timestamp, source, payload, classify(payload))
+                for timestamp, source, destination, payload in datagrams if destination[1] == capture_port]
+    requests.sort(key=lambda request: request[0])
+    return capture_port, requests
+
+
+def replay(requests, target, speed=1.0, sockets=256, grace=1.0):
+    """
+    Sends the captured requests to target (captured inter-arrival times divided by speed, 0: no pacing),
+    every captured source from one of `sockets` local ports, and collects and checks the answers.
+    """
+    family = socket.AF_INET6 if ':' in target[0] else socket.AF_INET
+    socks = []
+    poller = select.poll()
+    for _ in range(sockets):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.connect(target)  # only the server's answers are received
+        sock.setblocking(False)
+        poller.register(sock, select.POLLIN)
+        socks.append(sock)
+    by_fd = {sock.fileno(): index for index, sock in enumerate(socks)}
+    # the address the server should see: the socket's own on loopback, otherwise the first one it reports
+    loopback = target[0] in ('127.0.0.1', '::1', 'localhost')
+    expected_mapped = [sock.getsockname()[:2] if loopback else None for sock in socks]
+
+    source_index = {}
+    kinds = {kind: {"sent": 0, "success": 0, "error": 0, "other": 0, "error_codes": {}} for kind in KINDS}
+    software = set()
+    pending = collections.defaultdict(collections.deque)
+    histogram = stun_server.LatencyHistogram()
+    unmatched = mapped_mismatches = send_errors = 0
+
+    def receive(index):
+        nonlocal unmatched, mapped_mismatches
+        sock = socks[index]
+        while True:
+            try:
+                data = sock.recv(2048)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            if len(data) < 20:
+                unmatched += 1
+                continue
+            transaction_id = data[8:20]
+            waiting = pending.get((index, transaction_id))
+            if not waiting:
+                unmatched += 1
+                continue
+            sent_ns, kind = waiting.popleft()
+            histogram.record(time.perf_counter_ns() - sent_ns)
+            message_type = int.from_bytes(data[:2], 'big')
+            if message_type == stun_server.STUN_BINDING_RESPONSE:
+                kinds[kind]["success"] += 1
+                try:
+                    attributes = dict(stun_server.iter_stun_attributes(data))
+                except ValueError:
+                    attributes = {}
+                mapped = stun_server.decode_xor_address(attributes.get(stun_server.STUN_ATTR_XOR_MAPPED_ADDRESS, b""), transaction_id)
+                if mapped is not None and expected_mapped[index] is None:
+                    expected_mapped[index] = mapped
+                if mapped is None or mapped != (stun_server.unmap_ipv4(expected_mapped[index][0]), expected_mapped[index][1]):
+                    mapped_mismatches += 1
+            elif message_type == stun_server.STUN_BINDING_ERROR_RESPONSE:
+                kinds[kind]["error"] += 1
+                try:
+                    attributes = dict(stun_server.iter_stun_attributes(data))
+                except ValueError:
+                    attributes = {}
+                try:
+                    code, _ = stun_server.decode_error_code(attributes[stun_server.STUN_ATTR_ERROR_CODE])
+                except (KeyError, struct.error):
+                    code = None
+                error_codes = kinds[kind]["error_codes"]
+                error_codes[str(code)] = error_codes.get(str(code), 0) + 1
+                if stun_server.STUN_ATTR_SOFTWARE in attributes:
+                    software.add(stun_server.decode_software(attributes[stun_server.STUN_ATTR_SOFTWARE]))
+            else:
+                kinds[kind]["other"] += 1
+
+    first = requests[0][0] if requests else 0.0
+    start = time.perf_counter()
+    position = 0
+    while position < len(requests):
+        elapsed = time.perf_counter() - start
+        burst_end = position + 64  # answers are read between bursts, so they do not pile up in the socket buffers
+        while position < burst_end and position < len(requests) and (not speed or (requests[position][0] - first) / speed <= elapsed):
+            timestamp, source, payload, kind = requests[position]
+            index = source_index.setdefault(source, len(source_index) % sockets)
+            pending[(index, payload[8:20])].append((time.perf_counter_ns(), kind))
+            kinds[kind]["sent"] += 1
+            try:
+                socks[index].send(payload)
+            except OSError:
+                send_errors += 1
+            position += 1
+        timeout = 0
+        if speed and position < len(requests):
+            timeout = max(0, min(10, int(((requests[position][0] - first) / speed - (time.perf_counter() - start)) * 1000)))
+        for fd, _ in poller.poll(timeout):
+            receive(by_fd[fd])
+
+    duration = time.perf_counter() - start
+    deadline = time.perf_counter() + grace
+    while time.perf_counter() < deadline and any(pending.values()):
+        for fd, _ in poller.poll(10):
+            receive(by_fd[fd])
+    for sock in socks:
+        sock.close()
+
+    for counts in kinds.values():
+        counts["no_response"] = counts["sent"] - counts["success"] - counts["error"] - counts["other"]
+    return {
+        "requests": len(requests),
+        "sources": len(source_index),
+        "duration": duration,
+        "sent_pps": len(requests) / duration if duration else 0.0,
+        "kinds": kinds,
+        "unmatched_responses": unmatched,
+        "mapped_mismatches": mapped_mismatches,
+        "send_errors": send_errors,
+        "software": sorted(software),
+        "latency": histogram.summary(),
+    }
+
+
+def report(name, result):
+    latency = result["latency"]
+    print(f"{name}: {result['requests']:,} datagrams from {result['sources']:,} sources in {result['duration']:.2f}s"
+          f" ({result['sent_pps']:,.0f}/sec)  p50 {latency['p50_us']:.1f}us  p99 {latency['p99_us']:.1f}us  p999 {latency['p999_us']:.1f}us")
+    for kind, counts in result["kinds"].items():
+        print(f"{kind:>14}: sent {counts['sent']:8,}  success {counts['success']:8,}  error {counts['error']:7,}"
+              f"  other {counts['other']:5,}  no response {counts['no_response']:8,}")
+        if counts["error_codes"]:
+            print(f"{'':>14}  error codes " + ", ".join(f"{code}: {n:,}" for code, n in sorted(counts["error_codes"].items())))
+    print(f"{'':>14}  unmatched responses {result['unmatched_responses']}, wrong mapped addresses {result['mapped_mismatches']},"
+          f" send errors {result['send_errors']}" + (f", server SOFTWARE {result['software']}" if result["software"] else ""))
+
+
+def compare(name, result, baseline):
+    """ Prints how the answers of result differ from the baseline run; returns True if they match """
+    same = True
+    for kind, counts in result["kinds"].items():
+        old = baseline["kinds"].get(kind, {})
+        for outcome in ("success", "error", "other", "no_response"):
+            if counts[outcome] != old.get(outcome):
+                print(f"{name}: {kind} {outcome} {old.get(outcome)} -> {counts[outcome]}")
+                same = False
+    return same
+
+
+def synthesize(path, count, clients=500, seed=1):
+    """
+    Writes an Ethernet pcap of count client datagrams to 10.0.0.1:3478 with the server's answers:
+    binding keepalives (some retransmitted), requests with attributes (SOFTWARE + FINGERPRINT, an
+    unknown comprehension-required attribute), binding indications and garbage.
+    """
+    rng = random.Random(seed)
+    server = ('10.0.0.1', 3478)
+    sources = [(f"192.168.{i >> 8 & 255}.{i & 255}", rng.randrange(1024, 65536)) for i in range(clients)]
+    packets = []
+    now = 1700000000.0
+    for _ in range(count):
+        now += rng.expovariate(2000.0)
+        source = rng.choice(sources)
+        transaction_id = os.urandom(12)
+        roll = rng.random()
+        if roll < 0.80:
+            payload = stun_server.create_stun_message(stun_server.STUN_BINDING_REQUEST, transaction_id)
+            if rng.random() < 0.02:
+                packets.append((now + 0.5, source, server, payload))  # retransmission
+        elif roll < 0.88:
+            payload = stun_server.create_stun_message(stun_server.STUN_BINDING_REQUEST, transaction_id,
+                                                      [(stun_server.STUN_ATTR_SOFTWARE, b"libjuice")], fingerprint=True)
+        elif roll < 0.90:
+            payload = stun_server.create_stun_message(stun_server.STUN_BINDING_REQUEST, transaction_id, [(0x0024, b"\x6e\x7f\x1e\xff")])
+        elif roll < 0.94:
+            payload = stun_server.create_stun_message(0x0011, transaction_id)  # binding indication (keepalive)
+        else:
+            payload = rng.choice([
+                os.urandom(rng.randrange(1, 200)),
+                b"GET / HTTP/1.1\r\nHost: stun\r\n\r\n",
+                stun_server.create_stun_message(stun_server.STUN_BINDING_REQUEST, transaction_id)[:rng.randrange(1, 20)],
+                b"\x00\x01\x00\x00\xde\xad\xbe\xef" + transaction_id,
+            ])
+        packets.append((now, source, server, payload))
+        if classify(payload) == 'binding':
+            packets.append((now + 0.02, server, source,
+                            stun_server.create_stun_binding_response(transaction_id, source[0], source[1])))
+    packets.sort(key=lambda packet: packet[0])
+    write_pcap(path, packets)
+    return len(packets)
+
+
+def write_pcap(path, packets):
+    """ Writes (timestamp, source, destination, payload) UDP/IPv4 datagrams as an Ethernet pcap """
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+        for timestamp, (source, source_port), (destination, destination_port), payload in packets:
+            udp = struct.pack('!HHHH', source_port, destination_port, 8 + len(payload), 0) + payload
+            ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 0, 0x4000, 64, socket.IPPROTO_UDP, 0,
+                             socket.inet_aton(source), socket.inet_aton(destination))
+            frame = b"\x02\x00\x00\x00\x00\x02\x02\x00\x00\x00\x00\x01" + struct.pack('!H', ETHERTYPE_IPV4) + ip + udp
+            microseconds = round(timestamp * 1e6)
+            f.write(struct.pack('<IIII', microseconds // 1000000, microseconds % 1000000, len(frame), len(frame)) + frame)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', nargs='?', help="pcap or pcapng file to replay")
+    parser.add_argument('--target', default='127.0.0.1:3560', help="host:port of the server to replay against")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed-up over the captured timing (0: as fast as possible)")
+    parser.add_argument('--sockets', type=int, default=256, help="local ports the captured sources are spread over")
+    parser.add_argument('--capture-port', type=int, default=None, help="server port in the capture (default: detected)")
+    parser.add_argument('--compare', default=None, help="comma separated engines to start locally and replay against")
+    parser.add_argument('--port', type=int, default=34830, help="port of the locally started servers (--compare)")
+    parser.add_argument('--json', default=None, help="write the results to this file")
+    parser.add_argument('--baseline', default=None, help="results file of an earlier run to compare the answers with")
+    parser.add_argument('--synthesize', default=None, metavar='PATH', help="write a synthetic capture to PATH and exit")
+    parser.add_argument('--count', type=int, default=20000, help="client datagrams of the synthetic capture")
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[],
+                        help="extra stun_server.py options for --compare (must come last)")
+    args = parser.parse_args()
+
+    if args.synthesize:
+        print(f"wrote {synthesize(args.synthesize, args.count)} packets to {args.synthesize}")
+        return
+    if not args.capture:
+        parser.error("a capture file is needed (or --synthesize)")
+
+    capture_port, requests = load_requests(args.capture, args.capture_port)
+    print(f"{len(requests):,} datagrams to port {capture_port} in {args.capture}: "
+          + ", ".join(f"{kind} {sum(1 for request in requests if request[3] == kind):,}" for kind in KINDS))
+
+    results = {"capture": args.capture, "capture_port": capture_port, "speed": args.speed, "runs": {}}
+    if args.compare:
+        for engine in args.compare.split(','):
+            server = start_server(args.port, engine, args.server_args)
+            try:
+                results["runs"][engine] = replay(requests, ('127.0.0.1', args.port), args.speed, args.sockets)
+            finally:
+                server.terminate()
+                server.wait()
+            report(engine, results["runs"][engine])
+    else:
+        host, port = args.target.rsplit(':', 1)
+        results["runs"][args.target] = replay(requests, (host.strip('[]'), int(port)), args.speed, args.sockets)
+        report(args.target, results["runs"][args.target])
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.json}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline_runs = json.load(f)["runs"]
+        same = True
+        for name, result in results["runs"].items():
+            baseline = baseline_runs.get(name) or next(iter(baseline_runs.values()))
+            same = compare(name, result, baseline) and same
+        print("answers match the baseline" if same else "answers differ from the baseline")
+        sys.exit(0 if same else 1)
+
+
+if __name__ == '__main__':
+    main()
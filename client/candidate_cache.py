@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+import socket
+import time
+
+from stun_client import BindingResult, StunClient
+from stun_servers import StunServerSelector
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "broadwayinc", "candidates.json"
+)
+
+
+def format_address(address: tuple) -> str:
+    ip, port = address
+    return f"[{ip}]:{port}" if ":" in ip else f"{ip}:{port}"
+
+
+def parse_address(address: str) -> tuple:
+    ip, port = address.rsplit(":", 1)
+    return ip.strip("[]"), int(port)
+
+
+def local_interface(server: tuple) -> str:
+    """IP of the local interface that routes to server (no packet is sent)"""
+    family = socket.AF_INET6 if ":" in server[0] else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.connect(server)
+        except OSError:
+            return ""  # no route: matches no cached entry of a routable network
+        return sock.getsockname()[0]
+
+
+class CandidateCache:
+    """
+    Mapped addresses of local ports, keyed by (local port, STUN server, local
+    interface address) so a new network (other interface address) is a miss.
+    Entries persist in a small JSON file at cache_path.
+
+    mapped_address() returns a candidate validated within ttl seconds right away
+    (a BindingResult with transmissions == 0) and revalidates it in the background
+    with a single binding request: an unchanged answer renews the entry, a changed
+    one replaces it (and calls on_change(old, new)), no answer drops it. Otherwise
+    it asks the selector's servers and caches the answer. Revalidation briefly binds
+    the local port, so await drain() before binding it yourself, or pass the
+    client already open on the port to mapped_address().
+
+        candidates = CandidateCache(StunServerSelector(["stun.example:3478"]))
+        result = await candidates.mapped_address(local_port=12345)
+        # or, keeping the port open
+        client, result = await open_stun_client(
+            servers, 12345, first=functools.partial(candidates.mapped_address, 12345)
+        )
+    """
+
+    def __init__(
+        self,
+        selector: StunServerSelector,
+        cache_path: str = DEFAULT_CACHE_PATH,
+        ttl: float = 60.0,
+        revalidate_timeout: float = 2.0,
+        on_change=None,
+    ):
+        self.selector = selector
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.revalidate_timeout = revalidate_timeout
+        self.on_change = on_change
+        self.entries = {}  # (local port, "ip:port", interface) -> (mapped, validated)
+        self.revalidations = set()
+        self.load()
+
+    def load(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+            for local_port, server, interface, ip, port, validated in cached:
+                key = (local_port, server, interface)
+                self.entries[key] = ((ip, port), validated)
+        except (OSError, ValueError, TypeError):
+            pass
+
+    def save(self):
+        if not self.cache_path:
+            return
+        now = time.time()
+        data = [
+            [*key, *mapped, validated]
+            for key, (mapped, validated) in self.entries.items()
+            if now - validated < self.ttl
+        ]
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            temporary = f"{self.cache_path}.{os.getpid()}.tmp"
+            with open(temporary, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(temporary, self.cache_path)
+        except OSError:
+            pass
+
+    def lookup(self, local_port: int):
+        """(key, mapped address) of the freshest valid entry for local_port, or None"""
+        now = time.time()
+        best = None
+        for key, (mapped, validated) in self.entries.items():
+            if key[0] != local_port or now - validated >= self.ttl:
+                continue
+            if best is None or validated > best[2]:
+                best = key, mapped, validated
+        if best is None:
+            return None
+        key, mapped, _ = best
+        if local_interface(parse_address(key[1])) != key[2]:
+            return None  # the route to the server changed: another network
+        return key, mapped
+
+    def store(self, local_port: int, result: BindingResult):
+        server = format_address(result.server)
+        key = (local_port, server, local_interface(result.server))
+        self.entries[key] = (result.mapped_address, time.time())
+        self.save()
+
+    def drop(self, local_port: int):
+        """Forgets the mapped addresses of local_port (e.g. its mapping was lost)"""
+        for key in [key for key in self.entries if key[0] == local_port]:
+            del self.entries[key]
+        self.save()
+
+    async def mapped_address(
+        self, local_port: int, client: StunClient = None
+    ) -> BindingResult:
+        """
+        Cached or fresh mapped address of local_port. Raises StunError if there is no
+        valid cached one and no server answers. With client, a StunClient open on
+        local_port, servers are asked from it and a hit is not revalidated here:
+        revalidate it on the client once it is in use (e.g. with the first keepalive),
+        store() the answer and drop() the port if there is none.
+        """
+        hit = self.lookup(local_port)
+        if hit is not None:
+            key, mapped = hit
+            if client is None:
+                task = asyncio.ensure_future(self.revalidate(key))
+                self.revalidations.add(task)
+                task.add_done_callback(self.revalidations.discard)
+            return BindingResult(parse_address(key[1]), mapped, answered=True)
+        result = await self.selector.mapped_address(local_port, client)
+        self.store(local_port, result)
+        return result
+
+    async def revalidate(self, key: tuple):
+        options = dict(
+            self.selector.client_options,
+            max_transmissions=1,
+            timeout=self.revalidate_timeout,
+        )
+        try:
+            async with StunClient(key[0], **options) as client:
+                result = await client.request(parse_address(key[1]))
+        except OSError:
+            return  # the application is using the port: keep the entry
+        old = self.entries.get(key, (None,))[0]
+        if not result.ok:
+            self.entries.pop(key, None)
+        elif result.mapped_address != old:
+            self.entries[key] = (result.mapped_address, time.time())
+            if self.on_change is not None:
+                self.on_change(old, result.mapped_address)
+        else:
+            self.entries[key] = (old, time.time())
+        self.save()
+
+    async def drain(self):
+        """Waits for background revalidations to finish"""
+        if self.revalidations:
+            await asyncio.wait(set(self.revalidations))
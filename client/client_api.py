@@ -1,24 +1,165 @@
 import asyncio
+import functools
 
-from stun_client import stun_client
+from candidate_cache import CandidateCache
+from hole_punch import HolePuncher, parse_notice, room_candidates
+from ice import IceAgent, candidates_message, gather_candidates, make_candidate
+from keepalive import KeepaliveScheduler
+from port_prediction import sample_mapping
+from stun_client import BindingResult, StunError, open_stun_client
+from stun_servers import StunServerSelector
 from get_users import get_users
-from websocket import websocket_handshake
+from websocket import send_message, websocket_handshake
 
-stun_server = "stun.broadwayinc.computer:3468"  # 'stun.server:port
+# 'stun.server:port' endpoints; measured RTTs are cached so the fastest is asked
+# first, and servers are re-probed in the background
+stun_servers = ["stun.broadwayinc.computer:3468"]
 client_port = 12345
 token = "user_id"
 roomId = "Id001"
+prediction_window = 16  # predicted ports offered when the NAT is symmetric
 
-ip = stun_client(stun_server, client_port)
-print("ip:", ip)  # ip:port
+selector = StunServerSelector(stun_servers)
+# the candidate of a recent run (or room rejoin) is reused and revalidated afterwards
+candidates = CandidateCache(selector)
 
-# make websocket connection, join room
-websocket = websocket_handshake(token, ip, roomId)
 
-# get users that is currently in the room
-users = get_users(roomId)  # [{'cnd': 'ip:port', 'uid': 'stunpunch#user_id'}, ...]
-print("- users in the room -")
-print(users)  # users in the room
+async def main():
+    # keep the server ranking fresh while we run
+    selector.start()
 
-# keep running websocket in parallel and get noted when users join/leave
-asyncio.run(websocket)
+    # one socket for the STUN request, keepalives and punching, so the NAT mapping
+    # is kept; a cached candidate skips the STUN round trip
+    client, candidate = await open_stun_client(
+        stun_servers,
+        client_port,
+        first=functools.partial(candidates.mapped_address, client_port),
+    )
+    ip = "{}:{}".format(*candidate.mapped_address)
+    print("ip:", ip)  # ip:port
+    joined_address = candidate.mapped_address  # the room lists us with it
+
+    puncher = HolePuncher(client, check_spacing=0.02, batch=8, uid=token)
+
+    # behind a symmetric NAT (a new port per destination) the candidate above is
+    # only good for the STUN server: also offer the ports the NAT allocates next
+    predicted = []
+    if len(stun_servers) > 1:
+        try:
+            behavior = await sample_mapping(client, stun_servers)
+        except StunError as e:
+            print("- no port prediction:", e)
+        else:
+            if behavior.symmetric:
+                predicted = behavior.predicted_candidates(prediction_window)
+
+    # exchange host/server-reflexive candidates with sendMessage and check them
+    # best first, so peers on the same LAN connect directly
+    outbox = []
+    websocket_writer = None
+
+    def send_candidates(uid, local_candidates):
+        message = candidates_message(token, uid, local_candidates)
+        if websocket_writer is None:
+            outbox.append(message)
+        else:
+            asyncio.ensure_future(send_message(websocket_writer, message))
+
+    def on_open(writer):
+        nonlocal websocket_writer
+        websocket_writer = writer
+        for message in outbox:
+            asyncio.ensure_future(send_message(writer, message))
+        outbox.clear()
+        # joined: keep the mapping open; the first keepalive revalidates a cached
+        # candidate
+        asyncio.ensure_future(
+            keepalives.add(
+                client,
+                candidate.server,
+                mapped_address=candidate.mapped_address,
+                delay=0 if candidate.transmissions == 0 else None,
+            )
+        )
+
+    def on_mapping_change(keepalive, old, new):
+        nonlocal candidate
+        print("- mapped address changed:", new)
+        candidate = BindingResult(keepalive.server, new, answered=True)
+        # the room still lists the old one: offer the new candidates to every peer
+        agent.set_candidates(gather_candidates(client, candidate, predicted=predicted))
+
+    def on_mapping_answered(keepalive):
+        # (re)validates the cached candidate for the next run
+        result = BindingResult(keepalive.server, keepalive.mapped_address)
+        candidates.store(client_port, result)
+
+    def on_mapping_lost(keepalive):
+        print("- no answer from the STUN server: mapped address unknown")
+        candidates.drop(client_port)
+
+    keepalives = KeepaliveScheduler(
+        on_change=on_mapping_change,
+        on_answered=on_mapping_answered,
+        on_lost=on_mapping_lost,
+    )
+
+    def on_connected(uid, transport, remote):
+        print(
+            f"- connected to {uid} via {remote.kind}:",
+            transport.get_extra_info("punch"),
+        )
+
+    def on_failed(uid, error):
+        print(f"- could not connect to {uid}: {error}")
+
+    agent = IceAgent(
+        puncher,
+        gather_candidates(client, candidate, predicted=predicted),
+        send_candidates,
+        on_connected=on_connected,
+        on_failed=on_failed,
+        uid=token,
+    )
+    print("candidates:", [c.to_sdp() for c in agent.candidates])
+
+    def is_self(uid, address):
+        return uid == token or address in (candidate.mapped_address, joined_address)
+
+    def on_message(text):
+        if agent.on_message(text):
+            return
+        # '#notice': 'User "uid" has joined the message group;ip:port', ours included
+        notice = parse_notice(text)
+        if notice is None or notice[0] != "joined" or notice[2] is None:
+            return
+        if not is_self(notice[1], notice[2]):
+            agent.start(notice[1], [make_candidate("srflx", notice[2])])
+
+    # make websocket connection, join room
+    websocket = asyncio.ensure_future(
+        websocket_handshake(token, ip, roomId, on_message, on_open)
+    )
+
+    # get users that is currently in the room (a blocking HTTP request)
+    loop = asyncio.get_running_loop()
+    users = await loop.run_in_executor(None, get_users, roomId)
+    # [{'cnd': 'ip:port', 'uid': 'stunpunch#user_id'}, ...]
+    print("- users in the room -")
+    print(users)  # users in the room
+
+    # offer our candidates to everyone in the room and check theirs; they answer
+    # with their own candidates
+    for uid, peer in room_candidates(users, exclude=ip).items():
+        if not is_self(uid, peer):
+            agent.start(uid, [make_candidate("srflx", peer)])
+
+    # keep running websocket in parallel and get noted when users join/leave
+    try:
+        await websocket
+    finally:
+        keepalives.close()
+        selector.stop()
+
+
+asyncio.run(main())
@@ -0,0 +1,318 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from dataclasses import dataclass, field
+
+from stun_client import StunClient
+
+# probe and ack datagrams: magic, kind, 16 byte nonce, then the ids of the sender
+# and of the peer it is meant for (punch_id() of their uids). The first byte has its
+# top bits set to 01, so they can never be taken for STUN messages on the same port.
+PUNCH_MAGIC = b"PNCH"
+PUNCH_PROBE = 1
+PUNCH_ACK = 2
+PUNCH_ID_SIZE = 8
+PUNCH_NO_ID = bytes(PUNCH_ID_SIZE)  # uid not known
+PUNCH_PACKET_SIZE = len(PUNCH_MAGIC) + 1 + 16 + 2 * PUNCH_ID_SIZE
+
+NOTICE_PATTERN = re.compile(r'^User "(.*)" has (joined|left) the message group;(.*)$')
+
+
+class HolePunchError(Exception):
+    def __init__(self, message: str, stats=None):
+        super().__init__(message)
+        self.stats = stats  # PunchStats of the failed attempt
+
+
+def punch_id(uid: str = None) -> bytes:
+    """Id of a peer's uid in probes and acks"""
+    if uid is None:
+        return PUNCH_NO_ID
+    return hashlib.blake2b(uid.encode(), digest_size=PUNCH_ID_SIZE).digest()
+
+
+def punch_ids_match(a: bytes, b: bytes) -> bool:
+    """False only if both ids are known and differ"""
+    return a == b or PUNCH_NO_ID in (a, b)
+
+
+def parse_candidate(candidate) -> tuple:
+    """(ip, port) of an "ip:port" string (IPv6 in brackets) or (ip, port) tuple"""
+    if isinstance(candidate, str):
+        ip, port = candidate.rsplit(":", 1)
+        return ip.strip("[]"), int(port)
+    return candidate[0], int(candidate[1])
+
+
+def room_candidates(users: list, exclude: str = None) -> dict:
+    """
+    uid -> (ip, port) of get_users() entries ({"cnd": "ip:port", "uid": "svc#uid"}),
+    without the entry whose candidate is exclude (our own)
+    """
+    candidates = {}
+    for user in users:
+        if user.get("cnd") in (None, "", "n/a", exclude):
+            continue
+        candidates[user["uid"].split("#")[-1]] = parse_candidate(user["cnd"])
+    return candidates
+
+
+def parse_notice(text: str):
+    """
+    ("joined" or "left", uid, (ip, port) or None) of a websocket "#notice" message
+    ('User "uid" has joined the message group;ip:port'), or None for other messages
+    """
+    try:
+        notice = json.loads(text).get("#notice")
+    except (ValueError, AttributeError):
+        return None
+    match = NOTICE_PATTERN.match(notice) if isinstance(notice, str) else None
+    if match is None:
+        return None
+    uid, event, candidate = match.groups()
+    try:
+        return event, uid, parse_candidate(candidate)
+    except ValueError:
+        return event, uid, None  # "n/a"
+
+
+@dataclass
+class PunchStats:
+    candidates: list  # (ip, port) probed, including peer-reflexive ones learned
+    peer: tuple = None  # the candidate whose ack confirmed the path
+    elapsed: float = 0.0  # seconds from the first probe to the confirming ack
+    probes_sent: int = 0
+    probes_received: int = 0  # probes from the candidates, answered with acks
+    bursts: int = 0
+    started: float = field(default_factory=time.monotonic, repr=False)
+
+
+class PeerTransport(asyncio.DatagramTransport):
+    """Datagram transport to one punched peer over the puncher's shared socket"""
+
+    def __init__(self, puncher, peer: tuple, protocol, stats: PunchStats):
+        super().__init__({"peername": peer, "punch": stats})
+        self.puncher = puncher
+        self.peer = peer
+        self.protocol = protocol
+        self.closing = False
+
+    def sendto(self, data, addr=None):
+        if addr is not None and tuple(addr[:2]) != self.peer:
+            raise ValueError(f"connected to {self.peer}, not {addr}")
+        self.puncher.client.transport.sendto(data, self.peer)
+
+    def get_extra_info(self, name, default=None):
+        if name in self._extra:
+            return self._extra[name]
+        return self.puncher.client.transport.get_extra_info(name, default)
+
+    def get_protocol(self):
+        return self.protocol
+
+    def set_protocol(self, protocol):
+        self.protocol = protocol
+
+    def is_closing(self) -> bool:
+        return self.closing or self.puncher.client.transport.is_closing()
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            if self.puncher.paths.get(self.peer) is self:
+                del self.puncher.paths[self.peer]
+            asyncio.get_running_loop().call_soon(self.protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+
+class PunchAttempt:
+    def __init__(self, candidates: list, future, probe: bytes, peer_id: bytes):
+        self.stats = PunchStats(candidates)
+        self.future = future
+        self.probe = probe
+        self.peer_id = peer_id  # punch_id() of the peer
+        self.triggered = set()  # candidates probed back on receiving their probe
+
+
+class HolePuncher:
+    """
+    UDP hole punching from the port of an open StunClient (whose mapped address the
+    peers were given). connect() sends probes to every candidate of a peer in paced
+    bursts (burst probes burst_spacing apart, then a pause starting at interval and
+    growing by backoff up to max_interval), while the peer does the same towards us
+    (simultaneous open). Within a burst, candidates are probed in the given order,
+    batch at a time check_spacing apart, so long candidate lists such as predicted
+    port windows go out at a bounded rate. The path is confirmed when a candidate
+    echoes our probe's nonce in an ack, i.e. datagrams got through both ways. A
+    probe from an unknown port of a candidate's IP (a NAT that maps per
+    destination) becomes a candidate too, and the first probe from a candidate is
+    probed back at once.
+
+    With our uid and connect(peer=uid), probes and acks carry the ids of both ends:
+    only the attempt for the probe's sender learns from it, and probes meant for
+    someone else are not acked, so two peers behind one public IP (CGNAT, an office
+    NAT) cannot confirm each other's attempts. Without uids, any probe from a
+    candidate's IP counts for every attempt.
+
+    Probes meant for us are acked whoever sends them, so a peer that starts
+    punching first is confirmed as soon as our NAT lets its probes in. Datagrams
+    from connected peers go to their protocols; others to the client's previous
+    on_datagram.
+
+        client, result = await open_stun_client(["stun.example:3478"], 12345)
+        puncher = HolePuncher(client, uid="alice")
+        transport, protocol = await puncher.connect(
+            ["203.0.113.7:40000"], Protocol, peer="bob"
+        )
+        print(transport.get_extra_info("punch"))  # time-to-connect, probes sent
+    """
+
+    def __init__(
+        self,
+        client: StunClient,
+        burst: int = 2,
+        burst_spacing: float = 0.02,
+        interval: float = 0.1,
+        backoff: float = 2.0,
+        max_interval: float = 1.0,
+        timeout: float = 10.0,
+        check_spacing: float = 0.0,
+        batch: int = 1,
+        uid: str = None,
+    ):
+        self.client = client
+        self.burst = burst
+        self.burst_spacing = burst_spacing
+        self.interval = interval
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.check_spacing = check_spacing
+        self.batch = batch
+        self.id = punch_id(uid)
+        self.attempts = {}  # nonce -> PunchAttempt
+        self.paths = {}  # peer (ip, port) -> PeerTransport
+        self.fallback = client.protocol.on_datagram
+        client.protocol.on_datagram = self.datagram_received
+
+    def close(self):
+        for path in list(self.paths.values()):
+            path.close()
+        for attempt in self.attempts.values():
+            attempt.future.cancel()
+        if self.client.protocol.on_datagram == self.datagram_received:
+            self.client.protocol.on_datagram = self.fallback
+
+    async def connect(
+        self,
+        candidates: list,
+        protocol_factory=asyncio.DatagramProtocol,
+        peer: str = None,
+    ) -> tuple:
+        """
+        Punches to a peer (uid peer, if known) reachable at one of candidates
+        ("ip:port" or (ip, port)) and returns (transport, protocol) for it. Raises
+        HolePunchError if no candidate confirms within timeout seconds.
+        """
+        loop = asyncio.get_running_loop()
+        nonce = os.urandom(16)
+        peer_id = punch_id(peer)
+        probe = PUNCH_MAGIC + bytes([PUNCH_PROBE]) + nonce + self.id + peer_id
+        attempt = PunchAttempt(
+            [parse_candidate(c) for c in candidates],
+            loop.create_future(),
+            probe,
+            peer_id,
+        )
+        self.attempts[nonce] = attempt
+        stats = attempt.stats
+        deadline = stats.started + self.timeout
+        pause = self.interval
+        try:
+            while not attempt.future.done():
+                stats.bursts += 1
+                for index in range(self.burst):
+                    if index:
+                        await asyncio.wait([attempt.future], timeout=self.burst_spacing)
+                    if await self.probe_candidates(attempt, probe):
+                        break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.wait([attempt.future], timeout=min(pause, remaining))
+                pause = min(pause * self.backoff, self.max_interval)
+        finally:
+            del self.attempts[nonce]
+        if not attempt.future.done():
+            attempt.future.cancel()
+            raise HolePunchError(
+                f"no answer from {stats.candidates} after {stats.probes_sent} probes",
+                stats,
+            )
+        stats.peer = attempt.future.result()
+        stats.elapsed = time.monotonic() - stats.started
+        protocol = protocol_factory()
+        transport = PeerTransport(self, stats.peer, protocol, stats)
+        if stats.peer in self.paths:
+            self.paths[stats.peer].close()
+        self.paths[stats.peer] = transport
+        protocol.connection_made(transport)
+        return transport, protocol
+
+    async def probe_candidates(self, attempt: PunchAttempt, probe: bytes) -> bool:
+        """
+        Probes the candidates in order, batch at a time check_spacing apart; True
+        once confirmed
+        """
+        for index, candidate in enumerate(list(attempt.stats.candidates)):
+            if index and index % self.batch == 0 and self.check_spacing:
+                await asyncio.wait([attempt.future], timeout=self.check_spacing)
+            if attempt.future.done():
+                return True
+            self.client.transport.sendto(probe, candidate)
+            attempt.stats.probes_sent += 1
+        return attempt.future.done()
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        addr = tuple(addr[:2])
+        if len(data) == PUNCH_PACKET_SIZE and data.startswith(PUNCH_MAGIC):
+            kind, nonce = data[4], data[5:21]
+            sender, receiver = data[21:29], data[29:]
+            if not punch_ids_match(receiver, self.id):
+                return  # meant for another host behind the same address
+            if kind == PUNCH_PROBE:
+                ack = PUNCH_MAGIC + bytes([PUNCH_ACK]) + nonce + self.id + sender
+                self.client.transport.sendto(ack, addr)
+                for attempt in self.attempts.values():
+                    if not punch_ids_match(sender, attempt.peer_id):
+                        continue  # another peer's probe
+                    candidates = attempt.stats.candidates
+                    if addr not in candidates:
+                        if all(ip != addr[0] for ip, _ in candidates):
+                            continue
+                        candidates.append(addr)  # peer-reflexive candidate
+                    attempt.stats.probes_received += 1
+                    if addr not in attempt.triggered:
+                        # triggered check: the path works one way, try it back now
+                        attempt.triggered.add(addr)
+                        self.client.transport.sendto(attempt.probe, addr)
+                        attempt.stats.probes_sent += 1
+            elif kind == PUNCH_ACK:
+                attempt = self.attempts.get(nonce)
+                if (
+                    attempt is not None
+                    and not attempt.future.done()
+                    and punch_ids_match(sender, attempt.peer_id)
+                ):
+                    attempt.future.set_result(addr)
+            return
+        path = self.paths.get(addr)
+        if path is not None:
+            path.protocol.datagram_received(data, addr)
+        elif self.fallback is not None:
+            self.fallback(data, addr)
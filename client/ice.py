@@ -0,0 +1,277 @@
+import asyncio
+import ipaddress
+import json
+import socket
+import zlib
+from dataclasses import dataclass
+
+from candidate_cache import local_interface
+from hole_punch import HolePunchError, HolePuncher
+from stun_client import BindingResult, StunClient
+
+# RFC 8445 5.1.2.2 recommended type preferences
+ICE_TYPE_PREFERENCE = {"host": 126, "prflx": 110, "srflx": 100, "relay": 0}
+
+# key of the candidate list in sendMessage content
+ICE_CONTENT_KEY = "#ice"
+
+
+def candidate_priority(kind: str, local_preference: int = 65535, component=1) -> int:
+    """RFC 8445 5.1.2.1: type preference, then local preference, then component"""
+    return (ICE_TYPE_PREFERENCE[kind] << 24) + (local_preference << 8) + 256 - component
+
+
+@dataclass(frozen=True)
+class Candidate:
+    kind: str  # "host", "srflx", "prflx" or "relay"
+    ip: str
+    port: int
+    priority: int
+    foundation: str = "1"
+
+    @property
+    def address(self) -> tuple:
+        return self.ip, self.port
+
+    def to_sdp(self) -> str:
+        """RFC 8839 candidate-attribute, e.g. "candidate:1 1 udp 2130706431 ..." """
+        return (
+            f"candidate:{self.foundation} 1 udp {self.priority} "
+            f"{self.ip} {self.port} typ {self.kind}"
+        )
+
+    @classmethod
+    def from_sdp(cls, text: str):
+        """Raises ValueError for anything but a UDP candidate-attribute"""
+        fields = text.split()
+        if (
+            len(fields) < 8
+            or not fields[0].startswith("candidate:")
+            or fields[2].lower() != "udp"
+            or fields[6] != "typ"
+            or fields[7] not in ICE_TYPE_PREFERENCE
+        ):
+            raise ValueError(f"not a UDP ICE candidate: {text!r}")
+        ipaddress.ip_address(fields[4])
+        return cls(fields[7], fields[4], int(fields[5]), int(fields[3]), fields[0][10:])
+
+
+def make_candidate(kind: str, address: tuple, local_preference: int = 65535):
+    ip, port = address
+    foundation = str(zlib.crc32(f"{kind} {ip}".encode()))
+    return Candidate(
+        kind, ip, port, candidate_priority(kind, local_preference), foundation
+    )
+
+
+def host_addresses(family: int = socket.AF_INET, route_to: tuple = None) -> list:
+    """
+    Addresses of the local interfaces (no loopback or link-local ones), the one
+    routing to route_to first
+    """
+    addresses = [local_interface(route_to)] if route_to else []
+    try:
+        infos = socket.getaddrinfo(
+            socket.gethostname(), None, family, socket.SOCK_DGRAM
+        )
+    except OSError:
+        infos = []
+    addresses += [info[4][0] for info in infos]
+    usable = []
+    for address in addresses:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            continue
+        if not (ip.is_loopback or ip.is_link_local or ip.is_unspecified):
+            if address not in usable:
+                usable.append(address)
+    return usable
+
+
+def gather_candidates(
+    client: StunClient,
+    mapped: BindingResult = None,
+    relay: tuple = None,
+    interfaces: list = None,
+    predicted: list = None,
+) -> list:
+    """
+    Candidates of an open StunClient's port, best first: a host candidate per local
+    interface (interfaces, or host_addresses() when the client is bound to the
+    wildcard address), a server-reflexive one from mapped (its binding result) when
+    it differs from them, server-reflexive ones for predicted addresses (e.g.
+    MappingBehavior.predicted_candidates() behind a symmetric NAT), and relay, the
+    (ip, port) of a relay allocation, if any
+    """
+    bound_ip, port = client.transport.get_extra_info("sockname")[:2]
+    if interfaces is None:
+        if bound_ip in ("0.0.0.0", "::"):
+            route_to = mapped.server if mapped is not None else None
+            interfaces = host_addresses(client.family, route_to)
+        else:
+            interfaces = [bound_ip]
+    candidates = [
+        make_candidate("host", (ip, port), 65535 - index)
+        for index, ip in enumerate(interfaces)
+    ]
+    if mapped is not None and mapped.ok:
+        if all(c.address != mapped.mapped_address for c in candidates):
+            candidates.append(make_candidate("srflx", mapped.mapped_address))
+    for index, address in enumerate(predicted or ()):
+        if all(c.address != address for c in candidates):
+            candidates.append(make_candidate("srflx", address, 65534 - index))
+    if relay is not None:
+        candidates.append(make_candidate("relay", relay))
+    return sorted(candidates, key=lambda c: c.priority, reverse=True)
+
+
+def check_order(remote: list, family: int = socket.AF_INET) -> list:
+    """
+    Remote candidates in the order to check them. All local candidates share one
+    socket (their base), so pairing prunes to one pair per remote candidate (RFC
+    8445 6.1.2.4) and pair priority follows the remote candidate's priority.
+    """
+    v6 = family == socket.AF_INET6
+    usable = [c for c in remote if (":" in c.ip) == v6]
+    return sorted(usable, key=lambda c: c.priority, reverse=True)
+
+
+def candidates_message(token: str, uid: str, candidates: list) -> str:
+    """A websocket sendMessage action carrying candidates to uid"""
+    return json.dumps(
+        {
+            "action": "sendMessage",
+            "uid": uid,
+            "token": token,
+            "content": {ICE_CONTENT_KEY: [c.to_sdp() for c in candidates]},
+        }
+    )
+
+
+def parse_candidates_message(text: str):
+    """
+    (sender uid, [Candidate]) of a websocket "#private" candidates message, or None
+    for other messages. Malformed candidates are skipped.
+    """
+    try:
+        message = json.loads(text)
+        content = message.get("#private")
+        lines = content.get(ICE_CONTENT_KEY) if isinstance(content, dict) else None
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(lines, list):
+        return None
+    candidates = []
+    for line in lines:
+        try:
+            candidates.append(Candidate.from_sdp(line))
+        except (ValueError, AttributeError):
+            pass
+    return message.get("#user_id"), candidates
+
+
+class IceSession:
+    """Connectivity checks with one peer"""
+
+    def __init__(self, uid: str):
+        self.uid = uid
+        self.remote = []  # candidates received
+        self.offered = False  # our candidates were sent
+        self.check = None  # task running the checks
+        self.transport = None
+        self.selected = None  # remote Candidate of the connected pair
+
+
+class IceAgent:
+    """
+    ICE-style connectivity checks over a HolePuncher (whose check_spacing paces the
+    checks, like Ta in RFC 8445). Candidates are exchanged with send(uid, candidates),
+    e.g. as candidates_message() over the websocket, and received ones are passed
+    to on_message(), which drops our own messages echoed back to us (sender uid).
+    start(uid) offers ours to a peer and checks its candidates as they arrive, best
+    first, so peers on one LAN connect over their host candidates without
+    hairpinning through the NAT. Each new set of remote candidates restarts
+    the checks with all of them; the first confirmed pair is used (aggressive
+    nomination) and reported with on_connected(uid, transport, candidate).
+
+        agent = IceAgent(puncher, gather_candidates(client, result), send, uid=token)
+        agent.start(uid, [Candidate.from_sdp(...)])  # or candidates from the roster
+    """
+
+    def __init__(
+        self,
+        puncher: HolePuncher,
+        candidates: list,
+        send,
+        protocol_factory=asyncio.DatagramProtocol,
+        on_connected=None,
+        on_failed=None,
+        uid: str = None,
+    ):
+        self.puncher = puncher
+        self.candidates = candidates
+        self.send = send
+        self.protocol_factory = protocol_factory
+        self.on_connected = on_connected
+        self.on_failed = on_failed
+        self.uid = uid  # ours: the websocket token's user id
+        self.sessions = {}  # uid -> IceSession
+
+    def start(self, uid: str, candidates: list = ()) -> IceSession:
+        session = self.sessions.get(uid)
+        if session is None:
+            session = self.sessions[uid] = IceSession(uid)
+        if not session.offered:
+            session.offered = True
+            self.send(uid, self.candidates)
+        new = [c for c in candidates if c not in session.remote]
+        if new and session.transport is None:
+            session.remote += new
+            if session.check is not None:
+                session.check.cancel()
+            session.check = asyncio.ensure_future(self.run_checks(session))
+        return session
+
+    def set_candidates(self, candidates: list):
+        """
+        Replaces our candidates (e.g. after the NAT mapping changed) and offers them
+        again to every peer
+        """
+        self.candidates = candidates
+        for uid in self.sessions:
+            self.send(uid, candidates)
+
+    def on_message(self, text: str) -> bool:
+        """Handles a websocket message; False if it carries no candidates"""
+        parsed = parse_candidates_message(text)
+        if parsed is None:
+            return False
+        uid, candidates = parsed
+        if uid is not None and uid != self.uid:  # not our own echo
+            self.start(uid, candidates)
+        return True
+
+    async def run_checks(self, session: IceSession):
+        order = check_order(session.remote, self.puncher.client.family)
+        try:
+            transport, _ = await self.puncher.connect(
+                [c.address for c in order], self.protocol_factory, session.uid
+            )
+        except HolePunchError as e:
+            if self.on_failed is not None:
+                self.on_failed(session.uid, e)
+            return
+        peer = transport.get_extra_info("peername")
+        session.transport = transport
+        session.selected = next(
+            (c for c in order if c.address == peer),
+            make_candidate("prflx", peer),
+        )
+        if self.on_connected is not None:
+            self.on_connected(session.uid, transport, session.selected)
+
+    def close(self):
+        for session in self.sessions.values():
+            if session.check is not None:
+                session.check.cancel()
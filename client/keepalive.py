@@ -0,0 +1,206 @@
+import asyncio
+import functools
+import os
+import random
+
+from stun_client import StunClient, create_binding_request
+
+# RFC 5626 4.4.1: keepalives every 80-100% of the interval, so clients that
+# started together do not stay in lockstep
+KEEPALIVE_INTERVAL = 15.0
+KEEPALIVE_JITTER = 0.2
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: slots of tick seconds, so scheduling and expiring a timer
+    are O(1) however many timers are pending. Timers further out than the wheel
+    span (slots * tick) wait for enough turns of the wheel.
+    """
+
+    def __init__(self, tick: float = 0.25, slots: int = 512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.position = 0  # index of the slot expiring on the next advance()
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def schedule(self, delay: float, item):
+        """Expires item after delay seconds (rounded up to whole ticks, at least one)"""
+        ticks = max(int(-(-delay // self.tick)), 1) - 1
+        turns, offset = divmod(ticks, len(self.slots))
+        self.slots[(self.position + offset) % len(self.slots)].append([turns, item])
+        self.count += 1
+
+    def advance(self) -> list:
+        """Moves the wheel one tick and returns the items that expired"""
+        slot = self.slots[self.position]
+        self.position = (self.position + 1) % len(self.slots)
+        if not slot:
+            return []
+        expired = [item for turns, item in slot if turns == 0]
+        slot[:] = [[turns - 1, item] for turns, item in slot if turns]
+        self.count -= len(expired)
+        return expired
+
+
+class Keepalive:
+    """Keepalive state of one local port"""
+
+    def __init__(
+        self, client: StunClient, server: tuple, interval: float, mapped_address=None
+    ):
+        self.client = client
+        self.server = server  # resolved (ip, port)
+        self.interval = interval
+        self.mapped_address = mapped_address
+        self.future = None  # of the keepalive in flight
+        self.sent = 0
+        self.answered = 0
+        self.missed = 0  # consecutive keepalives without an answer
+        self.active = True
+
+
+class KeepaliveScheduler:
+    """
+    Holds the NAT mappings of many local ports open with periodic binding requests
+    to a STUN server, from one timer on the running event loop: a TimerWheel decides
+    which ports are due each tick, so an idle tick costs one slot lookup and each
+    keepalive one sendto() and one future. There are no retransmissions; the next
+    keepalive is the retry.
+
+    on_change(keepalive, old, new) is called when a port's mapped address changes
+    (the NAT dropped the mapping and made a new one), on_answered(keepalive) for
+    every answer (after on_change; keepalive.mapped_address is the current one), and
+    on_lost(keepalive) after max_missed unanswered keepalives in a row.
+
+        scheduler = KeepaliveScheduler(on_change=report_new_candidate)
+        client, result = await open_stun_client(["stun.example:3478"], 12345)
+        await scheduler.add(client, result.server, mapped_address=result.mapped_address)
+    """
+
+    def __init__(
+        self,
+        interval: float = KEEPALIVE_INTERVAL,
+        jitter: float = KEEPALIVE_JITTER,
+        tick: float = 0.25,
+        max_missed: int = 3,
+        on_change=None,
+        on_lost=None,
+        on_answered=None,
+    ):
+        self.interval = interval
+        self.jitter = jitter
+        self.max_missed = max_missed
+        self.on_change = on_change
+        self.on_lost = on_lost
+        self.on_answered = on_answered
+        self.wheel = TimerWheel(tick)
+        self.keepalives = {}  # StunClient -> Keepalive
+        self.timer = None
+        self.next_tick = None
+
+    async def add(
+        self,
+        client: StunClient,
+        server,
+        interval: float = None,
+        mapped_address=None,
+        delay: float = None,
+    ):
+        """
+        Keeps client's mapping at server ("host:port" or (host, port)) open;
+        mapped_address is the one already known, if any. The first keepalive goes
+        out after delay seconds (by default at random within an interval, to spread
+        them); 0 revalidates mapped_address at the next tick.
+        """
+        self.remove(client)
+        keepalive = Keepalive(
+            client,
+            await client.resolve(server),
+            interval or self.interval,
+            mapped_address,
+        )
+        self.keepalives[client] = keepalive
+        if delay is None:
+            # spread the first keepalives over a whole interval
+            delay = random.uniform(0, keepalive.interval)
+        self.wheel.schedule(delay, keepalive)
+        self.start_timer()
+        return keepalive
+
+    def remove(self, client: StunClient):
+        keepalive = self.keepalives.pop(client, None)
+        if keepalive is not None:
+            keepalive.active = False  # dropped from the wheel when it expires
+            if keepalive.future is not None:
+                keepalive.future.cancel()
+
+    def close(self):
+        for client in list(self.keepalives):
+            self.remove(client)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def start_timer(self):
+        if self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.next_tick = loop.time() + self.wheel.tick
+            self.timer = loop.call_at(self.next_tick, self.on_tick)
+
+    def on_tick(self):
+        loop = asyncio.get_running_loop()
+        # catch up on ticks the loop was too busy to run on time
+        while self.next_tick <= loop.time():
+            for keepalive in self.wheel.advance():
+                if keepalive.active:
+                    self.send(keepalive)
+            self.next_tick += self.wheel.tick
+        if len(self.wheel):
+            self.timer = loop.call_at(self.next_tick, self.on_tick)
+        else:
+            self.timer = None
+
+    def send(self, keepalive: Keepalive):
+        if keepalive.future is not None:
+            # the previous keepalive was not answered within an interval
+            keepalive.future.cancel()
+            keepalive.missed += 1
+            if keepalive.missed == self.max_missed and self.on_lost is not None:
+                self.on_lost(keepalive)
+                if not keepalive.active:
+                    return
+        client = keepalive.client
+        if client.transport is None or client.transport.is_closing():
+            self.remove(client)
+            return
+        transaction_id = os.urandom(12)
+        keepalive.future = asyncio.get_running_loop().create_future()
+        keepalive.future.add_done_callback(
+            functools.partial(self.on_answer, keepalive, transaction_id)
+        )
+        client.protocol.pending[transaction_id] = (keepalive.server, keepalive.future)
+        client.transport.sendto(
+            create_binding_request(transaction_id), keepalive.server
+        )
+        keepalive.sent += 1
+        factor = 1 - random.uniform(0, self.jitter)
+        self.wheel.schedule(keepalive.interval * factor, keepalive)
+
+    def on_answer(self, keepalive: Keepalive, transaction_id: bytes, future):
+        keepalive.client.protocol.pending.pop(transaction_id, None)
+        if future.cancelled() or future.exception() is not None:
+            return  # superseded, removed or client closed
+        keepalive.future = None
+        keepalive.missed = 0
+        keepalive.answered += 1
+        mapped_address, error = future.result()
+        if mapped_address is not None and mapped_address != keepalive.mapped_address:
+            old, keepalive.mapped_address = keepalive.mapped_address, mapped_address
+            if old is not None and self.on_change is not None:
+                self.on_change(keepalive, old, mapped_address)
+        if mapped_address is not None and self.on_answered is not None:
+            self.on_answered(keepalive)
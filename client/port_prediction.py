@@ -0,0 +1,69 @@
+import collections
+from dataclasses import dataclass
+
+from stun_client import StunClient, StunError
+
+
+@dataclass
+class MappingBehavior:
+    """
+    How a NAT maps one local port, from binding requests to several servers (or
+    server ports) sent at once: the ports it allocated, ascending
+    """
+
+    ip: str
+    ports: list
+    delta: int = 0  # most common step between consecutive allocations
+
+    @property
+    def symmetric(self) -> bool:
+        """True if the NAT allocates a new port per destination"""
+        return len(set(self.ports)) > 1
+
+    @property
+    def last_port(self) -> int:
+        return self.ports[-1]
+
+    def predicted_ports(self, window: int) -> list:
+        """
+        Ports the next window allocations get if nothing else allocates in between
+        (the last sampled port itself when the mapping is endpoint-independent)
+        """
+        if not self.symmetric:
+            return [self.last_port]
+        ports = (self.last_port + self.delta * step for step in range(1, window + 1))
+        return [port for port in ports if 0 < port < 65536]
+
+    def predicted_candidates(self, window: int) -> list:
+        return [(self.ip, port) for port in self.predicted_ports(window)]
+
+
+def mapping_behavior(addresses: list) -> MappingBehavior:
+    """
+    MappingBehavior of the mapped addresses of one local port. The requests go out
+    together, so the order they are allocated in is unknown: the ports are taken
+    in ascending order (NATs that allocate downwards are not predicted).
+    """
+    if not addresses:
+        raise StunError("no mapped addresses to predict from")
+    ips = {ip for ip, _ in addresses}
+    if len(ips) > 1:
+        raise StunError(f"mapped to several addresses {sorted(ips)}: not predictable")
+    ports = sorted(port for _, port in addresses)
+    steps = [b - a for a, b in zip(ports, ports[1:]) if b != a]
+    delta = collections.Counter(steps).most_common(1)[0][0] if steps else 0
+    return MappingBehavior(ips.pop(), ports, delta)
+
+
+async def sample_mapping(client: StunClient, servers: list) -> MappingBehavior:
+    """
+    Queries servers (at least two distinct destinations, e.g. two servers or two
+    ports of one server) at once from client's port and returns how the NAT maps it.
+    Raises StunError if fewer than two servers answer.
+    """
+    results = await client.query(servers).results()
+    addresses = [result.mapped_address for result in results if result.ok]
+    if len(addresses) < 2:
+        errors = "; ".join(str(result.error) for result in results if not result.ok)
+        raise StunError(f"need two mapped addresses to predict ports: {errors}")
+    return mapping_behavior(addresses)
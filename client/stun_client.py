@@ -1,68 +1,377 @@
+import asyncio
+import os
 import socket
 import struct
+import time
+import zlib
+from dataclasses import dataclass
 
+STUN_MAGIC_COOKIE = 0x2112A442
+STUN_BINDING_REQUEST = 0x0001
+STUN_BINDING_RESPONSE = 0x0101
+STUN_BINDING_ERROR_RESPONSE = 0x0111
+STUN_ATTR_MAPPED_ADDRESS = 0x0001
+STUN_ATTR_ERROR_CODE = 0x0009
+STUN_ATTR_XOR_MAPPED_ADDRESS = 0x0020
+STUN_ATTR_FINGERPRINT = 0x8028
 
-def stun_client(stun_endpoint: str, client_port: int) -> str:
-    endpoint_split = stun_endpoint.split(":")
-    server_ip = endpoint_split[0]
-    server_port = int(endpoint_split[1])
-    stun_header = b"\x00\x01\x00\x00" + b"\x21\x12\xA4\x42" + (b"\x00" * 12)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+# RFC 5389 7.2.1 retransmission: RTO doubling from 500 ms, Rc transmissions,
+# and Rm * RTO of waiting after the last one
+STUN_RTO = 0.5
+STUN_MAX_TRANSMISSIONS = 7
+STUN_LAST_WAIT_FACTOR = 16
 
-    # Bind the socket to a specific port
-    sock.bind(("", client_port))  # Bind to the chosen port on all interfaces
 
-    user_ip = ""
+class StunError(Exception):
+    pass
 
-    try:
-        sock.sendto(stun_header, (server_ip, server_port))
-        data, _ = sock.recvfrom(1024)
-        # print("Received response:", data)
-
-        # Process STUN response
-        message_type, message_length, magic_cookie = struct.unpack("!HHI", data[0:8])
-        transaction_id = data[8:20]
-
-        # Initialize pointer to start of attributes
-        pointer = 20
-
-        while pointer < message_length + 20:
-            attr_type, attr_length = struct.unpack("!HH", data[pointer : pointer + 4])
-            attr_value = data[pointer + 4 : pointer + 4 + attr_length]
-
-            if (
-                attr_type == 0x0001 or attr_type == 0x0020
-            ):  # MAPPED-ADDRESS or XOR-MAPPED-ADDRESS
-                if attr_length == 8:  # IPv4
-                    # Ensure attr_value is exactly 8 bytes
-                    if len(attr_value) == 8:
-                        _, family, port, ip1, ip2, ip3, ip4 = struct.unpack(
-                            "!BBHBBBB", attr_value
-                        )
-                        ip_address = f"{ip1}.{ip2}.{ip3}.{ip4}"
-                        user_ip = f"{ip_address}:{port}"
-                        break
 
-                    else:
-                        raise ValueError(
-                            f"Unexpected attr_value length for IPv4: {len(attr_value)}"
-                        )
-                elif attr_length == 20:  # IPv6
-                    # Ensure attr_value is exactly 20 bytes for IPv6
-                    if len(attr_value) == 20:
-                        _, family, port, *ip_parts = struct.unpack("!BBH8H", attr_value)
-                        ip_address = ":".join(f"{part:04x}" for part in ip_parts)
-                        user_ip = f"{ip_address}:{port}"
+@dataclass
+class BindingResult:
+    server: tuple  # (ip, port) the request was sent to
+    mapped_address: tuple = None  # (ip, port) as seen by the server
+    error: str = None  # error response or timeout
+    answered: bool = False  # the server sent a binding (error) response
+    transmissions: int = 0
+    elapsed: float = 0.0  # seconds from the first transmission to the answer
+    rtt: float = None  # only when the first transmission was answered (Karn)
+
+    @property
+    def ok(self) -> bool:
+        return self.mapped_address is not None
+
+
+def create_binding_request(transaction_id: bytes) -> bytes:
+    return (
+        struct.pack("!HHI", STUN_BINDING_REQUEST, 0, STUN_MAGIC_COOKIE) + transaction_id
+    )
+
+
+def decode_address(value: bytes, xor_key: bytes = None) -> tuple:
+    """(ip, port) of a MAPPED-ADDRESS value, or of an XOR-MAPPED-ADDRESS value with
+    xor_key (magic cookie + transaction ID)"""
+    if len(value) < 8:
+        raise StunError("address attribute too short")
+    family, port = value[1], int.from_bytes(value[2:4], "big")
+    address = value[4:8] if family == 0x01 else value[4:20]
+    if family not in (0x01, 0x02) or len(address) != (4 if family == 0x01 else 16):
+        raise StunError(f"bad address family {family}")
+    if xor_key is not None:
+        port ^= STUN_MAGIC_COOKIE >> 16
+        address = bytes(a ^ k for a, k in zip(address, xor_key))
+    return (
+        socket.inet_ntop(
+            socket.AF_INET if family == 0x01 else socket.AF_INET6, address
+        ),
+        port,
+    )
+
+
+def parse_binding_response(data: bytes, transaction_id: bytes) -> tuple:
+    """
+    Checks a binding response to transaction_id and returns (mapped address, None),
+    or (None, error) for an error response.
+    Raises StunError if data is not a valid answer.
+    """
+    if len(data) < 20:
+        raise StunError("message too short")
+    message_type, message_length, magic_cookie = struct.unpack("!HHI", data[:8])
+    if (
+        magic_cookie != STUN_MAGIC_COOKIE
+        or message_length + 20 != len(data)
+        or data[8:20] != transaction_id
+    ):
+        raise StunError("not an answer to this request")
+    if message_type not in (STUN_BINDING_RESPONSE, STUN_BINDING_ERROR_RESPONSE):
+        raise StunError(f"unexpected message type 0x{message_type:04x}")
+
+    attributes = {}
+    pointer = 20
+    while pointer + 4 <= len(data):
+        attr_type, attr_length = struct.unpack("!HH", data[pointer : pointer + 4])
+        if pointer + 4 + attr_length > len(data):
+            raise StunError("truncated attribute")
+        if attr_type == STUN_ATTR_FINGERPRINT:
+            expected = (zlib.crc32(data[:pointer]) ^ 0x5354554E) & 0xFFFFFFFF
+            if data[pointer + 4 : pointer + 8] != expected.to_bytes(4, "big"):
+                raise StunError("wrong FINGERPRINT")
+        attributes.setdefault(attr_type, data[pointer + 4 : pointer + 4 + attr_length])
+        pointer += 4 + attr_length + (-attr_length & 3)
+
+    if message_type == STUN_BINDING_ERROR_RESPONSE:
+        value = attributes.get(STUN_ATTR_ERROR_CODE, b"\x00\x00\x00\x00")
+        code = (value[2] & 0x07) * 100 + value[3] if len(value) >= 4 else 0
+        return None, f"{code} {value[4:].decode('utf-8', 'replace')}".strip()
+    if STUN_ATTR_XOR_MAPPED_ADDRESS in attributes:
+        return (
+            decode_address(attributes[STUN_ATTR_XOR_MAPPED_ADDRESS], data[4:20]),
+            None,
+        )
+    if STUN_ATTR_MAPPED_ADDRESS in attributes:
+        return decode_address(attributes[STUN_ATTR_MAPPED_ADDRESS]), None
+    raise StunError("binding response without a mapped address")
+
+
+class StunClientProtocol(asyncio.DatagramProtocol):
+    """
+    Hands every valid answer to the pending transaction with its transaction ID,
+    and other datagrams (e.g. from peers on a reused port) to on_datagram
+    """
+
+    def __init__(self, on_datagram=None):
+        self.transport = None
+        self.pending = {}  # transaction ID -> (server address, future)
+        self.on_datagram = on_datagram
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        transaction = self.pending.get(data[8:20])
+        if transaction is None or addr[:2] != transaction[0]:
+            if self.on_datagram is not None:
+                self.on_datagram(data, addr)
+            return
+        server, future = transaction
+        if future.done():
+            return
+        try:
+            future.set_result(parse_binding_response(data, data[8:20]))
+        except StunError:
+            pass  # not a valid answer: keep waiting for one
+
+    def error_received(self, exc):
+        pass  # ICMP errors: the transaction times out like a lost packet
+
+    def connection_lost(self, exc):
+        for _, future in self.pending.values():
+            if not future.done():
+                future.set_exception(StunError("client closed"))
+
+
+class BindingQuery:
+    """Binding transactions with several servers, running concurrently from one port"""
+
+    def __init__(self, tasks: list):
+        self.tasks = tasks
+
+    async def first(self) -> BindingResult:
+        """The first successful result; raises StunError if every server fails"""
+        errors = []
+        for next_done in asyncio.as_completed(self.tasks):
+            result = await next_done
+            if result.ok:
+                return result
+            errors.append(f"{result.server[0]}:{result.server[1]}: {result.error}")
+        raise StunError("no STUN server answered: " + "; ".join(errors))
+
+    async def results(self) -> list:
+        """Every server's result, in the order the servers were given"""
+        return list(await asyncio.gather(*self.tasks))
+
+    def done(self) -> list:
+        """Results available so far"""
+        return [
+            task.result() for task in self.tasks if task.done() and not task.cancelled()
+        ]
+
+    async def mapped_addresses(self) -> set:
+        """
+        Distinct mapped addresses reported by the servers that answered. More than one
+        means the NAT maps the local port per destination (symmetric NAT): a candidate
+        is then only good for the server that reported it.
+        """
+        return {result.mapped_address for result in await self.results() if result.ok}
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+
+class StunClient:
+    """
+    Asyncio STUN client on one local UDP port. Binding requests carry random
+    transaction IDs and are retransmitted per RFC 5389: rto doubling, max_transmissions,
+    last_wait_factor * rto after the last one, at most timeout seconds in all.
+    Answers are matched by transaction ID and server address; other datagrams go to
+    on_datagram(data, addr), so the port can stay open for hole punching.
+
+        async with StunClient(local_port=12345) as client:
+            query = client.query(["stun1.example.com:3478", "stun2.example.com:3478"])
+            candidate = await query.first()  # as soon as any server answers
+            consistent = len(await query.mapped_addresses()) == 1  # all servers
+    """
+
+    def __init__(
+        self,
+        local_port: int = 0,
+        local_host: str = "",
+        rto: float = STUN_RTO,
+        max_transmissions: int = STUN_MAX_TRANSMISSIONS,
+        last_wait_factor: int = STUN_LAST_WAIT_FACTOR,
+        timeout: float = None,
+        family: int = socket.AF_INET,
+        on_datagram=None,
+    ):
+        self.local_address = (local_host, local_port)
+        self.rto = rto
+        self.max_transmissions = max_transmissions
+        self.last_wait_factor = last_wait_factor
+        self.timeout = timeout
+        self.family = family
+        self.on_datagram = on_datagram
+        self.transport = None
+        self.protocol = None
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        sock.bind(self.local_address)
+        self.transport, self.protocol = await loop.create_datagram_endpoint(
+            lambda: StunClientProtocol(self.on_datagram), sock=sock
+        )
+        return self
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    @property
+    def local_port(self) -> int:
+        return self.transport.get_extra_info("sockname")[1]
+
+    async def resolve(self, server) -> tuple:
+        """(ip, port) of a "host:port" string or (host, port) tuple"""
+        host, port = server.rsplit(":", 1) if isinstance(server, str) else server
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, int(port), family=self.family, type=socket.SOCK_DGRAM
+        )
+        return infos[0][4][:2]
+
+    async def request(self, server) -> BindingResult:
+        """One binding transaction with server; failures are reported in the result"""
+        try:
+            address = await self.resolve(server)
+        except (OSError, ValueError) as e:
+            return BindingResult(server=server, error=f"cannot resolve: {e}")
+
+        loop = asyncio.get_running_loop()
+        transaction_id = os.urandom(12)
+        future = loop.create_future()
+        self.protocol.pending[transaction_id] = (address, future)
+        request = create_binding_request(transaction_id)
+        result = BindingResult(server=address)
+        start = time.monotonic()
+        deadline = start + self.timeout if self.timeout is not None else None
+        wait = self.rto
+        try:
+            while result.transmissions < self.max_transmissions:
+                self.transport.sendto(request, address)
+                result.transmissions += 1
+                if result.transmissions == self.max_transmissions:
+                    wait = self.rto * self.last_wait_factor
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                try:
+                    result.mapped_address, result.error = await asyncio.wait_for(
+                        asyncio.shield(future), max(wait, 0)
+                    )
+                except asyncio.TimeoutError:
+                    if deadline is not None and time.monotonic() >= deadline:
                         break
-                    else:
-                        raise ValueError(
-                            f"Unexpected attr_value length for IPv6: {len(attr_value)}"
-                        )
+                    wait *= 2
+                    continue
+                result.answered = True
+                result.elapsed = time.monotonic() - start
+                if result.transmissions == 1:
+                    result.rtt = result.elapsed
+                return result
+        except StunError as e:
+            result.error = str(e)
+            return result
+        finally:
+            self.protocol.pending.pop(transaction_id, None)
+        result.elapsed = time.monotonic() - start
+        result.error = f"timed out after {result.transmissions} transmissions"
+        return result
+
+    def query(self, servers: list) -> BindingQuery:
+        """Starts a binding transaction with every server at once"""
+        return BindingQuery(
+            [asyncio.ensure_future(self.request(server)) for server in servers]
+        )
 
-                break  # Exit after processing the relevant attribute
 
-            pointer += 4 + attr_length  # Move to the next attribute
+async def query_stun_servers(servers: list, local_port: int = 0, **options) -> tuple:
+    """
+    Queries servers concurrently from local_port. Returns the first successful
+    BindingResult and, once all have finished, every server's result (for NAT
+    consistency checks).
+    """
+    async with StunClient(local_port, **options) as client:
+        query = client.query(servers)
+        first = await query.first()
+        return first, await query.results()
+
+
+async def open_stun_client(
+    servers: list, local_port: int = 0, first=None, **options
+) -> tuple:
+    """
+    Like query_stun_servers, but returns (client, first BindingResult) with the
+    client still open: the NAT mapping it discovered stays bound to its socket for
+    hole punching and keepalives. Close the client when done. first(client), if
+    given, is awaited for the BindingResult instead of querying servers at once,
+    e.g. a StunServerSelector's or CandidateCache's mapped_address.
+    """
+    client = await StunClient(local_port, **options).open()
+    query = client.query(servers) if first is None else None
+    try:
+        if query is None:
+            return client, await first(client)
+        return client, await query.first()
+    except BaseException:
+        client.close()
+        raise
     finally:
-        sock.close()
+        if query is not None:
+            query.cancel()
+
+
+def stun_client(stun_endpoint: str, client_port: int, timeout: float = 9.5) -> str:
+    """
+    Mapped "ip:port" of client_port as seen by stun_endpoint ("host:port").
+    Raises StunError if the server does not answer within timeout seconds.
+    """
+    return stun_client_socket(stun_endpoint, client_port, timeout, keep_socket=False)[0]
+
+
+def stun_client_socket(
+    stun_endpoint: str, client_port: int, timeout: float = 9.5, keep_socket=True
+) -> tuple:
+    """
+    (mapped "ip:port", socket) like stun_client, where socket is the still bound UDP
+    socket the request was sent from (None without keep_socket), so the mapping is
+    not given up between learning it and using it.
+    """
+
+    async def first_mapped_address():
+        client, result = await open_stun_client(
+            [stun_endpoint], client_port, timeout=timeout
+        )
+        # a duplicate descriptor keeps the port bound after the event loop closes
+        sock = client.transport.get_extra_info("socket").dup() if keep_socket else None
+        client.close()
+        return result, sock
 
-    return user_ip
+    result, sock = asyncio.run(first_mapped_address())
+    if sock is not None:
+        sock.setblocking(True)  # the duplicate shares the event loop's O_NONBLOCK
+    ip, port = result.mapped_address
+    return f"{ip}:{port}", sock
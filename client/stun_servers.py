@@ -0,0 +1,251 @@
+import asyncio
+import json
+import os
+import time
+
+from stun_client import STUN_RTO, BindingResult, StunClient, StunError
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "broadwayinc", "stun_servers.json"
+)
+
+
+class ServerEstimate:
+    """Exponentially weighted RTT and loss of one server, like TCP's SRTT/RTTVAR"""
+
+    def __init__(self, srtt=None, rttvar=0.0, loss=0.0, failures=0, updated=0.0):
+        self.srtt = srtt  # seconds, None until a first-transmission answer
+        self.rttvar = rttvar
+        self.loss = loss  # share of transmissions that went unanswered
+        self.failures = failures  # consecutive transactions without a mapped address
+        self.updated = updated  # time.time() of the last result
+
+    def record(self, result: BindingResult, alpha: float):
+        if result.transmissions == 0:
+            return  # never sent (e.g. the name did not resolve)
+        if result.rtt is not None:
+            if self.srtt is None:
+                self.srtt, self.rttvar = result.rtt, result.rtt / 2
+            else:
+                self.rttvar += alpha * (abs(self.srtt - result.rtt) - self.rttvar)
+                self.srtt += alpha * (result.rtt - self.srtt)
+        loss = 1 - 1 / result.transmissions if result.answered else 1.0
+        self.loss += alpha * (loss - self.loss)
+        self.failures = 0 if result.ok else self.failures + 1
+        self.updated = time.time()
+
+    def record_loss(self, alpha: float):
+        """
+        One transmission left unanswered when another server answered first: a loss
+        sample, but not a failed transaction
+        """
+        self.loss += alpha * (1.0 - self.loss)
+        self.updated = time.time()
+
+    def expected_time(self, rto: float) -> float:
+        """Expected time to an answer: a round trip plus an RTO per lost transmission"""
+        if self.srtt is None:
+            return float("inf")
+        return self.srtt + self.loss / max(1 - self.loss, 0.05) * rto
+
+    def to_json(self) -> dict:
+        return {
+            "srtt": self.srtt,
+            "rttvar": self.rttvar,
+            "loss": self.loss,
+            "failures": self.failures,
+            "updated": self.updated,
+        }
+
+
+class StunServerSelector:
+    """
+    Picks STUN servers by measured latency. Every binding transaction updates the
+    server's ServerEstimate; estimates persist in a small JSON file at cache_path
+    (entries older than max_age seconds are dropped on load).
+
+    servers() ranks the healthy servers (fewer than max_failures consecutive
+    failures) by expected time to an answer, then servers without an estimate, then
+    unhealthy ones. mapped_address() asks the best server first and the next ones
+    only if it has not answered within about twice its smoothed RTT, so a server
+    that just went bad costs little. With start(), servers are re-probed in the
+    background every reprobe_interval seconds.
+
+        selector = StunServerSelector(["stun-a.example:3478", "stun-b.example:3478"])
+        selector.start()
+        result = await selector.mapped_address(local_port=12345)
+    """
+
+    def __init__(
+        self,
+        servers: list,
+        cache_path: str = DEFAULT_CACHE_PATH,
+        alpha: float = 0.25,
+        max_failures: int = 3,
+        reprobe_interval: float = 300.0,
+        max_age: float = 7 * 24 * 3600.0,
+        probe_timeout: float = 3.0,
+        **client_options,
+    ):
+        self.server_list = list(servers)
+        self.cache_path = cache_path
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.reprobe_interval = reprobe_interval
+        self.max_age = max_age
+        self.probe_timeout = probe_timeout
+        self.client_options = client_options
+        self.rto = client_options.get("rto", STUN_RTO)
+        self.estimates = {server: ServerEstimate() for server in self.server_list}
+        self.reprobe_task = None
+        self.load()
+
+    def load(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for server, values in cached.items():
+            if (
+                server in self.estimates
+                and now - values.get("updated", 0) < self.max_age
+            ):
+                try:
+                    self.estimates[server] = ServerEstimate(**values)
+                except TypeError:
+                    pass  # written by another version
+
+    def save(self):
+        if not self.cache_path:
+            return
+        data = {
+            server: estimate.to_json()
+            for server, estimate in self.estimates.items()
+            if estimate.updated
+        }
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            temporary = f"{self.cache_path}.{os.getpid()}.tmp"
+            with open(temporary, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=1)
+            os.replace(temporary, self.cache_path)  # readers never see a partial file
+        except OSError:
+            pass  # the cache is an optimization
+
+    def healthy(self, server: str) -> bool:
+        return self.estimates[server].failures < self.max_failures
+
+    def servers(self) -> list:
+        """Servers from best to worst"""
+
+        def rank(server):
+            estimate = self.estimates[server]
+            return (not self.healthy(server), estimate.expected_time(self.rto))
+
+        return sorted(self.server_list, key=rank)
+
+    def record(self, server: str, result: BindingResult):
+        self.estimates[server].record(result, self.alpha)
+
+    async def probe(self, servers: list = None):
+        """Queries servers (default: all) concurrently and updates their estimates"""
+        servers = self.server_list if servers is None else servers
+        options = dict(self.client_options, timeout=self.probe_timeout)
+        async with StunClient(**options) as client:
+            results = await client.query(servers).results()
+        for server, result in zip(servers, results):
+            self.record(server, result)
+        self.save()
+        return results
+
+    def stagger(self, server: str) -> float:
+        """How long to wait for server before asking the next one too"""
+        estimate = self.estimates[server]
+        if estimate.srtt is None or not self.healthy(server):
+            return self.rto
+        return min(max(2 * estimate.srtt + 4 * estimate.rttvar, 0.05), self.rto)
+
+    async def mapped_address(
+        self, local_port: int = 0, client: StunClient = None
+    ) -> BindingResult:
+        """
+        Mapped address of local_port from the best server, falling back to the next
+        ones in rank order, asked from client if it is already open on the port.
+        Raises StunError if no server answers.
+        """
+        if client is None:
+            async with StunClient(local_port, **self.client_options) as client:
+                return await self.mapped_address(local_port, client)
+        ranked = self.servers()
+        pending = {}
+        errors = []
+        winner = None
+        try:
+            for server in ranked:
+                pending[asyncio.ensure_future(client.request(server))] = server
+                winner = await self.first_answer(pending, self.stagger(server), errors)
+                if winner is not None:
+                    return winner[1]
+            while pending and winner is None:
+                winner = await self.first_answer(pending, None, errors)
+            if winner is not None:
+                return winner[1]
+        finally:
+            # servers overtaken by one asked later count as a lost transmission
+            overtaken = ranked[: ranked.index(winner[0])] if winner else []
+            for task, server in pending.items():
+                task.cancel()
+                if server in overtaken:
+                    self.estimates[server].record_loss(self.alpha)
+            self.save()
+        raise StunError("no STUN server answered: " + "; ".join(errors))
+
+    async def first_answer(self, pending: dict, timeout, errors: list):
+        """
+        Records finished requests and returns (server, result) of the first success
+        within timeout, or None
+        """
+        if not pending:
+            return None
+        done, _ = await asyncio.wait(
+            pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        success = None
+        for task in done:
+            server = pending.pop(task)
+            result = task.result()
+            self.record(server, result)
+            if result.ok and success is None:
+                success = server, result
+            elif not result.ok:
+                errors.append(f"{server}: {result.error}")
+        return success
+
+    def start(self):
+        """Re-probes the servers in the background (on the running event loop)"""
+        if self.reprobe_task is None:
+            self.reprobe_task = asyncio.ensure_future(self.reprobe_forever())
+
+    def stop(self):
+        if self.reprobe_task is not None:
+            self.reprobe_task.cancel()
+            self.reprobe_task = None
+
+    async def reprobe_forever(self):
+        while True:
+            now = time.time()
+            stale = [
+                server
+                for server in self.server_list
+                if now - self.estimates[server].updated >= self.reprobe_interval
+            ]
+            if stale:
+                try:
+                    await self.probe(stale)
+                except OSError:
+                    pass  # no network right now: try again later
+            await asyncio.sleep(self.reprobe_interval / 4)
@@ -25,7 +25,7 @@ async def send_message(writer, message):
     await writer.drain()
 
 
-async def websocket_handshake(token: str, candidate: str, roomId: str):
+async def websocket_handshake(token: str, candidate: str, roomId: str, on_message=None, on_open=None):
     if not token:
         raise Exception("Token is required")
 
@@ -90,6 +90,10 @@ async def websocket_handshake(token: str, candidate: str, roomId: str):
         ),
     )
 
+    # Hand the writer out for sending messages (e.g. with send_message)
+    if on_open is not None:
+        on_open(writer)
+
     try:
         while True:
             # Read the first two bytes to get opcode and payload length
@@ -112,6 +116,8 @@ async def websocket_handshake(token: str, candidate: str, roomId: str):
                 payload = await reader.readexactly(length)
                 text = payload.decode("utf-8")
                 print("Received text:", text)
+                if on_message is not None:
+                    on_message(text)
 
             # Handle ping frame (opcode 0x9)
             elif opcode == 0x9:
@@ -125,9 +131,6 @@ async def websocket_handshake(token: str, candidate: str, roomId: str):
                 print("Received pong or close frame")
                 break  # Exit loop if close frame
 
-            # Wait a bit before the next operation
-            await asyncio.sleep(1)
-
     except asyncio.CancelledError:
         # Close the connection gracefully
         writer.write(b"\x88\x00")  # WebSocket close frame
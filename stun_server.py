@@ -9,18 +9,155 @@ free to ask any questions, happy to help.
 - Baksa Gimm
 """
 
+import argparse
+import asyncio
+import base64
+import collections
+import fcntl
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import random
+import select
+import signal
 import socket
+import ssl
 import struct
+import termios
 import threading
+import time
+import zlib
+from urllib.parse import parse_qsl
 # STUN message types
 STUN_BINDING_REQUEST = 0x0001
 STUN_BINDING_RESPONSE = 0x0101
+STUN_BINDING_ERROR_RESPONSE = 0x0111
+# Low byte of a response's message type: tells binding success (0x01) from error (0x11) responses
+STUN_BINDING_RESPONSE_LOW = STUN_BINDING_RESPONSE & 0xFF
 
 # STUN attribute types
+STUN_ATTR_MAPPED_ADDRESS = 0x0001
+STUN_ATTR_CHANGE_REQUEST = 0x0003
+STUN_ATTR_USERNAME = 0x0006
+STUN_ATTR_MESSAGE_INTEGRITY = 0x0008
+STUN_ATTR_ERROR_CODE = 0x0009
+STUN_ATTR_UNKNOWN_ATTRIBUTES = 0x000A
+STUN_ATTR_REALM = 0x0014
+STUN_ATTR_NONCE = 0x0015
 STUN_ATTR_XOR_MAPPED_ADDRESS = 0x0020
+STUN_ATTR_SOFTWARE = 0x8022
+STUN_ATTR_FINGERPRINT = 0x8028
+STUN_ATTR_RESPONSE_ORIGIN = 0x802B
+STUN_ATTR_OTHER_ADDRESS = 0x802C
+
+# CHANGE-REQUEST flags (RFC 5780)
+STUN_CHANGE_IP = 0x04
+STUN_CHANGE_PORT = 0x02
+
+# Message classes, or-ed into the method to get the message type
+STUN_CLASS_REQUEST = 0x0000
+STUN_CLASS_INDICATION = 0x0010
+STUN_CLASS_SUCCESS = 0x0100
+STUN_CLASS_ERROR = 0x0110
+
+# TURN (RFC 5766) methods and attributes
+TURN_ALLOCATE = 0x003
+TURN_REFRESH = 0x004
+TURN_SEND = 0x006
+TURN_DATA = 0x007
+TURN_CREATE_PERMISSION = 0x008
+TURN_CHANNEL_BIND = 0x009
+STUN_ATTR_CHANNEL_NUMBER = 0x000C
+STUN_ATTR_LIFETIME = 0x000D
+STUN_ATTR_XOR_PEER_ADDRESS = 0x0012
+STUN_ATTR_DATA = 0x0013
+STUN_ATTR_XOR_RELAYED_ADDRESS = 0x0016
+STUN_ATTR_REQUESTED_TRANSPORT = 0x0019
+
+TURN_DEFAULT_LIFETIME = 600
+TURN_MAX_LIFETIME = 3600
+TURN_PERMISSION_LIFETIME = 300
+TURN_CHANNEL_LIFETIME = 600
+
+# Comprehension-required attributes (< 0x8000) this server understands; others get a 420 error response
+STUN_KNOWN_ATTRIBUTES = {
+    STUN_ATTR_MAPPED_ADDRESS,
+    STUN_ATTR_USERNAME,
+    STUN_ATTR_MESSAGE_INTEGRITY,
+    STUN_ATTR_ERROR_CODE,
+    STUN_ATTR_UNKNOWN_ATTRIBUTES,
+    STUN_ATTR_REALM,
+    STUN_ATTR_NONCE,
+    STUN_ATTR_XOR_MAPPED_ADDRESS,
+}
 
 # STUN magic cookie
 STUN_MAGIC_COOKIE = 0x2112A442
+STUN_FINGERPRINT_XOR = 0x5354554E
+
+SERVER_SOFTWARE = "broadwayinc stun_server.py"
+
+# Precompiled layouts for the hot path (see BindingResponder)
+STUN_HEADER = struct.Struct('!HHIQI')  # type, length, cookie, transaction ID (8 + 4 bytes)
+STUN_XOR_MAPPED_ADDRESS_V4 = struct.Struct('!HHBBHI')  # XOR-MAPPED-ADDRESS attribute (IPv4)
+STUN_BINDING_RESPONSE_V4 = struct.Struct('!HHIQI12s')  # header + encoded XOR-MAPPED-ADDRESS attribute (IPv4)
+STUN_BINDING_RESPONSE_V4_SIZE = STUN_BINDING_RESPONSE_V4.size
+STUN_BINDING_RESPONSE_V6 = struct.Struct('!HHIQIHHBBHIQI')  # header + XOR-MAPPED-ADDRESS (IPv6) as 32 + 64 + 32 bit words
+STUN_BINDING_RESPONSE_V6_SIZE = STUN_BINDING_RESPONSE_V6.size
+STUN_LENGTH_COOKIE = struct.Struct('!HI')
+STUN_LENGTH = struct.Struct('!H')
+STUN_ATTR_HEADER = struct.Struct('!HH')
+STUN_ADDRESS_V4_ATTR = struct.Struct('!HHBBH4s')  # MAPPED-ADDRESS style attribute (IPv4)
+STUN_CHANGE_REQUEST = struct.Struct('!I')
+STUN_XOR_ADDRESS_V4 = struct.Struct('!BBHI')  # XOR-*-ADDRESS value (IPv4)
+STUN_XOR_ADDRESS_V6 = struct.Struct('!BBH16s')  # XOR-*-ADDRESS value (IPv6)
+TURN_CHANNEL_DATA = struct.Struct('!HH')  # channel number, length
+TURN_DATA_INDICATION_V4 = struct.Struct('!HHIQIHHBBHIHH')  # header + XOR-PEER-ADDRESS (IPv4) + DATA attribute header
+TURN_DATA_INDICATION_V4_SIZE = TURN_DATA_INDICATION_V4.size
+STUN_FINGERPRINT_ATTR = struct.Struct('!HHI')
+STUN_MESSAGE_INTEGRITY_SIZE = 24  # attribute header + HMAC-SHA1
+STUN_MAX_RESPONSE_SIZE = 548  # keep responses within the minimum IPv4 MTU guidance of RFC 5389
+STUN_MAX_STREAM_MESSAGE = 2048  # larger messages on a TCP/TLS connection close it
+
+# A dual-stack (AF_INET6, IPV6_V6ONLY=0) socket reports IPv4 clients as '::ffff:a.b.c.d'
+IPV4_MAPPED_PREFIX = '::ffff:'
+WILDCARD_HOSTS = ('', '0.0.0.0', '::')
+
+# Kernel receive timestamps (Linux values, not exported by the socket module)
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+TIMESPEC = struct.Struct('@qq')  # tv_sec, tv_nsec
+TIMESTAMP_ANCBUFSIZE = socket.CMSG_SPACE(TIMESPEC.size)
+
+# Socket receive queue overflow counter attached to datagrams (Linux value, not exported by the socket module)
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+RXQ_OVFL = struct.Struct('@I')
+RXQ_OVFL_ANCBUFSIZE = socket.CMSG_SPACE(RXQ_OVFL.size)
+
+# Per UDP loop counters, exported on GET /metrics as stun_<name>_total
+COUNTER_NAMES = (
+    'packets_received',
+    'binding_responses_sent',
+    'malformed_drops',
+    'unknown_method_drops',
+    'rate_limited_drops',
+    'error_responses',
+    'send_drops',
+    'socket_overflow_drops',
+    'mapped_cache_hits',
+    'mapped_cache_misses',
+)
+
+HEALTH_CHECK_RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n\r\nOK"
+HEALTH_CHECK_STALLED_RESPONSE = b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\nContent-Length: 7\r\n\r\nSTALLED"
+
+# Named stats providers served as JSON on GET /stats of the health check port (name -> callable returning a dict)
+STATS_PROVIDERS = {}
+
+# Bytes per worker of the shared array the worker pool publishes its /stats and top talkers in, as JSON
+WORKER_STATE_SIZE = 16384
 
 def parse_stun_message(data):
     """
@@ -39,10 +176,18 @@ def parse_stun_message(data):
 
     return method, message_length, magic_cookie, transaction_id, attributes
 
-def create_stun_binding_response(transaction_id, ip, port):
+def create_stun_binding_response(transaction_id, ip, port, integrity_key=None):
     """
     Creates a STUN Binding Response message.
+    ip may be IPv4, IPv6 or a v4-mapped IPv6 address (answered as IPv4).
+    With integrity_key (the short-term credential password), a MESSAGE-INTEGRITY attribute is appended.
     """
+    ip = unmap_ipv4(ip)
+    if ':' in ip:
+        return create_stun_message(STUN_BINDING_RESPONSE, transaction_id,
+                                   [(STUN_ATTR_XOR_MAPPED_ADDRESS, encode_xor_address((ip, port), transaction_id))],
+                                   integrity_key=integrity_key)
+
     # STUN message header
     message_type = STUN_BINDING_RESPONSE
     message_length = 12  # Length of the XOR-MAPPED-ADDRESS attribute
@@ -66,56 +211,2228 @@ def create_stun_binding_response(transaction_id, ip, port):
                            xor_port,
                            struct.pack('!I', xor_ip))
 
+    if integrity_key is not None:
+        response = bytearray(response) + bytes(STUN_MESSAGE_INTEGRITY_SIZE)
+        append_message_integrity(response, len(response) - STUN_MESSAGE_INTEGRITY_SIZE, hmac.new(integrity_key, digestmod=hashlib.sha1))
+        response = bytes(response)
+
     return response
 
-def handle_stun_request(server_socket):
+def is_stun_message(data, nbytes):
+    """
+    Cheap RFC 5389 prefilter, run before any parsing: at least a header, top two bits zero,
+    length a multiple of 4 and equal to the declared message length plus header, and the magic cookie.
+    """
+    if nbytes < 20 or nbytes & 3 or data[0] & 0xC0:
+        return False
+    message_length, magic_cookie = STUN_LENGTH_COOKIE.unpack_from(data, 2)
+    return message_length + 20 == nbytes and magic_cookie == STUN_MAGIC_COOKIE
+
+def iter_stun_attributes(data, nbytes=None):
+    """
+    Walks the attribute TLVs of a STUN message (header included in data) without copying.
+    Yields (attribute type, memoryview of the value). Raises ValueError on a truncated attribute.
+    """
+    view = memoryview(data)
+    end = len(view) if nbytes is None else nbytes
+    offset = 20
+
+    while offset < end:
+        if offset + 4 > end:
+            raise ValueError(f"truncated attribute header at offset {offset}")
+        attr_type, attr_length = STUN_ATTR_HEADER.unpack_from(view, offset)
+        value_end = offset + 4 + attr_length
+        if value_end > end:
+            raise ValueError(f"attribute 0x{attr_type:04x} overruns the message")
+        yield attr_type, view[offset + 4:value_end]
+        offset = value_end + (-attr_length & 3)  # values are padded to 4 bytes
+
+def stun_fingerprint(data, length):
+    """ FINGERPRINT value of the first length bytes of a message: CRC-32 xor 0x5354554e """
+    return zlib.crc32(memoryview(data)[:length]) ^ STUN_FINGERPRINT_XOR
+
+def check_fingerprint(data, nbytes):
+    """
+    Returns True/False whether the FINGERPRINT closing the message matches,
+    or None if the message does not end with a FINGERPRINT attribute.
+    """
+    if nbytes < 28:
+        return None
+    attr_type, attr_length, value = STUN_FINGERPRINT_ATTR.unpack_from(data, nbytes - 8)
+    if attr_type != STUN_ATTR_FINGERPRINT or attr_length != 4:
+        return None
+    return value == stun_fingerprint(data, nbytes - 8)
+
+def append_fingerprint(buffer, length):
+    """
+    Appends a FINGERPRINT attribute to the length byte message in buffer (which must have
+    8 spare bytes) and updates the header's message length. Returns the new length.
+    """
+    STUN_LENGTH.pack_into(buffer, 2, length + 8 - 20)
+    STUN_FINGERPRINT_ATTR.pack_into(buffer, length, STUN_ATTR_FINGERPRINT, 4, stun_fingerprint(buffer, length))
+    return length + 8
+
+def find_message_integrity(data, nbytes):
+    """
+    Returns the offset of the MESSAGE-INTEGRITY attribute, which must be the last attribute
+    or only be followed by FINGERPRINT, or None if the message has none.
+    """
+    offset = nbytes - STUN_MESSAGE_INTEGRITY_SIZE
+    if nbytes >= 28 + 8 and STUN_ATTR_HEADER.unpack_from(data, nbytes - 8) == (STUN_ATTR_FINGERPRINT, 4):
+        offset -= 8
+    if offset < 20 or STUN_ATTR_HEADER.unpack_from(data, offset) != (STUN_ATTR_MESSAGE_INTEGRITY, 20):
+        return None
+    return offset
+
+def message_integrity(data, offset, key_hmac):
+    """
+    HMAC-SHA1 of the message up to the MESSAGE-INTEGRITY attribute at offset, with the header
+    length covering that attribute (RFC 5389 15.4). key_hmac is a keyed hmac object that is cloned, not consumed.
+    """
+    view = memoryview(data)
+    h = key_hmac.copy()
+    h.update(view[:2])
+    h.update(STUN_LENGTH.pack(offset + STUN_MESSAGE_INTEGRITY_SIZE - 20))
+    h.update(view[4:offset])
+    return h.digest()
+
+def verify_message_integrity(data, offset, key_hmac):
+    return hmac.compare_digest(message_integrity(data, offset, key_hmac), bytes(memoryview(data)[offset + 4:offset + 24]))
+
+def append_message_integrity(buffer, length, key_hmac):
+    """
+    Appends MESSAGE-INTEGRITY to the length byte message in buffer (which must have 24 spare bytes)
+    and updates the header's message length. Returns the new length.
+    """
+    STUN_LENGTH.pack_into(buffer, 2, length + STUN_MESSAGE_INTEGRITY_SIZE - 20)
+    STUN_ATTR_HEADER.pack_into(buffer, length, STUN_ATTR_MESSAGE_INTEGRITY, 20)
+    buffer[length + 4:length + STUN_MESSAGE_INTEGRITY_SIZE] = message_integrity(buffer, length, key_hmac)
+    return length + STUN_MESSAGE_INTEGRITY_SIZE
+
+def encode_stun_attribute(attr_type, value):
+    return STUN_ATTR_HEADER.pack(attr_type, len(value)) + bytes(value) + b"\x00" * (-len(value) & 3)
+
+def encode_address_attribute(attr_type, address):
+    """ MAPPED-ADDRESS style (not xored) IPv4 attribute, as used by RESPONSE-ORIGIN and OTHER-ADDRESS """
+    ip, port = address
+    return STUN_ADDRESS_V4_ATTR.pack(attr_type, 8, 0x00, 0x01, port, socket.inet_aton(ip))
+
+def unmap_ipv4(ip):
+    """ The IPv4 address of a v4-mapped IPv6 address ('::ffff:1.2.3.4' -> '1.2.3.4'), any other ip unchanged """
+    if ip.startswith(IPV4_MAPPED_PREFIX) and '.' in ip:
+        return ip[7:]
+    return ip
+
+def encode_xor_address(address, transaction_id=None):
+    """
+    XOR-MAPPED-ADDRESS style value of an (ip, port) address. v4-mapped addresses are encoded as IPv4;
+    IPv6 addresses are xored with the magic cookie and the transaction_id of the message.
+    """
+    ip, port = address[:2]
+    ip = unmap_ipv4(ip)
+    if ':' in ip:
+        mask = int.from_bytes(STUN_MAGIC_COOKIE.to_bytes(4, 'big') + transaction_id, 'big')
+        xor_ip = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big') ^ mask
+        return STUN_XOR_ADDRESS_V6.pack(0x00, 0x02, port ^ (STUN_MAGIC_COOKIE >> 16), xor_ip.to_bytes(16, 'big'))
+    return STUN_XOR_ADDRESS_V4.pack(0x00, 0x01, port ^ (STUN_MAGIC_COOKIE >> 16),
+                                    int.from_bytes(socket.inet_aton(ip), 'big') ^ STUN_MAGIC_COOKIE)
+
+def decode_xor_address(value, transaction_id=None):
+    """
+    Returns the (ip, port) of an XOR-*-ADDRESS value, or None if it is not a well-formed address.
+    IPv6 addresses are only decoded with the transaction_id of the message.
+    """
+    if len(value) == 20 and transaction_id is not None:
+        _, family, xor_port, xor_ip = STUN_XOR_ADDRESS_V6.unpack(value)
+        if family != 0x02:
+            return None
+        mask = int.from_bytes(STUN_MAGIC_COOKIE.to_bytes(4, 'big') + transaction_id, 'big')
+        ip = (int.from_bytes(xor_ip, 'big') ^ mask).to_bytes(16, 'big')
+        return socket.inet_ntop(socket.AF_INET6, ip), xor_port ^ (STUN_MAGIC_COOKIE >> 16)
+    if len(value) != 8:
+        return None
+    _, family, xor_port, xor_ip = STUN_XOR_ADDRESS_V4.unpack(value)
+    if family != 0x01:
+        return None
+    return socket.inet_ntoa((xor_ip ^ STUN_MAGIC_COOKIE).to_bytes(4, 'big')), xor_port ^ (STUN_MAGIC_COOKIE >> 16)
+
+def encode_error_code(code, reason):
+    """ ERROR-CODE value: class (hundreds) and number, then a UTF-8 reason phrase """
+    return struct.pack('!HBB', 0, code // 100, code % 100) + reason.encode('utf-8')
+
+def decode_error_code(value):
+    """ Returns (code, reason) from an ERROR-CODE value """
+    _, error_class, number = struct.unpack_from('!HBB', value)
+    return (error_class & 0x07) * 100 + number, bytes(value[4:]).decode('utf-8', 'replace')
+
+def decode_software(value):
+    """ SOFTWARE is a UTF-8 description of at most 128 characters """
+    return bytes(value[:763]).decode('utf-8', 'replace')
+
+def create_stun_message(message_type, transaction_id, attributes=(), fingerprint=False, integrity_key=None):
+    """
+    Creates a STUN message from (type, value) attributes, optionally followed by MESSAGE-INTEGRITY
+    (keyed with the short-term password integrity_key) and closed by a FINGERPRINT.
+    """
+    body = b"".join(encode_stun_attribute(attr_type, value) for attr_type, value in attributes)
+    message = bytearray(struct.pack('!HHI12s', message_type, len(body), STUN_MAGIC_COOKIE, bytes(transaction_id)) + body)
+    if integrity_key is not None:
+        message += bytes(STUN_MESSAGE_INTEGRITY_SIZE)
+        append_message_integrity(message, len(message) - STUN_MESSAGE_INTEGRITY_SIZE, hmac.new(integrity_key, digestmod=hashlib.sha1))
+    if fingerprint:
+        message += bytes(8)
+        append_fingerprint(message, len(message) - 8)
+    return bytes(message)
+
+def create_stun_error_response(transaction_id, code, reason, unknown_attributes=(), software=SERVER_SOFTWARE, fingerprint=False,
+                               message_type=STUN_BINDING_ERROR_RESPONSE, attributes=()):
+    """
+    Creates a Binding Error Response (or another error response type) with ERROR-CODE (and UNKNOWN-ATTRIBUTES
+    for 420), followed by the given extra (type, value) attributes.
+    """
+    attributes = [(STUN_ATTR_ERROR_CODE, encode_error_code(code, reason))] + list(attributes)
+    if unknown_attributes:
+        attributes.append((STUN_ATTR_UNKNOWN_ATTRIBUTES, b"".join(struct.pack('!H', a) for a in unknown_attributes)))
+    if software:
+        attributes.append((STUN_ATTR_SOFTWARE, software.encode('utf-8')))
+    return create_stun_message(message_type, transaction_id, attributes, fingerprint)
+
+class ShortTermCredentials:
+    """
+    RFC 5389 short-term credentials for binding requests.
+
+    Passwords come from a static USERNAME -> password mapping, or are derived from a shared
+    secret the way TURN REST credentials are (username "<expiry unix time>:<user id>",
+    password base64(HMAC-SHA1(secret, username)), rejected once expired), so tokens can be
+    handed out by the backend without telling every STUN server about every user.
+    Passwords are used as UTF-8 without SASLprep.
+
+    Keying HMAC-SHA1 is the expensive part of a check, so a keyed hmac object is prepared once
+    per username and kept in an LRU cache of cache_size entries, together with the username's
+    expiry (checked again on every hit); each request is verified (and its response signed)
+    with a .copy() of the cached object.
+    """
+    def __init__(self, passwords=None, shared_secret=None, cache_size=4096):
+        if not passwords and not shared_secret:
+            raise ValueError("passwords or shared_secret is required")
+        self.passwords = passwords or {}
+        self.shared_secret = shared_secret.encode('utf-8') if isinstance(shared_secret, str) else shared_secret
+        self.cache_size = cache_size
+        self.keys = collections.OrderedDict()
+
+    def password_for(self, username):
+        password = self.passwords.get(username)
+        if password is not None:
+            return password.encode('utf-8')
+
+        if self.shared_secret:
+            expiry, _, user_id = username.partition(':')
+            if user_id and expiry.isdigit() and int(expiry) > time.time():
+                return base64.b64encode(hmac.new(self.shared_secret, username.encode('utf-8'), hashlib.sha1).digest())
+
+        return None
+
+    def key_for(self, username):
+        """ Returns the cached keyed hmac object for username, or None for an unknown/expired user """
+        cached = self.keys.get(username)
+        if cached is not None:
+            key_hmac, expiry = cached
+            if expiry is not None and expiry <= time.time():
+                del self.keys[username]
+                return None
+            self.keys.move_to_end(username)
+            return key_hmac
+
+        password = self.password_for(username)
+        if password is None:
+            return None
+
+        # static passwords never expire; password_for only accepts "<expiry>:<user>" otherwise
+        expiry = None if username in self.passwords else int(username.partition(':')[0])
+        key_hmac = hmac.new(password, digestmod=hashlib.sha1)
+        self.keys[username] = (key_hmac, expiry)
+        if len(self.keys) > self.cache_size:
+            self.keys.popitem(last=False)
+        return key_hmac
+
+    def check(self, data, nbytes, username):
+        """
+        Verifies the MESSAGE-INTEGRITY of a request carrying USERNAME username.
+        Returns (error code, key hmac): (0, key) when valid, (400, None) without MESSAGE-INTEGRITY,
+        (401, None) for an unknown user or a wrong MESSAGE-INTEGRITY.
+        """
+        offset = find_message_integrity(data, nbytes)
+        if username is None or offset is None:
+            return 400, None
+
+        key_hmac = self.key_for(bytes(username).decode('utf-8', 'replace'))
+        if key_hmac is None or not verify_message_integrity(data, offset, key_hmac):
+            return 401, None
+
+        return 0, key_hmac
+
+class TopTalkers:
+    """
+    Fixed-memory per-source request counts for spotting flooding sources.
+
+    A count-min sketch (depth rows of width counters, indexed by slices of one hash of the
+    (ip, port) source) estimates every source's count; the k sources with the highest estimate
+    are kept in a small table whose minimum is only recomputed when an entry is evicted.
+    Every decay_interval seconds all counts are halved, so estimates follow recent traffic.
+
+    To keep the hot path cheap only about one in sample_every packets (randomly spaced, so
+    periodic traffic patterns do not alias) updates the sketch; reported counts are scaled back up.
+    Sampled updates, decays and reads hold a lock: the UDP and stream threads share one sketch,
+    and /top reads it from the health check thread.
+    """
+    def __init__(self, width=4096, depth=4, k=64, decay_interval=60.0, sample_every=8):
+        self.width_bits = (width - 1).bit_length()
+        if depth * self.width_bits > 64:
+            raise ValueError("depth * log2(width) must fit in a 64 bit hash")
+        self.mask = (1 << self.width_bits) - 1
+        self.rows = [[0] * (1 << self.width_bits) for _ in range(depth)]
+        self.k = k
+        self.top = {}
+        self.threshold = 0
+        self.decay_interval = decay_interval
+        self.next_decay = time.monotonic() + decay_interval
+        self.updates = 0
+        self.sample_every = sample_every
+        self.countdown = 1
+        self.lock = threading.Lock()
+
+    def record(self, client_address):
+        self.countdown -= 1
+        if self.countdown:
+            return
+        self.countdown = random.randrange(1, 2 * self.sample_every) if self.sample_every > 1 else 1
+        with self.lock:
+            self.update(client_address)
+
+    def update(self, client_address):
+        h = hash(client_address)
+        mask = self.mask
+        bits = self.width_bits
+        estimate = -1
+        for row in self.rows:
+            i = h & mask
+            h >>= bits
+            count = row[i] + 1
+            row[i] = count
+            if estimate < 0 or count < estimate:
+                estimate = count
+
+        top = self.top
+        if client_address in top or len(top) < self.k:
+            top[client_address] = estimate
+        elif estimate > self.threshold:
+            victim = min(top, key=top.__getitem__)
+            if estimate > top[victim]:
+                del top[victim]
+                top[client_address] = estimate
+                self.threshold = min(top.values())
+            else:
+                self.threshold = top[victim]
+
+        self.updates += 1
+        if not self.updates & 0x3FF and time.monotonic() >= self.next_decay:
+            self.halve()
+
+    def decay(self):
+        with self.lock:
+            self.halve()
+
+    def halve(self):
+        self.rows = [[count >> 1 for count in row] for row in self.rows]
+        self.top = {source: count >> 1 for source, count in self.top.items() if count > 1}
+        self.threshold >>= 1
+        self.next_decay = time.monotonic() + self.decay_interval
+
+    def heaviest(self, n=10):
+        """ Returns the n sources with the highest estimated count in the current window """
+        with self.lock:
+            ranked = sorted(self.top.items(), key=lambda item: item[1], reverse=True)[:n]
+        return [{"source": f"[{ip}]:{port}" if ':' in ip else f"{ip}:{port}", "count": count * self.sample_every}
+                for (ip, port, *_), count in ranked]
+
+class SourceRateLimiter:
+    """
+    Per-source-IP token buckets (rate tokens per second, at most burst tokens) in a fixed-capacity,
+    array-backed, set-associative hash table: an IP hashes to one set of `ways` slots in parallel
+    lists, and a source that is not in its set replaces a slot chosen by a per-set CLOCK hand
+    (slots touched since the hand last passed get a second chance). Memory and per-packet work
+    stay bounded however many sources there are; an evicted source simply starts with a full bucket.
+    Not thread safe: each serving thread needs its own limiter.
+    """
+    def __init__(self, rate=20.0, burst=40.0, capacity=65536, ways=4):
+        sets = max(1, capacity // ways)
+        sets = 1 << (sets - 1).bit_length()
+        self.rate = rate
+        self.burst = burst
+        self.ways = ways
+        self.set_mask = sets - 1
+        self.keys = [None] * (sets * ways)
+        self.tokens = [0.0] * (sets * ways)
+        self.stamps = [0.0] * (sets * ways)
+        self.referenced = bytearray(sets * ways)
+        self.hands = bytearray(sets)
+        self.drops = 0
+
+    def allow(self, ip):
+        """ Takes a token from ip's bucket. Returns False (and counts a drop) when it is empty. """
+        now = time.monotonic()
+        set_index = hash(ip) & self.set_mask
+        base = set_index * self.ways
+        keys = self.keys
+
+        for slot in range(base, base + self.ways):
+            if keys[slot] == ip:
+                tokens = self.tokens[slot] + (now - self.stamps[slot]) * self.rate
+                if tokens > self.burst:
+                    tokens = self.burst
+                self.stamps[slot] = now
+                self.referenced[slot] = 1
+                if tokens >= 1.0:
+                    self.tokens[slot] = tokens - 1.0
+                    return True
+                self.tokens[slot] = tokens
+                self.drops += 1
+                return False
+
+        # miss: CLOCK eviction within the set
+        referenced = self.referenced
+        hand = self.hands[set_index]
+        while referenced[base + hand]:
+            referenced[base + hand] = 0
+            hand = (hand + 1) % self.ways
+        victim = base + hand
+        self.hands[set_index] = (hand + 1) % self.ways
+
+        keys[victim] = ip
+        self.tokens[victim] = self.burst - 1.0
+        self.stamps[victim] = now
+        referenced[victim] = 1
+        return True
+
+class BindingResponder:
+    """
+    Allocation-free binding response codec.
+
+    Requests are received into a reusable buffer (recvfrom_into) and answered from a
+    preallocated response buffer with a single precompiled pack_into; the transaction ID
+    is carried as two integers instead of being sliced out as bytes. The encoded XOR-MAPPED-ADDRESS
+    attribute only depends on the client (ip, port), so it is kept in an LRU cache of
+    mapped_cache_size entries (0 disables it): for repeat clients such as keepalives, the
+    pack_into splicing the transaction ID in front of the cached attribute is all the per-request work.
+    Client addresses of a dual-stack socket are (ip, port, flowinfo, scope_id): v4-mapped clients
+    get the same cached IPv4 attribute, IPv6 clients a 24 byte attribute whose address words are
+    cached xored with the magic cookie and only xored with the transaction ID per request.
+
+    Datagrams go through is_stun_message before anything is unpacked. Requests without
+    attributes (the common case) skip attribute parsing; otherwise the TLVs are walked, an
+    unknown comprehension-required attribute gets a 420 error response and, with
+    verify_fingerprint, a request whose FINGERPRINT does not match is dropped.
+    With fingerprint, responses are closed by a FINGERPRINT attribute.
+
+    With credentials (ShortTermCredentials), every binding request must carry USERNAME and a
+    valid MESSAGE-INTEGRITY (otherwise 400/401 error responses), and binding responses are signed
+    with MESSAGE-INTEGRITY using the same key.
+
+    With nat_addresses, the responder serves RFC 5780 NAT behavior discovery: a list of the four
+    local (ip, port) addresses [primary, alternate port, alternate ip, alternate ip and port].
+    pack_response_into is then told which of them received the request (local_index), honors
+    CHANGE-REQUEST, adds RESPONSE-ORIGIN and OTHER-ADDRESS to binding responses and leaves the
+    index of the address to answer from in send_index.
+
+    With top_talkers (TopTalkers), every datagram's source is recorded before it is parsed;
+    with rate_limiter (SourceRateLimiter), datagrams over their source's rate are dropped
+    before they are parsed. Drops are counted in counters (PacketCounters).
+    """
+    def __init__(self, buffer_size=1024, mapped_cache_size=65536, top_talkers=None, rate_limiter=None, counters=None,
+                 fingerprint=False, verify_fingerprint=False, credentials=None, nat_addresses=None):
+        self.recv_buffer = bytearray(buffer_size)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.send_buffer = bytearray(STUN_MAX_RESPONSE_SIZE)
+        self.send_view = memoryview(self.send_buffer)
+        self.fingerprint = fingerprint
+        self.verify_fingerprint = verify_fingerprint
+        self.credentials = credentials
+        self.nat_addresses = nat_addresses
+        self.send_index = 0
+        if nat_addresses is not None:
+            # index bit 1: alternate ip, bit 0: alternate port, so CHANGE-REQUEST flags >> 1 flip the right bits
+            self.origin_attributes = [encode_address_attribute(STUN_ATTR_RESPONSE_ORIGIN, address) for address in nat_addresses]
+            self.other_attributes = [encode_address_attribute(STUN_ATTR_OTHER_ADDRESS, nat_addresses[index ^ 3])
+                                     for index in range(4)]
+        self.response_size = (STUN_BINDING_RESPONSE_V4_SIZE
+                              + (24 if nat_addresses is not None else 0)
+                              + (STUN_MESSAGE_INTEGRITY_SIZE if credentials is not None else 0)
+                              + (8 if fingerprint else 0))
+        self.response_view = self.send_view[:self.response_size]
+        self.mapped_cache_size = mapped_cache_size
+        self.mapped_cache = collections.OrderedDict()
+        self.top_talkers = top_talkers
+        self.rate_limiter = rate_limiter
+        self.counters = counters or PacketCounters()
+
+    def build_response(self, data, nbytes, client_address, local_index=0):
+        """
+        Returns a memoryview of the response for the request in data[:nbytes], or None if
+        there is nothing to answer. The view is only valid until the next call.
+        """
+        length = self.pack_response_into(self.send_buffer, data, nbytes, client_address, local_index)
+        if length == self.response_size:
+            return self.response_view
+        return self.send_view[:length] if length else None
+
+    def pack_response_into(self, out, data, nbytes, client_address, local_index=0):
+        """
+        Packs the response for the request in data[:nbytes] into out (at least
+        STUN_MAX_RESPONSE_SIZE bytes) and returns its length: response_size for a binding
+        response (12 bytes more for an IPv6 client), another length for an error response,
+        0 (drop counted) for no response.
+        local_index is the nat_addresses index the request was received on (NAT behavior discovery only).
+        """
+        self.send_index = local_index
+
+        if self.top_talkers is not None:
+            self.top_talkers.record(client_address)
+
+        if self.rate_limiter is not None and not self.rate_limiter.allow(client_address[0]):
+            self.counters.rate_limited_drops += 1
+            return 0
+
+        if nbytes < 20 or nbytes & 3 or data[0] & 0xC0:
+            self.counters.malformed_drops += 1
+            return 0
+
+        method, message_length, magic_cookie, transaction_hi, transaction_lo = STUN_HEADER.unpack_from(data, 0)
+        if magic_cookie != STUN_MAGIC_COOKIE or message_length + 20 != nbytes:
+            self.counters.malformed_drops += 1
+            return 0
+
+        if method != STUN_BINDING_REQUEST:
+            self.counters.unknown_method_drops += 1
+            return 0
+
+        key_hmac = None
+        change_request = 0
+        if message_length:
+            length, key_hmac, change_request = self.check_attributes(out, data, nbytes)
+            if length >= 0:
+                return length
+        elif self.credentials is not None:
+            return self.pack_error_into(out, data, 400, "Bad Request")
+
+        mapped_cache = self.mapped_cache
+        mapped = mapped_cache.get(client_address)
+        if mapped is None:
+            self.counters.mapped_cache_misses += 1
+            mapped = self.encode_mapped_address(client_address)
+        else:
+            self.counters.mapped_cache_hits += 1
+            mapped_cache.move_to_end(client_address)
+
+        if mapped.__class__ is bytes:
+            STUN_BINDING_RESPONSE_V4.pack_into(out, 0, STUN_BINDING_RESPONSE, 12, STUN_MAGIC_COOKIE, transaction_hi, transaction_lo, mapped)
+            length = STUN_BINDING_RESPONSE_V4_SIZE
+        else:
+            xor_port, xor_ip_hi, ip_mid, ip_lo = mapped
+            STUN_BINDING_RESPONSE_V6.pack_into(out, 0, STUN_BINDING_RESPONSE, 24, STUN_MAGIC_COOKIE, transaction_hi, transaction_lo,
+                                               STUN_ATTR_XOR_MAPPED_ADDRESS, 20, 0x00, 0x02, xor_port,
+                                               xor_ip_hi, ip_mid ^ transaction_hi, ip_lo ^ transaction_lo)
+            length = STUN_BINDING_RESPONSE_V6_SIZE
+
+        if self.nat_addresses is not None:
+            send_index = self.send_index = local_index ^ (change_request >> 1 & 3)
+            out[length:length + 12] = self.origin_attributes[send_index]
+            out[length + 12:length + 24] = self.other_attributes[local_index]
+            length += 24
+            STUN_LENGTH.pack_into(out, 2, length - 20)
+        if key_hmac is not None:
+            length = append_message_integrity(out, length, key_hmac)
+        if self.fingerprint:
+            length = append_fingerprint(out, length)
+        return length
+
+    def encode_mapped_address(self, client_address):
+        """
+        Encodes the XOR-MAPPED-ADDRESS of client_address and keeps it in the LRU mapped_cache: the
+        attribute bytes for IPv4 (and v4-mapped) clients, (xored port, xored first address word,
+        second and third address words) for IPv6 clients.
+        """
+        ip, port = client_address[:2]
+        ip = unmap_ipv4(ip)
+        if ':' in ip:
+            address = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+            mapped = (port ^ (STUN_MAGIC_COOKIE >> 16), (address >> 96) ^ STUN_MAGIC_COOKIE,
+                      address >> 32 & 0xFFFFFFFFFFFFFFFF, address & 0xFFFFFFFF)
+        else:
+            mapped = STUN_XOR_MAPPED_ADDRESS_V4.pack(STUN_ATTR_XOR_MAPPED_ADDRESS, 8, 0x00, 0x01,
+                                                     port ^ (STUN_MAGIC_COOKIE >> 16),
+                                                     int.from_bytes(socket.inet_aton(ip), 'big') ^ STUN_MAGIC_COOKIE)
+        if self.mapped_cache_size:
+            self.mapped_cache[client_address] = mapped
+            if len(self.mapped_cache) > self.mapped_cache_size:
+                self.mapped_cache.popitem(last=False)
+        return mapped
+
+    def check_attributes(self, out, data, nbytes):
+        """
+        Attribute checks of a binding request that carries attributes. Returns (length, key hmac,
+        CHANGE-REQUEST flags): length -1 to go on with the binding response (signed with key hmac,
+        if any), 0 to drop the request, or the length of an error response packed into out.
+        CHANGE-REQUEST is only understood with nat_addresses (420 Unknown Attribute otherwise).
+        """
+        if self.verify_fingerprint and check_fingerprint(data, nbytes) is False:
+            self.counters.malformed_drops += 1
+            return 0, None, 0
+
+        username = None
+        change_request = 0
+        unknown = []
+        try:
+            for attr_type, value in iter_stun_attributes(data, nbytes):
+                if attr_type == STUN_ATTR_USERNAME:
+                    username = value
+                elif attr_type == STUN_ATTR_CHANGE_REQUEST and self.nat_addresses is not None and len(value) == 4:
+                    change_request, = STUN_CHANGE_REQUEST.unpack(value)
+                elif attr_type < 0x8000 and attr_type not in STUN_KNOWN_ATTRIBUTES:
+                    unknown.append(attr_type)
+        except ValueError:
+            self.counters.malformed_drops += 1
+            return 0, None, 0
+
+        if unknown:
+            return self.pack_error_into(out, data, 420, "Unknown Attribute", unknown[:32]), None, 0
+
+        if self.credentials is None:
+            return -1, None, change_request
+
+        error, key_hmac = self.credentials.check(data, nbytes, username)
+        if error == 400:
+            return self.pack_error_into(out, data, 400, "Bad Request"), None, 0
+        if error == 401:
+            return self.pack_error_into(out, data, 401, "Unauthorized"), None, 0
+        return -1, key_hmac, change_request
+
+    def pack_error_into(self, out, data, code, reason, unknown_attributes=()):
+        response = create_stun_error_response(bytes(memoryview(data)[8:20]), code, reason,
+                                              unknown_attributes, fingerprint=self.fingerprint)
+        out[:len(response)] = response
+        self.counters.error_responses += 1
+        return len(response)
+
+class PacketCounters:
+    """
+    Counters of one UDP loop. Only the owning loop writes them (no locks);
+    scrapes read them through ServerMetrics.
+    """
+    __slots__ = COUNTER_NAMES
+
+    def __init__(self):
+        for name in COUNTER_NAMES:
+            setattr(self, name, 0)
+
+    def snapshot(self):
+        return [getattr(self, name) for name in COUNTER_NAMES]
+
+def handle_stun_request_fast(server_socket, responder=None, counters=None):
+    """
+    Handles incoming STUN requests with BindingResponder: no per-packet allocation of
+    request/response bytes and no per-packet printing.
+    """
+    counters = counters or PacketCounters()
+    responder = responder or BindingResponder(counters=counters)
+    recv_buffer = responder.recv_buffer
+    build_response = responder.build_response
+    recvfrom_into = server_socket.recvfrom_into
+    sendto = server_socket.sendto
+
+    hot_restart = HOT_RESTART
+    while not hot_restart.draining:
+        nbytes, client_address = recvfrom_into(recv_buffer)
+        counters.packets_received += 1
+        response = build_response(recv_buffer, nbytes, client_address)
+
+        if response is not None:
+            sendto(response, client_address)
+            if response[1] == STUN_BINDING_RESPONSE_LOW:  # error responses count as error_responses
+                counters.binding_responses_sent += 1
+
+class LatencyHistogram:
+    """
+    HDR-style log-bucketed histogram of nanosecond values held in a fixed-size list.
+
+    Values below 2**sub_bucket_bits are counted exactly; above that every power of two is split
+    into 2**(sub_bucket_bits - 1) linear sub-buckets, so the relative error stays under
+    1 / 2**(sub_bucket_bits - 1) (about 3% with the default 6 bits). Values above 2**max_bits are clamped.
+    """
+    def __init__(self, sub_bucket_bits=6, max_bits=40):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.sub_bucket_half = self.sub_bucket_count >> 1
+        self.max_value = (1 << max_bits) - 1
+        self.counts = [0] * self.bucket_index(self.max_value) + [0]
+        self.total = 0
+        self.max = 0
+
+    def bucket_index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return self.sub_bucket_count + (shift - 1) * self.sub_bucket_half + (value >> shift) - self.sub_bucket_half
+
+    def bucket_upper_bound(self, index):
+        if index < self.sub_bucket_count:
+            return index
+        shift, sub_bucket = divmod(index - self.sub_bucket_count, self.sub_bucket_half)
+        shift += 1
+        return ((sub_bucket + self.sub_bucket_half + 1) << shift) - 1
+
+    def record(self, value):
+        if value < 0:
+            value = 0  # clock adjustments between kernel and user space timestamps
+        elif value > self.max_value:
+            value = self.max_value
+        self.counts[self.bucket_index(value)] += 1
+        self.total += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Adds the counts of other, a histogram with the same layout (e.g. from another process) """
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """ Returns the (upper bound of the) value at percentile q (0-100) """
+        if not self.total:
+            return 0
+        rank = max(1, int(self.total * q / 100 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bucket_upper_bound(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.total,
+            "p50_us": self.percentile(50) / 1000,
+            "p99_us": self.percentile(99) / 1000,
+            "p999_us": self.percentile(99.9) / 1000,
+            "max_us": self.max / 1000,
+        }
+
+def enable_receive_timestamps(server_socket):
+    """ Asks the kernel to attach the receive time (SCM_TIMESTAMPNS) to every datagram """
+    server_socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+
+def enable_overflow_counter(server_socket):
+    """ Asks the kernel to attach the socket's receive queue drop count (SO_RXQ_OVFL) to datagrams """
+    server_socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+
+def read_ancillary(ancdata, counters):
+    """
+    Returns the SCM_TIMESTAMPNS receive time (ns, CLOCK_REALTIME) from recvmsg ancillary data, or 0.
+    An SO_RXQ_OVFL drop count, if present, is stored in counters.socket_overflow_drops.
+    """
+    received_ns = 0
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET:
+            if kind == SCM_TIMESTAMPNS:
+                tv_sec, tv_nsec = TIMESPEC.unpack_from(data)
+                received_ns = tv_sec * 1000000000 + tv_nsec
+            elif kind == SO_RXQ_OVFL:
+                counters.socket_overflow_drops = RXQ_OVFL.unpack_from(data)[0]
+    return received_ns
+
+def handle_stun_request_timestamped(server_socket, histogram, responder=None, counters=None):
+    """
+    Like handle_stun_request_fast, but receives with recvmsg_into and records the kernel
+    receive-to-send latency (socket queueing + service time) of every binding response.
+    """
+    counters = counters or PacketCounters()
+    enable_receive_timestamps(server_socket)
+    enable_overflow_counter(server_socket)
+    responder = responder or BindingResponder(counters=counters)
+    recv_buffer = responder.recv_buffer
+    recv_slot = [responder.recv_view]
+    build_response = responder.build_response
+    recvmsg_into = server_socket.recvmsg_into
+    sendto = server_socket.sendto
+    record = histogram.record
+    ancbufsize = TIMESTAMP_ANCBUFSIZE + RXQ_OVFL_ANCBUFSIZE
+
+    hot_restart = HOT_RESTART
+    while not hot_restart.draining:
+        nbytes, ancdata, msg_flags, client_address = recvmsg_into(recv_slot, ancbufsize)
+        counters.packets_received += 1
+        response = build_response(recv_buffer, nbytes, client_address)
+
+        if response is not None:
+            sendto(response, client_address)
+            if response[1] == STUN_BINDING_RESPONSE_LOW:  # error responses count as error_responses
+                counters.binding_responses_sent += 1
+            received_ns = read_ancillary(ancdata, counters)
+            if received_ns:
+                record(time.time_ns() - received_ns)
+        elif ancdata:
+            read_ancillary(ancdata, counters)
+
+class BatchStats:
+    """
+    Batch-size statistics for handle_stun_request_batched.
+    histogram[n] counts drains that picked up n packets (n <= batch_size).
+    """
+    def __init__(self, batch_size):
+        self.histogram = [0] * (batch_size + 1)
+        self.batches = 0
+        self.packets = 0
+        self.responses = 0
+        self.send_drops = 0
+
+    def record(self, received, sent, dropped):
+        self.histogram[received] += 1
+        self.batches += 1
+        self.packets += received
+        self.responses += sent
+        self.send_drops += dropped
+
+    def summary(self):
+        largest = max((n for n, count in enumerate(self.histogram) if count), default=0)
+        return {
+            "batches": self.batches,
+            "packets": self.packets,
+            "responses": self.responses,
+            "send_drops": self.send_drops,
+            "mean_batch_size": self.packets / self.batches if self.batches else 0.0,
+            "max_batch_size": largest,
+            "full_batches": self.histogram[-1],
+        }
+
+def handle_stun_request_batched(server_socket, batch_size=64, stats=None, histogram=None, responder=None, counters=None):
+    """
+    Handles incoming STUN requests in batches: waits until the socket is readable, drains up to
+    batch_size datagrams with non-blocking recvmsg_into into a ring of preallocated buffers,
+    builds all the responses, then flushes them in one tight send loop.
+    With a LatencyHistogram, kernel receive-to-send latency is recorded for every response.
+    """
+    stats = stats or BatchStats(batch_size)
+    counters = counters or PacketCounters()
+    responder = responder or BindingResponder(counters=counters)
+    recv_buffers = [bytearray(1024) for _ in range(batch_size)]
+    recv_slots = [[memoryview(buffer)] for buffer in recv_buffers]
+    send_buffers = [bytearray(STUN_MAX_RESPONSE_SIZE) for _ in range(batch_size)]
+    send_views = [memoryview(buffer) for buffer in send_buffers]
+    response_views = [view[:responder.response_size] for view in send_views]
+    response_size = responder.response_size
+    addresses = [None] * batch_size
+    lengths = [0] * batch_size
+    received_at = [0] * batch_size
+
+    enable_overflow_counter(server_socket)
+    ancbufsize = RXQ_OVFL_ANCBUFSIZE
+    if histogram is not None:
+        enable_receive_timestamps(server_socket)
+        ancbufsize += TIMESTAMP_ANCBUFSIZE
+
+    server_socket.setblocking(False)
+    poller = select.poll()
+    poller.register(server_socket, select.POLLIN)
+
+    recvmsg_into = server_socket.recvmsg_into
+    sendto = server_socket.sendto
+    pack_response_into = responder.pack_response_into
+
+    hot_restart = HOT_RESTART
+    while not hot_restart.draining:
+        poller.poll()
+
+        received = 0
+        while received < batch_size:
+            try:
+                nbytes, ancdata, msg_flags, client_address = recvmsg_into(recv_slots[received], ancbufsize)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionRefusedError:
+                continue  # ICMP port unreachable from an earlier send
+            received_at[received] = read_ancillary(ancdata, counters) if ancdata else 0
+            addresses[received] = client_address
+            lengths[received] = pack_response_into(send_buffers[received], recv_buffers[received], nbytes, client_address)
+            received += 1
+
+        sent = succeeded = dropped = 0
+        for i in range(received):
+            length = lengths[i]
+            if length:
+                try:
+                    sendto(response_views[i] if length == response_size else send_views[i][:length], addresses[i])
+                    sent += 1
+                    if send_buffers[i][1] == STUN_BINDING_RESPONSE_LOW:
+                        succeeded += 1
+                    if histogram is not None and received_at[i]:
+                        histogram.record(time.time_ns() - received_at[i])
+                except (BlockingIOError, ConnectionRefusedError):
+                    dropped += 1
+
+        stats.record(received, sent, dropped)
+        counters.packets_received += received
+        counters.binding_responses_sent += succeeded  # error responses count as error_responses
+        counters.send_drops += dropped
+
+def handle_stun_request_nat_behavior(server_sockets, responder, counters=None):
+    """
+    Handles incoming STUN requests on the four sockets of RFC 5780 NAT behavior discovery
+    (ordered like responder.nat_addresses) from a single poll loop. Every response is sent
+    from the socket picked by the request's CHANGE-REQUEST (responder.send_index).
+    """
+    counters = counters or PacketCounters()
+    recv_buffer = responder.recv_buffer
+    build_response = responder.build_response
+    sockets_by_fd = {}
+    poller = select.poll()
+    for index, server_socket in enumerate(server_sockets):
+        server_socket.setblocking(False)
+        poller.register(server_socket, select.POLLIN)
+        sockets_by_fd[server_socket.fileno()] = (index, server_socket.recvfrom_into)
+    sendtos = [server_socket.sendto for server_socket in server_sockets]
+
+    hot_restart = HOT_RESTART
+    while not hot_restart.draining:
+        for fd, _ in poller.poll():
+            index, recvfrom_into = sockets_by_fd[fd]
+            while True:
+                try:
+                    nbytes, client_address = recvfrom_into(recv_buffer)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except ConnectionRefusedError:
+                    continue  # ICMP port unreachable from an earlier send
+                counters.packets_received += 1
+                response = build_response(recv_buffer, nbytes, client_address, index)
+
+                if response is not None:
+                    try:
+                        sendtos[responder.send_index](response, client_address)
+                        if response[1] == STUN_BINDING_RESPONSE_LOW:
+                            counters.binding_responses_sent += 1
+                    except (BlockingIOError, ConnectionRefusedError):
+                        counters.send_drops += 1
+
+def handle_stun_request(server_socket, counters=None, top_talkers=None, rate_limiter=None):
     """
     Handles incoming STUN requests.
     """
-    while True:
+    counters = counters or PacketCounters()
+    hot_restart = HOT_RESTART
+    while not hot_restart.draining:
         data, client_address = server_socket.recvfrom(1024)
+        counters.packets_received += 1
+        if top_talkers is not None:
+            top_talkers.record(client_address)
+        if rate_limiter is not None and not rate_limiter.allow(client_address[0]):
+            counters.rate_limited_drops += 1
+            continue
+        if not is_stun_message(data, len(data)):
+            counters.malformed_drops += 1
+            continue
         method, message_length, magic_cookie, transaction_id, attributes = parse_stun_message(data)
         
         if method == STUN_BINDING_REQUEST:
             print(f"Received Binding Request from {client_address}")
             response = create_stun_binding_response(transaction_id, client_address[0], client_address[1])
             server_socket.sendto(response, client_address)
+            counters.binding_responses_sent += 1
             print(f"Sent Binding Response to {client_address}")
+        elif method is None:
+            counters.malformed_drops += 1
         else:
+            counters.unknown_method_drops += 1
             print(f"Received unknown method {method} from {client_address}")
 
+# Comprehension-required attributes understood by TurnServer requests
+TURN_KNOWN_ATTRIBUTES = STUN_KNOWN_ATTRIBUTES | {
+    STUN_ATTR_CHANNEL_NUMBER,
+    STUN_ATTR_LIFETIME,
+    STUN_ATTR_XOR_PEER_ADDRESS,
+    STUN_ATTR_DATA,
+    STUN_ATTR_REQUESTED_TRANSPORT,
+}
+
+class TurnAllocation:
+    """
+    One TURN allocation: the relay socket of a client 5-tuple, its permissions (peer ip -> expiry)
+    and its channel table (channel number <-> peer address).
+    """
+    __slots__ = ('client_address', 'relay_socket', 'relay_address', 'sendto', 'expires', 'transaction_id', 'key',
+                 'permissions', 'channels', 'peer_channels', 'channel_expires')
+
+    def __init__(self, client_address, relay_socket, relay_address, transaction_id, key):
+        self.client_address = client_address
+        self.relay_socket = relay_socket
+        self.relay_address = relay_address
+        self.sendto = relay_socket.sendto
+        self.expires = 0.0
+        self.transaction_id = transaction_id
+        self.key = key
+        self.permissions = {}
+        self.channels = {}
+        self.peer_channels = {}
+        self.channel_expires = {}
+
+class TurnStats:
+    """ Relay counters for GET /stats; only the TurnServer loop writes them """
+    def __init__(self, server):
+        self.server = server
+        self.client_packets = 0
+        self.client_bytes = 0
+        self.peer_packets = 0
+        self.peer_bytes = 0
+        self.relay_drops = 0
+        self.error_responses = 0
+
+    def summary(self):
+        return {
+            "allocations": len(self.server.allocations),
+            "client_to_peer_packets": self.client_packets,
+            "client_to_peer_bytes": self.client_bytes,
+            "peer_to_client_packets": self.peer_packets,
+            "peer_to_client_bytes": self.peer_bytes,
+            "relay_drops": self.relay_drops,
+            "error_responses": self.error_responses,
+        }
+
+class TurnServer:
+    """
+    Minimal TURN (RFC 5766) relay over UDP: Allocate, Refresh, CreatePermission and ChannelBind
+    requests, Send/Data indications and ChannelData, served from a single poll loop over the
+    control socket and every allocation's relay socket.
+
+    The data path allocates nothing per packet: datagrams are received with recvfrom_into into
+    preallocated buffers and forwarded as memoryview slices of them. Peer datagrams are received
+    TURN_DATA_INDICATION_V4_SIZE bytes into their buffer, so the ChannelData header (or the Data
+    indication header) is packed in place in front of the payload.
+
+    Relay sockets are bound to relay_host and advertised as relay_ip. With credentials
+    (ShortTermCredentials, used as the password source), requests need long-term credentials
+    (USERNAME, REALM, NONCE, MESSAGE-INTEGRITY keyed with MD5(username:realm:password)) and are
+    challenged with 401 + REALM + NONCE otherwise. Without them the relay is open to anyone.
+    Binding requests on the control socket are answered by responder (a BindingResponder).
+    """
+    def __init__(self, control_socket, relay_host, relay_ip=None, credentials=None, realm="broadwayinc",
+                 fingerprint=False, responder=None, max_allocations=10000):
+        self.control_socket = control_socket
+        self.relay_host = relay_host
+        self.relay_ip = relay_ip or relay_host
+        self.credentials = credentials
+        self.realm = realm.encode('utf-8')
+        self.nonce = os.urandom(12).hex().encode('ascii')
+        self.fingerprint = fingerprint
+        self.responder = responder or BindingResponder(fingerprint=fingerprint)
+        self.max_allocations = max_allocations
+        self.allocations = {}
+        self.allocations_by_fd = {}
+        self.stats = TurnStats(self)
+        self.xor_ip_cache = {}
+        self.indication_id = random.getrandbits(64)
+
+        self.recv_buffer = bytearray(65536)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.peer_buffer = bytearray(65536)
+        self.peer_view = memoryview(self.peer_buffer)
+        self.peer_payload_view = self.peer_view[TURN_DATA_INDICATION_V4_SIZE:65507]
+        self.poller = select.poll()
+
+    def serve_forever(self, sweep_interval=1.0):
+        control_fd = self.control_socket.fileno()
+        self.control_socket.setblocking(False)
+        self.poller.register(self.control_socket, select.POLLIN)
+        next_sweep = time.monotonic() + sweep_interval
+
+        while True:
+            events = self.poller.poll(sweep_interval * 1000)
+            now = time.monotonic()
+            for fd, _ in events:
+                if fd == control_fd:
+                    self.drain_control(now)
+                else:
+                    allocation = self.allocations_by_fd.get(fd)
+                    if allocation is not None:
+                        self.drain_relay(allocation, now)
+            if now >= next_sweep:
+                self.expire(now)
+                next_sweep = now + sweep_interval
+
+    def drain_control(self, now):
+        """ Handles every datagram queued on the control socket: ChannelData inline, STUN messages in handle_message """
+        recv_buffer = self.recv_buffer
+        recv_view = self.recv_view
+        recvfrom_into = self.control_socket.recvfrom_into
+        allocations = self.allocations
+        stats = self.stats
+
+        while True:
+            try:
+                nbytes, client_address = recvfrom_into(recv_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                continue  # ICMP port unreachable from an earlier send
+
+            if nbytes >= 4 and recv_buffer[0] & 0xC0 == 0x40:
+                channel, length = TURN_CHANNEL_DATA.unpack_from(recv_buffer, 0)
+                allocation = allocations.get(client_address)
+                peer = allocation.channels.get(channel) if allocation is not None else None
+                if peer is None or length + 4 > nbytes or allocation.permissions.get(peer[0], 0) <= now:
+                    stats.relay_drops += 1
+                    continue
+                try:
+                    allocation.sendto(recv_view[4:4 + length], peer)
+                    stats.client_packets += 1
+                    stats.client_bytes += length
+                except OSError:
+                    stats.relay_drops += 1
+            else:
+                self.handle_message(recv_view, nbytes, client_address, now)
+
+    def drain_relay(self, allocation, now):
+        """ Relays every datagram queued on a relay socket to the client, as ChannelData or a Data indication """
+        peer_buffer = self.peer_buffer
+        peer_view = self.peer_view
+        recvfrom_into = allocation.relay_socket.recvfrom_into
+        payload_view = self.peer_payload_view
+        permissions = allocation.permissions
+        peer_channels = allocation.peer_channels
+        client_address = allocation.client_address
+        sendto = self.control_socket.sendto
+        stats = self.stats
+
+        while True:
+            try:
+                nbytes, peer = recvfrom_into(payload_view)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                continue
+
+            if permissions.get(peer[0], 0) <= now:
+                stats.relay_drops += 1
+                continue
+
+            channel = peer_channels.get(peer)
+            if channel is not None:
+                TURN_CHANNEL_DATA.pack_into(peer_buffer, TURN_DATA_INDICATION_V4_SIZE - 4, channel, nbytes)
+                message = peer_view[TURN_DATA_INDICATION_V4_SIZE - 4:TURN_DATA_INDICATION_V4_SIZE + nbytes]
+            else:
+                message = self.pack_data_indication(peer, nbytes)
+
+            try:
+                sendto(message, client_address)
+                stats.peer_packets += 1
+                stats.peer_bytes += nbytes
+            except OSError:
+                stats.relay_drops += 1
+
+    def pack_data_indication(self, peer, nbytes):
+        """ Packs a Data indication around the nbytes payload already in peer_buffer and returns its view """
+        ip, port = peer
+        xor_ip = self.xor_ip_cache.get(ip)
+        if xor_ip is None:
+            if len(self.xor_ip_cache) >= 65536:
+                self.xor_ip_cache.clear()
+            xor_ip = self.xor_ip_cache[ip] = int.from_bytes(socket.inet_aton(ip), 'big') ^ STUN_MAGIC_COOKIE
+
+        padding = -nbytes & 3
+        end = TURN_DATA_INDICATION_V4_SIZE + nbytes
+        self.peer_buffer[end:end + padding] = b"\x00" * padding
+        self.indication_id = (self.indication_id + 1) & 0xFFFFFFFFFFFFFFFF
+        TURN_DATA_INDICATION_V4.pack_into(self.peer_buffer, 0,
+                                          TURN_DATA | STUN_CLASS_INDICATION,
+                                          end + padding - 20,
+                                          STUN_MAGIC_COOKIE,
+                                          self.indication_id,
+                                          0,
+                                          STUN_ATTR_XOR_PEER_ADDRESS,
+                                          8,
+                                          0x00,
+                                          0x01,
+                                          port ^ (STUN_MAGIC_COOKIE >> 16),
+                                          xor_ip,
+                                          STUN_ATTR_DATA,
+                                          nbytes)
+        return self.peer_view[:end + padding]
+
+    def handle_message(self, view, nbytes, client_address, now):
+        """ Control plane: binding requests, Send indications and TURN requests on the control socket """
+        if not is_stun_message(view, nbytes):
+            self.stats.relay_drops += 1
+            return
+
+        message_type, = STUN_LENGTH.unpack_from(view, 0)
+        if message_type == STUN_BINDING_REQUEST:
+            length = self.responder.pack_response_into(self.responder.send_buffer, view, nbytes, client_address)
+            if length:
+                self.control_socket.sendto(self.responder.send_view[:length], client_address)
+            return
+
+        method = message_type & 0x3EEF
+        message_class = message_type & 0x0110
+        try:
+            attributes = list(iter_stun_attributes(view, nbytes))
+        except ValueError:
+            self.stats.relay_drops += 1
+            return
+
+        if message_class == STUN_CLASS_INDICATION:
+            if method == TURN_SEND:
+                self.handle_send(attributes, client_address, now)
+            return
+        if message_class != STUN_CLASS_REQUEST:
+            return
+
+        transaction_id = bytes(view[8:20])
+        unknown = [attr_type for attr_type, _ in attributes if attr_type < 0x8000 and attr_type not in TURN_KNOWN_ATTRIBUTES]
+        if unknown:
+            return self.send_error(method, transaction_id, client_address, 420, "Unknown Attribute", unknown_attributes=unknown[:32])
+
+        key = None
+        if self.credentials is not None:
+            key = self.authenticate(view, nbytes, method, transaction_id, attributes, client_address)
+            if key is None:
+                return
+
+        values = {}
+        peers = []
+        for attr_type, value in attributes:
+            if attr_type == STUN_ATTR_XOR_PEER_ADDRESS:
+                peers.append(decode_xor_address(value))
+            values.setdefault(attr_type, value)
+
+        if method == TURN_ALLOCATE:
+            self.allocate(values, transaction_id, client_address, key, now)
+            return
+
+        allocation = self.allocations.get(client_address)
+        if method not in (TURN_REFRESH, TURN_CREATE_PERMISSION, TURN_CHANNEL_BIND):
+            return self.send_error(method, transaction_id, client_address, 400, "Bad Request")
+        if allocation is None:
+            return self.send_error(method, transaction_id, client_address, 437, "Allocation Mismatch")
+
+        if method == TURN_REFRESH:
+            lifetime = self.requested_lifetime(values)
+            if lifetime == 0:
+                self.release(allocation)
+            else:
+                allocation.expires = now + lifetime
+            return self.send_success(method, transaction_id, client_address, key,
+                                     [(STUN_ATTR_LIFETIME, struct.pack('!I', lifetime))])
+
+        if not peers:
+            return self.send_error(method, transaction_id, client_address, 400, "Bad Request")
+        if None in peers:
+            return self.send_error(method, transaction_id, client_address, 440, "Address Family not Supported")
+
+        if method == TURN_CREATE_PERMISSION:
+            for peer in peers:
+                allocation.permissions[peer[0]] = now + TURN_PERMISSION_LIFETIME
+            return self.send_success(method, transaction_id, client_address, key)
+
+        channel_value = values.get(STUN_ATTR_CHANNEL_NUMBER)
+        channel = struct.unpack_from('!H', channel_value)[0] if channel_value is not None and len(channel_value) == 4 else 0
+        peer = peers[0]
+        if (not 0x4000 <= channel <= 0x7FFF
+                or allocation.channels.get(channel, peer) != peer
+                or allocation.peer_channels.get(peer, channel) != channel):
+            return self.send_error(method, transaction_id, client_address, 400, "Bad Request")
+
+        allocation.channels[channel] = peer
+        allocation.peer_channels[peer] = channel
+        allocation.channel_expires[channel] = now + TURN_CHANNEL_LIFETIME
+        allocation.permissions[peer[0]] = now + TURN_PERMISSION_LIFETIME
+        self.send_success(method, transaction_id, client_address, key)
+
+    def handle_send(self, attributes, client_address, now):
+        allocation = self.allocations.get(client_address)
+        if allocation is None:
+            return
+        peer = data = None
+        for attr_type, value in attributes:
+            if attr_type == STUN_ATTR_XOR_PEER_ADDRESS and peer is None:
+                peer = decode_xor_address(value)
+            elif attr_type == STUN_ATTR_DATA and data is None:
+                data = value
+        if peer is None or data is None or allocation.permissions.get(peer[0], 0) <= now:
+            self.stats.relay_drops += 1
+            return
+        try:
+            allocation.sendto(data, peer)
+            self.stats.client_packets += 1
+            self.stats.client_bytes += len(data)
+        except OSError:
+            self.stats.relay_drops += 1
+
+    def authenticate(self, view, nbytes, method, transaction_id, attributes, client_address):
+        """
+        Long-term credential check (RFC 5389 10.2). Returns the MESSAGE-INTEGRITY key, or None
+        after sending the 400/401/438 error response.
+        """
+        values = dict(attributes)
+        offset = find_message_integrity(view, nbytes)
+        challenge = [(STUN_ATTR_REALM, self.realm), (STUN_ATTR_NONCE, self.nonce)]
+        if offset is None:
+            return self.send_error(method, transaction_id, client_address, 401, "Unauthorized", challenge)
+        if STUN_ATTR_USERNAME not in values or STUN_ATTR_REALM not in values or STUN_ATTR_NONCE not in values:
+            return self.send_error(method, transaction_id, client_address, 400, "Bad Request")
+        if bytes(values[STUN_ATTR_NONCE]) != self.nonce:
+            return self.send_error(method, transaction_id, client_address, 438, "Stale Nonce", challenge)
+
+        username = bytes(values[STUN_ATTR_USERNAME])
+        password = self.credentials.password_for(username.decode('utf-8', 'replace'))
+        if password is not None:
+            key = hashlib.md5(username + b":" + bytes(values[STUN_ATTR_REALM]) + b":" + password).digest()
+            if verify_message_integrity(view, offset, hmac.new(key, digestmod=hashlib.sha1)):
+                return key
+        return self.send_error(method, transaction_id, client_address, 401, "Unauthorized", challenge)
+
+    def requested_lifetime(self, values):
+        """ LIFETIME of a request clamped to [TURN_DEFAULT_LIFETIME, TURN_MAX_LIFETIME]; 0 (release) is kept """
+        value = values.get(STUN_ATTR_LIFETIME)
+        if value is None or len(value) != 4:
+            return TURN_DEFAULT_LIFETIME
+        lifetime, = struct.unpack('!I', value)
+        return lifetime and min(max(lifetime, TURN_DEFAULT_LIFETIME), TURN_MAX_LIFETIME)
+
+    def allocate(self, values, transaction_id, client_address, key, now):
+        allocation = self.allocations.get(client_address)
+        if allocation is not None:
+            if allocation.transaction_id != transaction_id:
+                return self.send_error(TURN_ALLOCATE, transaction_id, client_address, 437, "Allocation Mismatch")
+            return self.send_allocate_success(allocation, client_address, now)  # retransmitted request
+
+        transport = values.get(STUN_ATTR_REQUESTED_TRANSPORT)
+        if transport is None or len(transport) != 4:
+            return self.send_error(TURN_ALLOCATE, transaction_id, client_address, 400, "Bad Request")
+        if transport[0] != socket.IPPROTO_UDP:
+            return self.send_error(TURN_ALLOCATE, transaction_id, client_address, 442, "Unsupported Transport Protocol")
+        if len(self.allocations) >= self.max_allocations:
+            return self.send_error(TURN_ALLOCATE, transaction_id, client_address, 486, "Allocation Quota Reached")
+
+        relay_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            relay_socket.bind((self.relay_host, 0))
+        except OSError:
+            relay_socket.close()
+            return self.send_error(TURN_ALLOCATE, transaction_id, client_address, 508, "Insufficient Capacity")
+        relay_socket.setblocking(False)
+
+        allocation = TurnAllocation(client_address, relay_socket, (self.relay_ip, relay_socket.getsockname()[1]),
+                                    transaction_id, key)
+        allocation.expires = now + (self.requested_lifetime(values) or TURN_DEFAULT_LIFETIME)
+        self.allocations[client_address] = allocation
+        self.allocations_by_fd[relay_socket.fileno()] = allocation
+        self.poller.register(relay_socket, select.POLLIN)
+        self.send_allocate_success(allocation, client_address, now)
+
+    def send_allocate_success(self, allocation, client_address, now):
+        self.send_success(TURN_ALLOCATE, allocation.transaction_id, client_address, allocation.key, [
+            (STUN_ATTR_XOR_RELAYED_ADDRESS, encode_xor_address(allocation.relay_address)),
+            (STUN_ATTR_LIFETIME, struct.pack('!I', max(round(allocation.expires - now), 0))),
+            (STUN_ATTR_XOR_MAPPED_ADDRESS, encode_xor_address(client_address)),
+        ])
+
+    def release(self, allocation):
+        self.allocations.pop(allocation.client_address, None)
+        self.allocations_by_fd.pop(allocation.relay_socket.fileno(), None)
+        self.poller.unregister(allocation.relay_socket)
+        allocation.relay_socket.close()
+
+    def expire(self, now):
+        """ Drops expired allocations, channel bindings and permissions """
+        for allocation in list(self.allocations.values()):
+            if allocation.expires <= now:
+                self.release(allocation)
+                continue
+            for channel, expires in list(allocation.channel_expires.items()):
+                if expires <= now:
+                    del allocation.channel_expires[channel]
+                    allocation.peer_channels.pop(allocation.channels.pop(channel), None)
+            for ip, expires in list(allocation.permissions.items()):
+                if expires <= now:
+                    del allocation.permissions[ip]
+
+    def send_success(self, method, transaction_id, client_address, key, attributes=()):
+        response = create_stun_message(method | STUN_CLASS_SUCCESS, transaction_id, attributes,
+                                       fingerprint=self.fingerprint, integrity_key=key)
+        self.control_socket.sendto(response, client_address)
+
+    def send_error(self, method, transaction_id, client_address, code, reason, attributes=(), unknown_attributes=()):
+        """ Sends an error response; returns None so that request handlers can return its result """
+        response = create_stun_error_response(transaction_id, code, reason, unknown_attributes, fingerprint=self.fingerprint,
+                                              message_type=method | STUN_CLASS_ERROR, attributes=attributes)
+        self.control_socket.sendto(response, client_address)
+        self.stats.error_responses += 1
+        return None
+
+def udp_pending_bytes(udp_socket):
+    """ Size of the next datagram waiting in the socket receive queue (FIONREAD), 0 when the queue is empty """
+    return struct.unpack('i', fcntl.ioctl(udp_socket.fileno(), termios.FIONREAD, b'\0\0\0\0'))[0]
+
+def proc_udp_drops(udp_socket):
+    """ Receive queue drops of udp_socket from /proc/net/udp[6] (same counter SO_RXQ_OVFL reports) """
+    inode = str(os.fstat(udp_socket.fileno()).st_ino)
+    try:
+        with open('/proc/net/udp6' if udp_socket.family == socket.AF_INET6 else '/proc/net/udp') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 12 and fields[9] == inode:
+                    return int(fields[12])
+    except OSError:
+        pass
+    return 0
+
+class ServerMetrics:
+    """
+    Aggregates the PacketCounters of this process' UDP loops on scrape and, in worker pool mode,
+    the counters of every worker through a shared array with one row per worker. Each worker
+    writes only its own row (published every publish_interval seconds), so nothing is locked.
+    Alongside, each worker publishes its STATS_PROVIDERS and heaviest sources as JSON into its
+    WORKER_STATE_SIZE slot of a second, locked array, so any worker answering a scrape reports
+    the whole pool: /top merges every worker's sources, /stats and the latency summary are
+    listed per worker.
+
+    The UDP loop counts as stalled when datagrams are waiting in the socket but packets_received
+    has not moved for stall_timeout seconds; an idle loop with an empty queue is healthy.
+    """
+    def __init__(self, stall_timeout=5.0, publish_interval=1.0):
+        self.loops = []
+        self.udp_socket = None
+        self.shared = None
+        self.shared_state = None
+        self.worker_index = 0
+        self.workers = 1
+        self.stall_timeout = stall_timeout
+        self.publish_interval = publish_interval
+        self.top_talkers = None
+        self.last_received = -1
+        self.last_progress = time.monotonic()
+
+    def new_loop_counters(self):
+        counters = PacketCounters()
+        self.loops.append(counters)
+        return counters
+
+    def local_totals(self):
+        totals = [0] * len(COUNTER_NAMES)
+        for counters in self.loops:
+            for i, value in enumerate(counters.snapshot()):
+                totals[i] += value
+
+        overflow = COUNTER_NAMES.index('socket_overflow_drops')
+        if self.udp_socket is not None:
+            totals[overflow] = max(totals[overflow], proc_udp_drops(self.udp_socket))
+        return totals
+
+    def attach_shared(self, shared, worker_index, workers, shared_state=None):
+        """
+        Joins a worker pool: publishes this worker's totals into its row of the shared array
+        and its stats and top talkers into its slot of shared_state
+        """
+        self.shared = shared
+        self.shared_state = shared_state
+        self.worker_index = worker_index
+        self.workers = workers
+        threading.Thread(target=self.publish_forever, daemon=True).start()
+
+    def publish_forever(self):
+        row = self.worker_index * len(COUNTER_NAMES)
+        while True:
+            self.shared[row:row + len(COUNTER_NAMES)] = self.local_totals()
+            if self.shared_state is not None:
+                self.publish_state()
+            time.sleep(self.publish_interval)
+
+    def local_state(self):
+        """ This process' STATS_PROVIDERS and (with top talker tracking) heaviest sources """
+        top = self.top_talkers.heaviest(self.top_talkers.k) if self.top_talkers is not None else []
+        return {"stats": {name: provider() for name, provider in STATS_PROVIDERS.items()}, "top": top}
+
+    def publish_state(self):
+        state = self.local_state()
+        data = json.dumps(state).encode('utf-8')
+        while len(data) > WORKER_STATE_SIZE and state["top"]:
+            state["top"] = state["top"][:len(state["top"]) // 2]  # keep the heaviest that fit
+            data = json.dumps(state).encode('utf-8')
+        if len(data) > WORKER_STATE_SIZE:
+            data = b""
+        offset = self.worker_index * WORKER_STATE_SIZE
+        with self.shared_state.get_lock():
+            self.shared_state[offset:offset + WORKER_STATE_SIZE] = data.ljust(WORKER_STATE_SIZE, b"\0")
+
+    def worker_states(self):
+        """ Returns [(worker index, local_state())], with the live state for this worker """
+        if self.shared_state is None:
+            return [(self.worker_index, self.local_state())]
+
+        states = []
+        with self.shared_state.get_lock():
+            raw = self.shared_state.raw
+        for i in range(self.workers):
+            if i == self.worker_index:
+                states.append((i, self.local_state()))
+                continue
+            data = raw[i * WORKER_STATE_SIZE:(i + 1) * WORKER_STATE_SIZE].rstrip(b"\0")
+            try:
+                states.append((i, json.loads(data)))
+            except ValueError:
+                states.append((i, {"stats": {}, "top": []}))  # not published yet
+        return states
+
+    def stats(self):
+        """ GET /stats: the STATS_PROVIDERS, per worker ({"workers": {index: ...}}) in a worker pool """
+        states = self.worker_states()
+        if self.shared_state is None:
+            return states[0][1]["stats"]
+        return {"workers": {str(worker): state["stats"] for worker, state in states}}
+
+    def heaviest(self, n=10):
+        """ GET /top: the n heaviest sources of every worker together """
+        counts = collections.Counter()
+        for _, state in self.worker_states():
+            for entry in state["top"]:
+                counts[entry["source"]] += entry["count"]
+        return [{"source": source, "count": count} for source, count in counts.most_common(n)]
+
+    def worker_rows(self):
+        """ Returns [(worker index, totals)], with live values for this worker """
+        if self.shared is None:
+            return [(self.worker_index, self.local_totals())]
+
+        width = len(COUNTER_NAMES)
+        rows = [(i, list(self.shared[i * width:(i + 1) * width])) for i in range(self.workers)]
+        rows[self.worker_index] = (self.worker_index, self.local_totals())
+        return rows
+
+    def is_stalled(self):
+        if self.udp_socket is None:
+            return False
+
+        received = sum(counters.packets_received for counters in self.loops)
+        now = time.monotonic()
+        if received != self.last_received or not udp_pending_bytes(self.udp_socket):
+            self.last_received = received
+            self.last_progress = now
+            return False
+        return now - self.last_progress > self.stall_timeout
+
+    def render(self):
+        """ Prometheus text exposition format """
+        rows = self.worker_rows()
+        lines = []
+        for i, name in enumerate(COUNTER_NAMES):
+            metric = f"stun_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for worker, totals in rows:
+                lines.append(f'{metric}{{worker="{worker}"}} {totals[i]}')
+
+        hits, misses = COUNTER_NAMES.index('mapped_cache_hits'), COUNTER_NAMES.index('mapped_cache_misses')
+        lines.append("# TYPE stun_mapped_cache_hit_ratio gauge")
+        for worker, totals in rows:
+            lookups = totals[hits] + totals[misses]
+            lines.append(f'stun_mapped_cache_hit_ratio{{worker="{worker}"}} {totals[hits] / lookups if lookups else 0.0}')
+
+        lines.append("# TYPE stun_udp_loop_stalled gauge")
+        lines.append(f'stun_udp_loop_stalled{{worker="{self.worker_index}"}} {int(self.is_stalled())}')
+
+        latencies = [(worker, state["stats"]["latency"]) for worker, state in self.worker_states() if "latency" in state["stats"]]
+        if latencies:
+            lines.append("# TYPE stun_service_latency_seconds summary")
+            for worker, latency in latencies:
+                for quantile, key in (("0.5", "p50_us"), ("0.99", "p99_us"), ("0.999", "p999_us")):
+                    lines.append(f'stun_service_latency_seconds{{worker="{worker}",quantile="{quantile}"}} {latency[key] / 1e6}')
+                lines.append(f'stun_service_latency_seconds_count{{worker="{worker}"}} {latency["count"]}')
+
+        return "\n".join(lines) + "\n"
+
+SERVER_METRICS = ServerMetrics()
+
+def http_response(body, content_type='text/plain', status='200 OK'):
+    body = body.encode('utf-8')
+    return (f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n").encode('utf-8') + body
+
+def route_tcp_request(request):
+    """
+    Returns the raw HTTP response for a request on the health check port.
+    GET /stats returns the STATS_PROVIDERS as JSON (per worker in a worker pool), GET /metrics the SERVER_METRICS
+    in Prometheus text format, GET /top?n=N the N heaviest sources of the current window (with --top-talkers),
+    anything else (including an empty request) is the health check, which fails with 503 while the UDP loop is stalled.
+    """
+    request_line = request.split(b"\r\n", 1)[0].split()
+    path = request_line[1].decode('latin-1') if len(request_line) > 1 else '/'
+
+    if path == '/stats':
+        return http_response(json.dumps(SERVER_METRICS.stats()), 'application/json')
+
+    if path == '/metrics':
+        return http_response(SERVER_METRICS.render(), 'text/plain; version=0.0.4')
+
+    if path.startswith('/top'):
+        if SERVER_METRICS.top_talkers is None:
+            return http_response("top talker tracking is disabled (--top-talkers)", status='404 Not Found')
+        query = dict(parse_qsl(path.partition('?')[2]))
+        n = int(query['n']) if query.get('n', '').isdigit() else 10
+        return http_response(json.dumps(SERVER_METRICS.heaviest(n)), 'application/json')
+
+    if SERVER_METRICS.is_stalled():
+        return HEALTH_CHECK_STALLED_RESPONSE
+
+    return HEALTH_CHECK_RESPONSE
+
 def handle_tcp_health_check(client_socket, client_address):
     """
     Handles TCP health check requests.
     """
     print(f"Received health check request from {client_address}")
-    health_check_response = "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n\r\nOK"
-    client_socket.sendall(health_check_response.encode('utf-8'))
-    client_socket.close()
+    client_socket.settimeout(2)
+    try:
+        request = client_socket.recv(1024)
+    except OSError:
+        request = b""
 
-def start_combined_server(host='0.0.0.0', port=3560):
+    try:
+        client_socket.sendall(route_tcp_request(request))
+    except OSError:
+        pass
+    finally:
+        client_socket.close()
+
+class StunDatagramProtocol(asyncio.DatagramProtocol):
     """
-    Starts a combined server that handles both STUN (UDP) and TCP health check requests on the same port.
+    asyncio STUN handler. Same parsing and response building as handle_stun_request,
+    but driven by the event loop and without per-packet printing.
     """
-    # UDP socket for STUN
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def __init__(self, counters=None, top_talkers=None, rate_limiter=None):
+        self.transport = None
+        self.counters = counters or PacketCounters()
+        self.top_talkers = top_talkers
+        self.rate_limiter = rate_limiter
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, client_address):
+        self.counters.packets_received += 1
+        if self.top_talkers is not None:
+            self.top_talkers.record(client_address)
+        if self.rate_limiter is not None and not self.rate_limiter.allow(client_address[0]):
+            self.counters.rate_limited_drops += 1
+            return
+        if not is_stun_message(data, len(data)):
+            self.counters.malformed_drops += 1
+            return
+        method, message_length, magic_cookie, transaction_id, attributes = parse_stun_message(data)
+
+        if method == STUN_BINDING_REQUEST:
+            response = create_stun_binding_response(transaction_id, client_address[0], client_address[1])
+            self.transport.sendto(response, client_address)
+            self.counters.binding_responses_sent += 1
+        elif method is None:
+            self.counters.malformed_drops += 1
+        else:
+            self.counters.unknown_method_drops += 1
+
+    def error_received(self, exc):
+        print(f"UDP error: {exc}")
+
+async def handle_tcp_health_check_async(reader, writer):
+    """
+    Handles TCP health check requests on the event loop.
+    """
+    try:
+        request = await asyncio.wait_for(reader.read(1024), 2)
+    except (asyncio.TimeoutError, ConnectionError):
+        request = b""
+
+    try:
+        writer.write(route_tcp_request(request))
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve_asyncio(udp_socket, tcp_socket, counters=None, top_talkers=None, rate_limiter=None):
+    """
+    Serves STUN (UDP) and the TCP health check from a single asyncio event loop.
+    """
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: StunDatagramProtocol(counters, top_talkers, rate_limiter), sock=udp_socket)
+    tcp_server = await asyncio.start_server(handle_tcp_health_check_async, sock=tcp_socket)
+
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        transport.close()
+
+class StunStreamStats:
+    """ Counters of the STUN over TCP/TLS listeners for GET /stats; only their event loop writes them """
+    def __init__(self):
+        self.connections = 0
+        self.active = 0
+        self.tls_handshakes = 0
+        self.resumed_sessions = 0
+        self.requests = 0
+        self.responses = 0
+        self.framing_errors = 0
+
+    def summary(self):
+        return {
+            "connections": self.connections,
+            "active_connections": self.active,
+            "tls_handshakes": self.tls_handshakes,
+            "tls_resumed_sessions": self.resumed_sessions,
+            "requests": self.requests,
+            "responses": self.responses,
+            "framing_errors": self.framing_errors,
+        }
+
+async def handle_stun_stream(reader, writer, responder, stats, idle_timeout=300.0):
+    """
+    Serves one STUN over TCP/TLS connection (RFC 5389 7.2.2: messages sent back to back, no extra framing).
+    Pipelined requests are answered in order: every message complete in what has been read so far is
+    answered into one output buffer, written and drained once. The connection is closed on a message
+    that is not STUN (or larger than STUN_MAX_STREAM_MESSAGE) and after idle_timeout seconds without data.
+    """
+    client_address = writer.get_extra_info('peername')[:2]
+    ssl_object = writer.get_extra_info('ssl_object')
+    # without it Nagle holds a response back behind unacknowledged TLS session tickets (a delayed ACK, ~40 ms)
+    writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    stats.connections += 1
+    stats.active += 1
+    if ssl_object is not None:
+        stats.tls_handshakes += 1
+        stats.resumed_sessions += ssl_object.session_reused
+
+    out = bytearray(STUN_MAX_RESPONSE_SIZE)
+    out_view = memoryview(out)
+    pack_response_into = responder.pack_response_into
+    pending = b""
+    try:
+        while True:
+            chunk = await asyncio.wait_for(reader.read(65536), idle_timeout)
+            if not chunk:
+                break
+            data = pending + chunk if pending else chunk
+            view = memoryview(data)
+            output = bytearray()
+            offset = 0
+            while len(data) - offset >= 20:
+                if data[offset] & 0xC0:
+                    raise ValueError("not a STUN message")
+                message_length, = STUN_LENGTH.unpack_from(data, offset + 2)
+                end = offset + 20 + message_length
+                if end - offset > STUN_MAX_STREAM_MESSAGE:
+                    raise ValueError("message too large")
+                if end > len(data):
+                    break
+                stats.requests += 1
+                length = pack_response_into(out, view[offset:end], end - offset, client_address)
+                if length:
+                    output += out_view[:length]
+                    stats.responses += 1
+                offset = end
+            pending = data[offset:]
+
+            if output:
+                writer.write(output)
+                await writer.drain()
+    except ValueError:
+        stats.framing_errors += 1
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        stats.active -= 1
+        writer.close()
+
+async def serve_stun_streams(listeners, responder, stats):
+    """ Serves STUN over TCP/TLS on [(listening socket, ssl context or None)] """
+    servers = [
+        await asyncio.start_server(lambda reader, writer: handle_stun_stream(reader, writer, responder, stats),
+                                   sock=listener, ssl=ssl_context)
+        for listener, ssl_context in listeners
+    ]
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+def create_tls_context(certfile, keyfile=None, tickets=2):
+    """
+    Server TLS context for STUN over TLS. TLS 1.3 session tickets (tickets per full handshake) let
+    clients resume sessions and skip the certificate exchange and key agreement on reconnects.
+    """
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+    ssl_context.load_cert_chain(certfile, keyfile)
+    ssl_context.num_tickets = tickets
+    return ssl_context
+
+class HotRestart:
+    """
+    Zero-downtime restart: the running server listens on a Unix socket at path; a new server
+    started with the same path connects to it and takes over the bound UDP/TCP sockets, passed
+    with SCM_RIGHTS, instead of binding its own.
+
+    Handing over sets draining: every UDP loop of the old process stops after the packet (or
+    batch) it is serving (an empty datagram to its own UDP socket wakes loops blocked on an idle
+    socket; it is counted as a malformed drop), and the old process tells the new one it has released the sockets
+    once its loops are done (at most drain_timeout seconds), then exits. The new process only
+    starts reading after that, so the two never read the same socket at once (they also share
+    its blocking mode); datagrams and connections arriving in between wait in the socket queues.
+    """
+    def __init__(self, drain_timeout=2.0):
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        self.sockets = []
+        self.loops = []
+
+    def take_over(self, path, timeout=10.0):
+        """ Returns the sockets handed over by the server listening on path, or None if there is none """
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            client.close()
+            return None
+
+        with client:
+            client.settimeout(timeout)
+            client.sendall(b"takeover")
+            message, fds, _, _ = socket.recv_fds(client, 1024, 16)
+            sockets = [socket.socket(fileno=fd) for fd in fds]
+            old_pid = json.loads(message)["pid"]
+            client.recv(16)  # b"released", or EOF if the old process died
+        for server_socket in sockets:
+            server_socket.setblocking(True)
+        print(f"Took over {len(sockets)} sockets from pid {old_pid}")
+        return sockets
+
+    def listen(self, path, sockets, loops):
+        """ Serves takeover requests on path for sockets, served by the loops threads """
+        self.sockets = sockets
+        self.loops = loops
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        threading.Thread(target=self.serve_takeovers, args=(listener,), name="hot-restart", daemon=True).start()
+
+    def serve_takeovers(self, listener):
+        while True:
+            connection, _ = listener.accept()
+            with connection:
+                connection.settimeout(2)
+                try:
+                    if connection.recv(16) == b"takeover":
+                        self.hand_over(connection)
+                except OSError as e:
+                    print(f"Hot restart handoff failed: {e}")
+
+    def hand_over(self, connection):
+        self.draining = True
+        socket.send_fds(connection, [json.dumps({"pid": os.getpid()}).encode()], [s.fileno() for s in self.sockets])
+        host, port = self.sockets[0].getsockname()[:2]
+        with socket.socket(self.sockets[0].family, socket.SOCK_DGRAM) as waker:
+            waker.sendto(b"", ({'0.0.0.0': '127.0.0.1', '::': '::1'}.get(host, host), port))
+        deadline = time.monotonic() + self.drain_timeout
+        for loop in self.loops:
+            loop.join(max(deadline - time.monotonic(), 0))
+        drained = not any(loop.is_alive() for loop in self.loops)
+        connection.sendall(b"released")
+        print(f"Handed sockets over, {'drained' if drained else 'drain timed out'}, exiting [pid {os.getpid()}]")
+        os._exit(0)
+
+HOT_RESTART = HotRestart()
+
+def create_socket(host, kind):
+    """
+    An AF_INET socket, or for an IPv6 host (e.g. '::') an AF_INET6 socket with IPV6_V6ONLY off: one
+    dual-stack socket that also serves IPv4 clients, seen as v4-mapped addresses.
+    """
+    if ':' not in host:
+        return socket.socket(socket.AF_INET, kind)
+    dual_stack_socket = socket.socket(socket.AF_INET6, kind)
+    dual_stack_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    return dual_stack_socket
+
+def create_udp_socket(host, port, reuse_port=False):
+    udp_socket = create_socket(host, socket.SOCK_DGRAM)
+    if reuse_port:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     udp_socket.bind((host, port))
+    return udp_socket
 
-    # TCP socket for health check
-    tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def create_tcp_socket(host, port, reuse_port=False, backlog=128):
+    tcp_socket = create_socket(host, socket.SOCK_STREAM)
     tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     tcp_socket.bind((host, port))
-    tcp_socket.listen(5)
+    tcp_socket.listen(backlog)
+    return tcp_socket
+
+def create_server_sockets(host='0.0.0.0', port=3560, reuse_port=False):
+    """
+    Creates and binds the UDP (STUN) and TCP (health check) sockets.
+    With reuse_port, several processes can bind the same port and the kernel spreads traffic between them.
+    """
+    # UDP socket for STUN
+    udp_socket = create_udp_socket(host, port, reuse_port)
+
+    # TCP socket for health check
+    tcp_socket = create_tcp_socket(host, port, reuse_port)
+
+    return udp_socket, tcp_socket
+
+def start_combined_server(host='0.0.0.0', port=3560, engine='thread', reuse_port=False, batch_size=64, timestamps=False,
+                          top_talkers=False, top_talkers_window=60.0, rate_limit=0.0, rate_burst=None, rate_table_size=65536,
+                          fingerprint=False, verify_fingerprint=False, credentials_file=None, auth_secret=None,
+                          alternate_host=None, alternate_port=None, turn_port=None, turn_relay_ip=None, turn_realm="broadwayinc",
+                          handoff_path=None, stun_tcp_port=None, stun_tls_port=None, tls_cert=None, tls_key=None):
+    """
+    Starts a combined server that handles both STUN (UDP) and TCP health check requests on the same port.
+
+    engine:
+        'thread'  - blocking recvfrom loop on a thread, one thread per health check (default).
+        'asyncio' - single event loop for both UDP and TCP (see serve_asyncio).
+        'fast'    - like 'thread', but with the allocation-free BindingResponder codec.
+        'batch'   - like 'fast', but drains up to batch_size datagrams per wakeup (see handle_stun_request_batched).
+
+    timestamps: record kernel receive-to-send latency (SO_TIMESTAMPNS) and serve p50/p99/p999 on GET /stats.
+        Not available with the 'asyncio' engine, which has no access to ancillary data.
+
+    top_talkers: track per-source request counts in a TopTalkers sketch (halved every top_talkers_window
+        seconds) and serve the heaviest sources on GET /top?n=N.
+
+    rate_limit: binding requests per second allowed per source IP (token bucket of rate_burst tokens,
+        2 * rate_limit by default), tracked for up to rate_table_size sources. 0 disables rate limiting.
+
+    fingerprint / verify_fingerprint: close responses with FINGERPRINT / drop requests with a wrong FINGERPRINT.
+        Attribute handling (including 420 Unknown Attribute) is done by BindingResponder, so these
+        only apply to the 'fast' and 'batch' engines and to timestamps.
+
+    credentials_file / auth_secret: require short-term credentials (USERNAME + MESSAGE-INTEGRITY) on binding
+        requests, with passwords from a JSON {"username": "password"} file and/or derived from a shared
+        secret (see ShortTermCredentials). Like the fingerprint options, 'fast'/'batch'/timestamps only.
+
+    alternate_host / alternate_port: serve RFC 5780 NAT behavior discovery. STUN is also served on
+        host:alternate_port, alternate_host:port and alternate_host:alternate_port (alternate_port defaults
+        to port + 1), CHANGE-REQUEST is honored and responses carry RESPONSE-ORIGIN and OTHER-ADDRESS.
+        host and alternate_host must be two distinct local IPv4 addresses (not 0.0.0.0). The four sockets
+        are served by handle_stun_request_nat_behavior with the 'fast' or 'batch' engine, without timestamps.
+
+    turn_port: also run a TurnServer on this UDP port (any engine), relaying from sockets bound to host and
+        advertised as turn_relay_ip (required when host is 0.0.0.0). The relay is IPv4 only: with host '::'
+        it listens and relays on 0.0.0.0. credentials_file / auth_secret, when given,
+        are the long-term credentials of TURN requests in realm turn_realm; without them the relay is open.
 
-    print(f"Combined server started on {host}:{port}")
+    handoff_path: hot restart through this Unix socket path (see HotRestart). If a server is listening
+        there, its sockets are taken over instead of binding new ones; this server then listens there
+        for the next restart. Not available with the 'asyncio' engine or turn_port (allocations are not handed over).
+
+    stun_tcp_port / stun_tls_port: also serve STUN over TCP / TLS (certificate chain tls_cert, key tls_key)
+        on these ports, with pipelined requests on persistent connections (see handle_stun_stream), from
+        an event loop thread of their own. Works with every engine, not with handoff_path.
+
+    An IPv6 host ('::' or an address) serves STUN on dual-stack sockets (see create_socket): IPv6 clients get
+    an IPv6 XOR-MAPPED-ADDRESS, IPv4 clients (v4-mapped addresses) the same IPv4 one as on an IPv4 socket.
+    """
+    if timestamps and engine == 'asyncio':
+        raise ValueError("timestamps are not supported by the asyncio engine")
+
+    nat_addresses = None
+    if alternate_host:
+        if engine not in ('fast', 'batch') or timestamps:
+            raise ValueError("NAT behavior discovery needs the fast or batch engine, without timestamps")
+        if host in WILDCARD_HOSTS or host == alternate_host or ':' in host + alternate_host:
+            raise ValueError("NAT behavior discovery needs two distinct local IPv4 addresses")
+        alternate_port = alternate_port or port + 1
+        nat_addresses = [(host, port), (host, alternate_port), (alternate_host, port), (alternate_host, alternate_port)]
+
+    if turn_port and host in WILDCARD_HOSTS and not turn_relay_ip:
+        raise ValueError("the TURN relay needs turn_relay_ip when host is 0.0.0.0")
+    if turn_port and ':' in host and host != '::':
+        raise ValueError("the TURN relay is IPv4 only")
+
+    if handoff_path and (engine == 'asyncio' or turn_port or stun_tcp_port or stun_tls_port):
+        raise ValueError("hot restart is not supported by the asyncio engine or with the TURN relay or STUN over TCP/TLS")
+
+    if stun_tls_port and not tls_cert:
+        raise ValueError("STUN over TLS needs tls_cert")
+
+    inherited = HOT_RESTART.take_over(handoff_path) if handoff_path else None
+    if inherited:
+        if len(inherited) != (len(nat_addresses) + 1 if nat_addresses is not None else 2):
+            raise ValueError(f"the previous server handed over {len(inherited)} sockets, started with other addresses?")
+        udp_socket, tcp_socket, *alternate_sockets = inherited
+    else:
+        udp_socket, tcp_socket = create_server_sockets(host, port, reuse_port)
+        alternate_sockets = [create_udp_socket(*address, reuse_port) for address in (nat_addresses or [])[1:]]
+    nat_sockets = [udp_socket] + alternate_sockets if nat_addresses is not None else None
+    counters = SERVER_METRICS.new_loop_counters()
+    SERVER_METRICS.udp_socket = udp_socket
+
+    if top_talkers:
+        SERVER_METRICS.top_talkers = TopTalkers(decay_interval=top_talkers_window)
+
+    rate_limiter = None
+    if rate_limit > 0:
+        rate_limiter = SourceRateLimiter(rate_limit, rate_burst or 2 * rate_limit, rate_table_size)
+
+    print(f"Combined server ({engine}) started on {host}:{port} [pid {os.getpid()}]")
+    if nat_addresses is not None:
+        print("NAT behavior discovery on " + ", ".join(f"{ip}:{udp_port}" for ip, udp_port in nat_addresses))
+
+    credentials = None
+    if credentials_file or auth_secret:
+        passwords = None
+        if credentials_file:
+            with open(credentials_file, encoding='utf-8') as f:
+                passwords = json.load(f)
+        credentials = ShortTermCredentials(passwords, auth_secret)
+
+    if turn_port:
+        turn_host = '0.0.0.0' if host == '::' else host
+        turn_server = TurnServer(create_udp_socket(turn_host, turn_port, reuse_port), turn_host, turn_relay_ip, credentials, turn_realm,
+                                 fingerprint=fingerprint)
+        STATS_PROVIDERS['turn'] = turn_server.stats.summary
+        threading.Thread(target=turn_server.serve_forever, name="turn", daemon=True).start()
+        print(f"TURN relay on {turn_host}:{turn_port}, relayed addresses {turn_server.relay_ip}:*"
+              + ("" if credentials is not None else " (open relay, no credentials)"))
+
+    if stun_tcp_port or stun_tls_port:
+        listeners = []
+        if stun_tcp_port:
+            listeners.append((create_tcp_socket(host, stun_tcp_port, reuse_port, backlog=1024), None))
+        if stun_tls_port:
+            listeners.append((create_tcp_socket(host, stun_tls_port, reuse_port, backlog=1024), create_tls_context(tls_cert, tls_key)))
+        stream_stats = StunStreamStats()
+        STATS_PROVIDERS['stun_tcp'] = stream_stats.summary
+        stream_rate_limiter = None  # not thread safe: the stream thread keeps its own buckets
+        if rate_limit > 0:
+            stream_rate_limiter = SourceRateLimiter(rate_limit, rate_burst or 2 * rate_limit, rate_table_size)
+        stream_responder = BindingResponder(top_talkers=SERVER_METRICS.top_talkers, rate_limiter=stream_rate_limiter, fingerprint=fingerprint,
+                                            verify_fingerprint=verify_fingerprint, credentials=credentials)
+        threading.Thread(target=asyncio.run, args=(serve_stun_streams(listeners, stream_responder, stream_stats),),
+                         name="stun-tcp", daemon=True).start()
+        print("STUN over " + ", ".join(f"{'TLS' if ssl_context else 'TCP'} on {host}:{listener.getsockname()[1]}"
+                                       for listener, ssl_context in listeners))
+
+    if engine == 'asyncio':
+        asyncio.run(serve_asyncio(udp_socket, tcp_socket, counters, SERVER_METRICS.top_talkers, rate_limiter))
+        return
 
     # Start thread to handle STUN requests
-    stun_thread = threading.Thread(target=handle_stun_request, args=(udp_socket,))
+    histogram = None
+    if timestamps:
+        histogram = LatencyHistogram()
+        STATS_PROVIDERS['latency'] = histogram.summary
+
+    responder = BindingResponder(top_talkers=SERVER_METRICS.top_talkers, rate_limiter=rate_limiter, counters=counters,
+                                 fingerprint=fingerprint, verify_fingerprint=verify_fingerprint, credentials=credentials,
+                                 nat_addresses=nat_addresses)
+
+    if nat_sockets is not None:
+        stun_handler = handle_stun_request_nat_behavior
+        handler_options = {'responder': responder}
+    elif engine == 'batch':
+        batch_stats = BatchStats(batch_size)
+        STATS_PROVIDERS['batch'] = batch_stats.summary
+        stun_handler = handle_stun_request_batched
+        handler_options = {'batch_size': batch_size, 'stats': batch_stats, 'histogram': histogram, 'responder': responder}
+    elif timestamps:
+        stun_handler = handle_stun_request_timestamped
+        handler_options = {'histogram': histogram, 'responder': responder}
+    elif engine == 'fast':
+        stun_handler = handle_stun_request_fast
+        handler_options = {'responder': responder}
+    else:
+        stun_handler = handle_stun_request
+        handler_options = {'top_talkers': SERVER_METRICS.top_talkers, 'rate_limiter': rate_limiter}
+
+    stun_thread = threading.Thread(target=stun_handler, args=(nat_sockets or udp_socket,), kwargs=dict(handler_options, counters=counters))
     stun_thread.start()
 
+    if handoff_path:
+        HOT_RESTART.listen(handoff_path, [udp_socket, tcp_socket] + alternate_sockets, [stun_thread])
+
     while True:
         client_socket, client_address = tcp_socket.accept()
         threading.Thread(target=handle_tcp_health_check, args=(client_socket, client_address)).start()
 
+def run_worker(host, port, cpu=None, server_options=None, shared_counters=None, worker_index=0, workers=1, shared_state=None):
+    """
+    Worker process entry point. Optionally pins itself to a single CPU.
+    """
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+
+    if shared_counters is not None:
+        SERVER_METRICS.attach_shared(shared_counters, worker_index, workers, shared_state)
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # supervisor handles Ctrl+C
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    start_combined_server(host, port, reuse_port=True, **(server_options or {}))
+
+def start_worker_pool(host='0.0.0.0', port=3560, workers=2, affinity=False, restart_delay=1.0, **server_options):
+    """
+    Forks `workers` processes, each binding its own SO_REUSEPORT UDP/TCP socket on the same port,
+    and supervises them: a worker that dies is restarted after restart_delay seconds.
+    server_options are passed on to start_combined_server (engine, batch_size, ...).
+    """
+    ctx = multiprocessing.get_context('fork')
+    cpus = sorted(os.sched_getaffinity(0)) if affinity else None
+    pool = {}
+    # one row of COUNTER_NAMES per worker, see ServerMetrics
+    shared_counters = ctx.Array('Q', workers * len(COUNTER_NAMES), lock=False)
+    # one WORKER_STATE_SIZE slot of /stats and /top JSON per worker, see ServerMetrics
+    shared_state = ctx.Array('c', workers * WORKER_STATE_SIZE)
+
+    def spawn(index):
+        cpu = cpus[index % len(cpus)] if cpus else None
+        process = ctx.Process(target=run_worker, args=(host, port, cpu, server_options, shared_counters, index, workers, shared_state), name=f"stun-worker-{index}", daemon=True)
+        process.start()
+        pool[index] = process
+        print(f"Started worker {index} [pid {process.pid}]" + (f" on cpu {cpu}" if cpu is not None else ""))
+
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for index in range(workers):
+        spawn(index)
+
+    while not stopping.wait(restart_delay):
+        for index, process in list(pool.items()):
+            if not process.is_alive():
+                print(f"Worker {index} [pid {process.pid}] exited with code {process.exitcode}, restarting")
+                process.join()
+                spawn(index)
+
+    for process in pool.values():
+        process.terminate()
+    for process in pool.values():
+        process.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="STUN (UDP) + health check (TCP) server")
+    parser.add_argument('--host', default='0.0.0.0', help="address to bind; '::' serves IPv6 and IPv4 clients on dual-stack sockets")
+    parser.add_argument('--port', type=int, default=3560)
+    parser.add_argument('--engine', choices=['thread', 'asyncio', 'fast', 'batch'], default='thread')
+    parser.add_argument('--batch-size', type=int, default=64, help="max datagrams drained per wakeup (batch engine)")
+    parser.add_argument('--timestamps', action='store_true',
+                        help="record kernel receive-to-send latency, served as p50/p99/p999 on GET /stats")
+    parser.add_argument('--top-talkers', action='store_true',
+                        help="track per-source request counts, served on GET /top?n=N")
+    parser.add_argument('--top-talkers-window', type=float, default=60.0,
+                        help="seconds after which top talker counts are halved")
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help="binding requests per second allowed per source IP (0: unlimited)")
+    parser.add_argument('--rate-burst', type=float, default=None, help="token bucket size (default: 2 x --rate-limit)")
+    parser.add_argument('--rate-table-size', type=int, default=65536, help="number of source IPs tracked by the rate limiter")
+    parser.add_argument('--fingerprint', action='store_true', help="add FINGERPRINT to responses (fast/batch engines)")
+    parser.add_argument('--verify-fingerprint', action='store_true',
+                        help="drop requests whose FINGERPRINT does not match (fast/batch engines)")
+    parser.add_argument('--credentials', dest='credentials_file', default=None,
+                        help='JSON file {"username": "password"} of short-term credentials required on binding requests')
+    parser.add_argument('--auth-secret', default=None,
+                        help='shared secret for "<expiry>:<user>" credentials (default: $STUN_AUTH_SECRET, fast/batch engines)')
+    parser.add_argument('--alternate-host', default=None,
+                        help="second local IP for RFC 5780 NAT behavior discovery (fast/batch engines, needs --host)")
+    parser.add_argument('--alternate-port', type=int, default=None, help="second UDP port (default: --port + 1)")
+    parser.add_argument('--turn-port', type=int, default=None, help="serve a TURN relay (RFC 5766, UDP) on this port")
+    parser.add_argument('--turn-relay-ip', default=None, help="address advertised for relayed addresses (default: --host)")
+    parser.add_argument('--turn-realm', default="broadwayinc", help="REALM of TURN long-term credentials")
+    parser.add_argument('--handoff-path', default=None,
+                        help="Unix socket for hot restarts: take over the sockets of the server listening there, if any")
+    parser.add_argument('--stun-tcp-port', type=int, default=None, help="serve STUN over TCP on this port (e.g. 3478)")
+    parser.add_argument('--stun-tls-port', type=int, default=None, help="serve STUN over TLS on this port (e.g. 5349)")
+    parser.add_argument('--tls-cert', default=None, help="PEM certificate chain for --stun-tls-port")
+    parser.add_argument('--tls-key', default=None, help="PEM private key for --stun-tls-port (default: in --tls-cert)")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="number of SO_REUSEPORT worker processes (0: serve in this process)")
+    parser.add_argument('--affinity', action='store_true', help="pin each worker to its own CPU")
+    args = parser.parse_args()
+
+    if args.timestamps and args.engine == 'asyncio':
+        parser.error("--timestamps is not supported by the asyncio engine")
+
+    supports_credentials = args.engine not in ('thread', 'asyncio') or args.timestamps
+    if (args.credentials_file or args.auth_secret) and not supports_credentials:
+        parser.error("--credentials/--auth-secret need the fast or batch engine")
+    if args.auth_secret is None and os.environ.get('STUN_AUTH_SECRET'):
+        if supports_credentials:
+            args.auth_secret = os.environ['STUN_AUTH_SECRET']
+        else:
+            print(f"$STUN_AUTH_SECRET is ignored: the {args.engine} engine does not check credentials")
+
+    if args.alternate_host:
+        if args.engine in ('thread', 'asyncio') or args.timestamps:
+            parser.error("--alternate-host needs the fast or batch engine, without --timestamps")
+        if args.host in WILDCARD_HOSTS or args.host == args.alternate_host or ':' in args.host + args.alternate_host:
+            parser.error("--alternate-host needs --host set to another local IPv4 address")
+
+    if args.turn_port and args.host in WILDCARD_HOSTS and not args.turn_relay_ip:
+        parser.error("--turn-port needs --turn-relay-ip (or --host) set to the relay's address")
+    if args.turn_port and ':' in args.host and args.host != '::':
+        parser.error("--turn-port is IPv4 only (with --host '::' it binds 0.0.0.0)")
+
+    if args.handoff_path and (args.engine == 'asyncio' or args.turn_port or args.workers > 0
+                              or args.stun_tcp_port or args.stun_tls_port):
+        parser.error("--handoff-path is not supported with the asyncio engine, --turn-port, --stun-tcp/tls-port or --workers")
+
+    if args.stun_tls_port and not args.tls_cert:
+        parser.error("--stun-tls-port needs --tls-cert")
+
+    server_options = {
+        'engine': args.engine,
+        'batch_size': args.batch_size,
+        'timestamps': args.timestamps,
+        'top_talkers': args.top_talkers,
+        'top_talkers_window': args.top_talkers_window,
+        'rate_limit': args.rate_limit,
+        'rate_burst': args.rate_burst,
+        'rate_table_size': args.rate_table_size,
+        'fingerprint': args.fingerprint,
+        'verify_fingerprint': args.verify_fingerprint,
+        'credentials_file': args.credentials_file,
+        'auth_secret': args.auth_secret,
+        'alternate_host': args.alternate_host,
+        'alternate_port': args.alternate_port,
+        'turn_port': args.turn_port,
+        'turn_relay_ip': args.turn_relay_ip,
+        'turn_realm': args.turn_realm,
+        'handoff_path': args.handoff_path,
+        'stun_tcp_port': args.stun_tcp_port,
+        'stun_tls_port': args.stun_tls_port,
+        'tls_cert': args.tls_cert,
+        'tls_key': args.tls_key,
+    }
+
+    if args.workers > 0:
+        start_worker_pool(args.host, args.port, args.workers, affinity=args.affinity, **server_options)
+    else:
+        start_combined_server(args.host, args.port, **server_options)
+
 if __name__ == '__main__':
-    start_combined_server()
+    main()